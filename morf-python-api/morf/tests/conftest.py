@@ -0,0 +1,116 @@
+import hashlib
+import io
+import os
+import shutil
+import pytest
+from botocore.exceptions import ClientError
+from morf.utils import catalog
+
+
+class FakePaginator:
+    def __init__(self, s3):
+        self.s3 = s3
+
+    def paginate(self, Bucket, Prefix=""):
+        keys = sorted(k for k in self.s3.buckets.get(Bucket, {}) if k.startswith(Prefix))
+        for i in range(0, len(keys), self.s3.page_size):
+            yield {"Contents": [self.s3._describe(Bucket, k) for k in keys[i:i + self.s3.page_size]]}
+
+
+class FakeS3:
+    """
+    Minimal in-memory stand-in for a boto3 s3 client, recording the name of every request made.
+    """
+    def __init__(self, page_size=1000):
+        self.buckets = {}
+        self.page_size = page_size
+        self.requests = []
+
+    def put(self, bucket, key, data):
+        self.buckets.setdefault(bucket, {})[key] = data
+
+    def _describe(self, bucket, key):
+        data = self.buckets[bucket][key]
+        return {"Key": key, "Size": len(data), "ETag": '"{}"'.format(hashlib.md5(data).hexdigest())}
+
+    def get_paginator(self, name):
+        self.requests.append("ListObjectsV2")
+        return FakePaginator(self)
+
+    def head_object(self, Bucket, Key):
+        self.requests.append("HeadObject")
+        if Key not in self.buckets.get(Bucket, {}):
+            raise ClientError({"Error": {"Code": "404", "Message": "Not Found"}}, "HeadObject")
+        obj = self._describe(Bucket, Key)
+        return {"ContentLength": obj["Size"], "ETag": obj["ETag"]}
+
+    def get_object(self, Bucket, Key, Range=None):
+        self.requests.append("GetObject")
+        data = self.buckets[Bucket][Key]
+        if Range:
+            start, end = [int(x) for x in Range[len("bytes="):].split("-")]
+            data = data[start:end + 1]
+        return {"Body": io.BytesIO(data), "ContentLength": len(data)}
+
+    def download_file(self, Bucket, Key, Filename, Config=None, Callback=None):
+        self.requests.append("GetObject")
+        with open(Filename, "wb") as f:
+            f.write(self.buckets[Bucket][Key])
+
+    def upload_file(self, Filename, Bucket, Key, Config=None, Callback=None):
+        self.requests.append("PutObject")
+        with open(Filename, "rb") as f:
+            self.put(Bucket, Key, f.read())
+
+    def copy_object(self, CopySource, Bucket, Key):
+        self.requests.append("CopyObject")
+        self.put(Bucket, Key, self.buckets[CopySource["Bucket"]][CopySource["Key"]])
+
+    def delete_objects(self, Bucket, Delete):
+        self.requests.append("DeleteObjects")
+        for obj in Delete["Objects"]:
+            self.buckets[Bucket].pop(obj["Key"], None)
+        return {"Deleted": Delete["Objects"]}
+
+
+class FakeJobConfig:
+    """
+    Stand-in for MorfJobConfig with the attributes used by morf.utils, backed by a FakeS3 client.
+    """
+    def __init__(self, tmpdir, s3):
+        self.s3 = s3
+        self.morf_id = "morf-id"
+        self.user_id = "user"
+        self.job_id = "job"
+        self.mode = "extract"
+        self.run_id = "run-1"
+        self.email_to = "user@example.com"
+        self.logging_dir = str(tmpdir.mkdir("logs"))
+        self.cache_dir = str(tmpdir.mkdir("cache"))
+        self.local_working_directory = str(tmpdir.mkdir("working"))
+        self.proc_data_bucket = "proc-bucket"
+        self.raw_data_buckets = ("raw-bucket",)
+        self.access_table_url = str(tmpdir.join("access.csv"))
+        with open(self.access_table_url, "w") as f:
+            f.write("email,email_logging_authorized\nuser@example.com,F\n")
+
+    def initialize_s3(self):
+        return self.s3
+
+
+@pytest.fixture
+def fake_s3():
+    return FakeS3()
+
+
+@pytest.fixture
+def job_config(tmpdir, fake_s3):
+    return FakeJobConfig(tmpdir, fake_s3)
+
+
+@pytest.fixture(autouse=True)
+def clear_catalogs():
+    # bucket catalogs are cached per process; start every test without them
+    catalog._catalogs.clear()
+    yield
+    catalog._catalogs.clear()
@@ -0,0 +1,55 @@
+import hashlib
+import os
+import pytest
+from morf.utils import artifacts
+from morf.utils.artifacts import fetch_artifact, artifact_md5, get_artifact_cache
+
+
+@pytest.fixture
+def downloads(monkeypatch):
+    urls = []
+    download_url = artifacts.download_url
+
+    def counting_download_url(job_config, url, dest_fp):
+        urls.append(url)
+        return download_url(job_config, url, dest_fp)
+
+    monkeypatch.setattr(artifacts, "download_url", counting_download_url)
+    return urls
+
+
+def test_tasks_link_cached_artifact(job_config, tmpdir, downloads, monkeypatch):
+    image_fp = str(tmpdir.join("image.tar"))
+    with open(image_fp, "wb") as f:
+        f.write(b"image-a")
+    url = "file://" + image_fp
+    task_fps = [fetch_artifact(job_config, url, str(tmpdir.mkdir("task{}".format(i))), "docker_image") for i in range(3)]
+    assert len(downloads) == 1
+    assert len({os.stat(fp).st_ino for fp in task_fps}) == 1
+    # the md5 of a linked artifact comes from the cache without reading the file
+    with monkeypatch.context() as m:
+        m.setattr(artifacts, "generate_md5", lambda fp: pytest.fail("artifact was hashed again"))
+        assert artifact_md5(job_config, task_fps[0]) == hashlib.md5(b"image-a").hexdigest()
+    # a new version of the file replaces the cached one
+    with open(image_fp, "wb") as f:
+        f.write(b"image-bb")
+    new_fp = fetch_artifact(job_config, url, str(tmpdir.mkdir("task3")), "docker_image")
+    assert open(new_fp, "rb").read() == b"image-bb"
+    assert len(downloads) == 2
+    assert not os.path.exists(get_artifact_cache(job_config).blob_path(hashlib.md5(b"image-a").hexdigest()))
+
+
+def test_s3_artifact_checksum_verified(job_config, fake_s3, tmpdir, downloads, monkeypatch):
+    fake_s3.put("proc-bucket", "user/job/docker_image", b"image-a")
+    url = "s3://proc-bucket/user/job/docker_image"
+    monkeypatch.setattr(artifacts, "download_s3_object",
+                        lambda job_config, bucket, key, dest_fp: open(dest_fp, "wb").write(fake_s3.buckets[bucket][key]))
+    dest_fp = fetch_artifact(job_config, url, str(tmpdir.mkdir("task0")), "docker_image")
+    assert open(dest_fp, "rb").read() == b"image-a"
+    # a corrupted download is not cached or handed to tasks
+    fake_s3.put("proc-bucket", "user/job/docker_image", b"image-b")
+    monkeypatch.setattr(artifacts, "download_s3_object",
+                        lambda job_config, bucket, key, dest_fp: open(dest_fp, "wb").write(b"corrupt"))
+    with pytest.raises(IOError):
+        fetch_artifact(job_config, url, str(tmpdir.mkdir("task1")), "docker_image")
+    assert not os.path.exists(str(tmpdir.join("task1", "docker_image")))
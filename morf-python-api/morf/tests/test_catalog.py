@@ -0,0 +1,56 @@
+import pytest
+from morf.utils import fetch_raw_course_sessions
+from morf.utils.catalog import BucketCatalog, list_bucket_objects
+
+KEYS = ["morf-data/coursera_course_dates.csv",
+        "morf-data/labels-train.csv",
+        "morf-data/accounting/001/forum.sql.gz",
+        "morf-data/accounting/002/forum.sql.gz",
+        "morf-data/accounting/2013-003/forum.sql.gz",
+        "morf-data/biology/001/clickstream.gz",
+        "other-dir/ignored/001/file.txt"]
+
+
+@pytest.fixture
+def raw_s3(fake_s3):
+    fake_s3.page_size = 2
+    for key in KEYS:
+        fake_s3.put("bucket", key, key.encode("utf-8"))
+    return fake_s3
+
+
+def test_list_bucket_objects_paginates(fake_s3):
+    for i in range(2500):
+        fake_s3.put("bucket", "morf-data/c/{:04d}/f".format(i), b"")
+    objs = list(list_bucket_objects(fake_s3, "bucket", "morf-data/"))
+    assert len(objs) == 2500
+
+
+def test_catalog_courses_and_sessions(raw_s3):
+    catalog = BucketCatalog.from_s3(raw_s3, "bucket", "morf-data")
+    assert catalog.courses() == ["accounting", "biology"]
+    assert catalog.sessions("accounting") == ["001", "002", "2013-003"]
+    assert catalog.holdout_session("accounting") == "2013-003"
+    assert catalog.sessions("missing") == []
+    assert [x[0] for x in catalog.session_objects("accounting", "002")] == ["morf-data/accounting/002/forum.sql.gz"]
+    assert catalog.object_size("morf-data/labels-train.csv") == len("morf-data/labels-train.csv")
+    with pytest.raises(KeyError):
+        catalog.object_size("other-dir/ignored/001/file.txt")
+
+
+def test_catalog_roundtrip(raw_s3, tmpdir):
+    catalog = BucketCatalog.from_s3(raw_s3, "bucket", "morf-data/")
+    fp = str(tmpdir.join("catalog.json"))
+    catalog.to_file(fp)
+    loaded = BucketCatalog.from_file(fp)
+    assert loaded.objects == catalog.objects
+    assert loaded.courses() == catalog.courses()
+    assert loaded.is_fresh(60) and not loaded.is_fresh(0)
+
+
+def test_raw_course_sessions_by_level(job_config, raw_s3):
+    assert fetch_raw_course_sessions(job_config, "bucket", "course", "extract-holdout", "morf-data/", "accounting") == \
+        [("bucket", "accounting", "2013-003")]
+    assert len(fetch_raw_course_sessions(job_config, ["bucket"], "all", "extract", "morf-data/")) == 2
+    with pytest.raises(ValueError):
+        fetch_raw_course_sessions(job_config, "bucket", "courses", "extract", "morf-data/", "accounting")
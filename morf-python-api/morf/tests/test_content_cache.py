@@ -0,0 +1,145 @@
+import errno
+import gzip
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from morf.utils import content_cache
+from morf.utils.catalog import get_bucket_catalog
+from morf.utils.content_cache import ContentCache, fetch_cached_object, get_content_cache, pop_bind_mounts
+from morf.utils.docker import make_docker_run_command
+from morf.utils.s3interface import sync_s3_job_cache
+
+
+def test_content_cache_downloads_each_version_once(job_config, fake_s3):
+    fake_s3.put("raw-bucket", "morf-data/course/001/a.csv", b"a")
+    get_bucket_catalog(job_config, "raw-bucket") # etags come from the catalog, not HEAD requests
+    cache = get_content_cache(job_config)
+    path = cache.get(job_config, "raw-bucket", "morf-data/course/001/a.csv")
+    assert cache.get(job_config, "raw-bucket", "morf-data/course/001/a.csv") == path
+    assert fake_s3.requests == ["ListObjectsV2", "GetObject"]
+    # a new version of the object is stored separately
+    fake_s3.put("raw-bucket", "morf-data/course/001/a.csv", b"a2")
+    new_path = cache.get(job_config, "raw-bucket", "morf-data/course/001/a.csv", etag=fake_s3._describe("raw-bucket", "morf-data/course/001/a.csv")["ETag"])
+    assert new_path != path and open(new_path, "rb").read() == b"a2"
+
+
+
+def test_objects_with_same_etag_are_not_shared(job_config, fake_s3):
+    # multipart and SSE-KMS ETags are not content hashes, so equal ETags do not mean equal content
+    cache = get_content_cache(job_config)
+    fake_s3.put("raw-bucket", "a.csv", b"a")
+    fake_s3.put("proc-bucket", "b.csv", b"b")
+    path_a = cache.get(job_config, "raw-bucket", "a.csv", etag='"same-etag-1"')
+    path_b = cache.get(job_config, "proc-bucket", "b.csv", etag='"same-etag-1"')
+    assert open(path_a, "rb").read() == b"a" and open(path_b, "rb").read() == b"b"
+
+def test_content_cache_evicts_least_recently_used(job_config, fake_s3):
+    cache = ContentCache(job_config.cache_dir, max_bytes=25)
+    for name in ("a", "b", "c"):
+        fake_s3.put("raw-bucket", name, name.encode() * 10)
+    a = cache.get(job_config, "raw-bucket", "a")
+    cache.get(job_config, "raw-bucket", "b")
+    cache.get(job_config, "raw-bucket", "a") # a is now more recently used than b
+    cache.get(job_config, "raw-bucket", "c")
+    assert os.path.exists(a)
+    assert cache.lookup(fake_s3._describe("raw-bucket", "b")["ETag"].strip('"')) is None
+    assert cache.size() == 20
+
+
+def test_concurrent_misses_download_once(job_config, fake_s3, monkeypatch):
+    fake_s3.put("raw-bucket", "labels-train.csv", b"labels")
+    etag = fake_s3._describe("raw-bucket", "labels-train.csv")["ETag"]
+    download_s3_object = content_cache.download_s3_object
+
+    def slow_download(*args, **kwargs):
+        time.sleep(0.2) # keep the fill in progress while the other callers miss
+        return download_s3_object(*args, **kwargs)
+
+    monkeypatch.setattr(content_cache, "download_s3_object", slow_download)
+    cache = get_content_cache(job_config)
+    with ThreadPoolExecutor(8) as executor:
+        paths = list(executor.map(lambda _: cache.get(job_config, "raw-bucket", "labels-train.csv", etag), range(8)))
+    assert len(set(paths)) == 1 and open(paths[0], "rb").read() == b"labels"
+    assert fake_s3.requests == ["GetObject"]
+    assert os.listdir(cache.tmp_dir) == []
+
+
+def test_fetch_cached_object_decompresses(job_config, fake_s3, tmpdir):
+    fake_s3.put("raw-bucket", "morf-data/course/001/dump.sql.gz", gzip.compress(b"select 1;"))
+    dest_fp = str(tmpdir.join("input", "dump.sql"))
+    fetch_cached_object(job_config, "raw-bucket", "morf-data/course/001/dump.sql.gz", dest_fp, decompress=True)
+    assert open(dest_fp, "rb").read() == b"select 1;"
+
+
+def test_decompressed_object_is_cached_by_source_etag(job_config, fake_s3, tmpdir, monkeypatch):
+    fake_s3.put("raw-bucket", "dump.sql.gz", gzip.compress(b"select 1;"))
+    etag = fake_s3._describe("raw-bucket", "dump.sql.gz")["ETag"]
+    fetch_cached_object(job_config, "raw-bucket", "dump.sql.gz", str(tmpdir.join("1", "dump.sql")), etag, decompress=True)
+    fake_s3.requests.clear()
+    monkeypatch.setattr(content_cache, "gunzip_to_file", None) # a second fetch must not decompress again
+    dest_fp = str(tmpdir.join("2", "dump.sql"))
+    fetch_cached_object(job_config, "raw-bucket", "dump.sql.gz", dest_fp, etag, decompress=True)
+    assert open(dest_fp, "rb").read() == b"select 1;"
+    assert fake_s3.requests == []
+    cache = get_content_cache(job_config)
+    assert cache.lookup(content_cache.make_digest("raw-bucket", "dump.sql.gz", etag, content_cache.GUNZIP))
+    assert cache.lookup(content_cache.make_digest("raw-bucket", "dump.sql.gz", etag)) is None # compressed object was not kept
+
+
+def test_sync_job_cache_fills_content_cache(job_config, fake_s3):
+    fake_s3.put("proc-bucket", "user/job/extract/user-job-extract.csv", b"features")
+    sync_s3_job_cache(job_config, modes=("extract",))
+    fake_s3.requests.clear()
+    path = get_content_cache(job_config).get(job_config, "proc-bucket", "user/job/extract/user-job-extract.csv")
+    assert open(path, "rb").read() == b"features"
+    assert fake_s3.requests == ["HeadObject"]
+
+
+def test_link_staging_shares_cached_object(job_config, fake_s3, tmpdir):
+    fake_s3.put("raw-bucket", "a.csv", b"a" * 100)
+    cache = get_content_cache(job_config)
+    path = cache.get(job_config, "raw-bucket", "a.csv")
+    dest_fp = str(tmpdir.join("input", "a.csv"))
+    assert cache.materialize(path, dest_fp, staging_mode="link") in ("reflink", "hardlink")
+    assert open(dest_fp, "rb").read() == b"a" * 100
+    assert os.stat(path).st_mode & 0o777 == 0o444 # cached objects are read-only
+
+
+def test_link_staging_falls_back_to_bind_mount(job_config, fake_s3, tmpdir, monkeypatch):
+    fake_s3.put("raw-bucket", "a.csv", b"a")
+    cache = get_content_cache(job_config)
+    path = cache.get(job_config, "raw-bucket", "a.csv")
+
+    def cross_device(*args):
+        raise OSError(errno.EXDEV, "cross-device link")
+
+    monkeypatch.setattr(content_cache, "reflink", cross_device)
+    monkeypatch.setattr(os, "link", cross_device)
+    input_dir = str(tmpdir.join("input"))
+    dest_fp = os.path.join(input_dir, "course", "001", "a.csv")
+    assert cache.materialize(path, dest_fp, staging_mode="link", allow_bind=True) == "bind"
+    cmd = make_docker_run_command(job_config, "docker", input_dir, str(tmpdir.join("output")), "image", "course", "001", "extract")
+    assert "--volume={}:/input/course/001/a.csv:ro".format(path) in cmd
+    # the mounted object is kept while the container may be running
+    cache.max_bytes = 0
+    cache.evict()
+    assert os.path.exists(path)
+    assert pop_bind_mounts(input_dir) == [(path, os.path.join("course", "001", "a.csv"))]
+    assert pop_bind_mounts(input_dir) == []
+    cache.evict()
+    assert not os.path.exists(path)
+    cache.max_bytes = 10 ** 6
+    path = cache.get(job_config, "raw-bucket", "a.csv")
+    # without allow_bind, the object is copied
+    assert cache.materialize(path, str(tmpdir.join("features", "a.csv")), staging_mode="link") == "copy"
+
+
+def test_link_staging_mounts_input_read_only(job_config, tmpdir):
+    input_dir, output_dir = str(tmpdir.join("input")), str(tmpdir.join("output"))
+    cmd = make_docker_run_command(job_config, "docker", input_dir, output_dir, "image", "course", "001", "extract")
+    assert "--volume={}:/input ".format(input_dir) in cmd
+    # hardlinked inputs share the cached object, which root in the container could otherwise modify
+    job_config.staging_mode = "link"
+    cmd = make_docker_run_command(job_config, "docker", input_dir, output_dir, "image", "course", "001", "extract")
+    assert "--volume={}:/input:ro ".format(input_dir) in cmd
+    assert "--volume={}:/output ".format(output_dir) in cmd
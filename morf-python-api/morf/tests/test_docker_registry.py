@@ -0,0 +1,131 @@
+import logging
+import os
+import stat
+import sys
+from multiprocessing.pool import ThreadPool
+import pytest
+from morf.utils.docker import acquire_docker_image, release_docker_image, registered_docker_image, \
+    remove_job_docker_images, docker_image_registry
+
+FAKE_DOCKER = """#!{python}
+import hashlib, os, sys
+state_fp = {state_fp!r}
+images = open(state_fp).read().split() if os.path.exists(state_fp) else []
+cmd = sys.argv[1]
+if cmd == "load":
+    image = hashlib.md5(open(sys.argv[3], "rb").read()).hexdigest()
+    with open(state_fp + ".loads", "a") as f:
+        f.write(image + "\\n")
+    images.append(image)
+    print("Loaded image ID: sha256:" + image)
+elif cmd == "image":
+    sys.exit(0 if sys.argv[3] in images else 1)
+elif cmd == "rmi":
+    images = [i for i in images if i != sys.argv[3]]
+with open(state_fp, "w") as f:
+    f.write("\\n".join(images))
+"""
+
+logger = logging.getLogger(__name__)
+
+
+@pytest.fixture
+def docker_job_config(job_config, tmpdir):
+    docker_fp = str(tmpdir.join("docker"))
+    with open(docker_fp, "w") as f:
+        f.write(FAKE_DOCKER.format(python=sys.executable, state_fp=str(tmpdir.join("images"))))
+    os.chmod(docker_fp, os.stat(docker_fp).st_mode | stat.S_IEXEC)
+    job_config.docker_exec = docker_fp
+    job_config.docker_image_cache_size = 0
+    return job_config
+
+
+def make_image(tmpdir, name, data):
+    image_fp = str(tmpdir.join(name))
+    with open(image_fp, "wb") as f:
+        f.write(data)
+    return image_fp
+
+
+def loaded_images(tmpdir):
+    state_fp = str(tmpdir.join("images"))
+    return open(state_fp).read().split() if os.path.exists(state_fp) else []
+
+
+def load_count(tmpdir):
+    loads_fp = str(tmpdir.join("images.loads"))
+    return len(open(loads_fp).read().split()) if os.path.exists(loads_fp) else 0
+
+
+def test_image_loaded_once_for_concurrent_tasks(docker_job_config, tmpdir):
+    # every task downloads its own copy of the same image
+    image_fps = [make_image(tmpdir, "docker_image_{}".format(i), b"image-a") for i in range(8)]
+
+    def run_task(image_fp):
+        with registered_docker_image(docker_job_config, image_fp, logger) as image_uuid:
+            return image_uuid
+
+    with ThreadPool(4) as pool:
+        image_uuids = pool.map(run_task, image_fps)
+    assert len(set(image_uuids)) == 1
+    assert load_count(tmpdir) == 1
+    # the image stays loaded until the job ends
+    assert loaded_images(tmpdir) == image_uuids[:1]
+    assert remove_job_docker_images(docker_job_config, logger)
+    assert loaded_images(tmpdir) == []
+
+
+def test_images_of_running_jobs_are_kept(docker_job_config, tmpdir):
+    image_fp = make_image(tmpdir, "docker_image", b"image-a")
+    digest, image_uuid = acquire_docker_image(docker_job_config, image_fp, logger)
+    other_job_config = type(docker_job_config)(tmpdir.mkdir("other"), docker_job_config.s3)
+    other_job_config.__dict__.update(docker_job_config.__dict__, morf_id="other-morf-id")
+    with registered_docker_image(other_job_config, image_fp, logger):
+        pass
+    assert remove_job_docker_images(other_job_config, logger) == []
+    assert loaded_images(tmpdir) == [image_uuid]
+    release_docker_image(docker_job_config, digest)
+    assert remove_job_docker_images(docker_job_config, logger) == [digest]
+    assert load_count(tmpdir) == 1
+
+
+def test_unused_images_evicted_least_recently_used_first(docker_job_config, tmpdir):
+    docker_job_config.docker_image_cache_size = 1
+    for data in (b"image-a", b"image-b"):
+        with registered_docker_image(docker_job_config, make_image(tmpdir, "docker_image", data), logger):
+            pass
+    removed = remove_job_docker_images(docker_job_config, logger)
+    assert len(removed) == 1
+    with docker_image_registry(docker_job_config) as registry:
+        assert list(registry.values())[0]["image"] == loaded_images(tmpdir)[0]
+    # a later job reuses the image kept loaded, and reloads it if it was removed outside MORF
+    with registered_docker_image(docker_job_config, make_image(tmpdir, "docker_image", b"image-b"), logger):
+        pass
+    assert load_count(tmpdir) == 2
+    os.remove(str(tmpdir.join("images")))
+    with registered_docker_image(docker_job_config, make_image(tmpdir, "docker_image", b"image-b"), logger):
+        pass
+    assert load_count(tmpdir) == 3
+
+
+def test_failed_job_releases_images(docker_job_config, tmpdir, monkeypatch):
+    from morf.utils import job_runner_utils
+    image_fp = make_image(tmpdir, "docker_image", b"image-a")
+    with registered_docker_image(docker_job_config, image_fp, logger):
+        pass
+
+    def missing_field(*args, **kwargs):
+        raise KeyError("docker_url")
+
+    for name in ("clear_s3_metrics", "refresh_bucket_catalogs", "update_raw_data_cache"):
+        monkeypatch.setattr(job_runner_utils, name, lambda *args, **kwargs: None)
+    monkeypatch.setattr(job_runner_utils, "fetch_artifact", missing_field)
+    docker_job_config.initialize_s3 = lambda: None
+    docker_job_config.docker_url = docker_job_config.controller_url = "s3://bucket/missing"
+    monkeypatch.chdir(str(tmpdir))
+    tmpdir.join("config.properties").write("")
+    with pytest.raises(SystemExit):
+        job_runner_utils.run_morf_job(docker_job_config)
+    assert loaded_images(tmpdir) == []
+    with docker_image_registry(docker_job_config) as registry:
+        assert registry == {}
@@ -0,0 +1,13 @@
+import pandas as pd
+import pytest
+from morf.workflow.evaluate import fetch_binary_classification_metrics
+
+
+@pytest.mark.parametrize("label_values", [["0", "1", "1", "0", "1"], [0, 1, 1, 0, 1]])
+def test_class_counts(job_config, label_values):
+    df = pd.DataFrame({"course": ["a"] * 5 + ["b"], "label_value": label_values + [label_values[0]],
+                       "pred": ["0", "1", "0", "0", "1", "1"], "prob": [0.1, 0.9, 0.4, 0.2, 0.8, 0.7]})
+    metrics_df = fetch_binary_classification_metrics(job_config, df, "a")
+    assert metrics_df.loc["a", "N"] == 5
+    assert metrics_df.loc["a", "N_n"] == 2
+    assert metrics_df.loc["a", "N_p"] == 3
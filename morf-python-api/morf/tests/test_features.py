@@ -0,0 +1,72 @@
+import os
+from morf.utils import api_utils
+from morf.utils import filter_train_test_data, make_feature_csv_name
+from morf.utils.api_utils import partition_collected_features
+from morf.utils.features import fetch_feature_partition
+
+COLLECTED_CSV = """userID,feature_1,feature_2,course,session
+u1,1,,course-a,001
+u2,2,0.5,course-a,001
+u3,3,1.5,course-a,002
+u4,4,2.5,course-b,001
+"""
+
+
+def test_partitions_match_filtered_features(job_config, fake_s3, tmpdir, monkeypatch):
+    def upload_file_to_s3(file, bucket, key, job_config=None, remove_on_success=False, raise_errors=False):
+        with open(file, "rb") as f:
+            fake_s3.put(bucket, key, f.read())
+
+    monkeypatch.setattr(api_utils, "upload_file_to_s3", upload_file_to_s3)
+    collected_fp = tmpdir.join("user-job-extract.csv")
+    collected_fp.write(COLLECTED_CSV)
+    partition_collected_features(job_config, str(collected_fp))
+    for course, session in (("course-a", "001"), ("course-a", "002"), ("course-b", "001"), ("course-b", "002")):
+        # features filtered from the whole file, as staged without partitions
+        input_dir = tmpdir.join("filtered")
+        input_dir.ensure(course, session, dir=True)
+        collected_fp.copy(input_dir.join(course, session, "collected.csv"))
+        filter_train_test_data(job_config, course, session, str(input_dir), "collected.csv")
+        filtered = input_dir.join(course, session, make_feature_csv_name(course, session)).read()
+        partition_fp = str(tmpdir.join("partitioned", course, session, make_feature_csv_name(course, session)))
+        assert fetch_feature_partition(job_config, course, session, "extract", partition_fp) == partition_fp
+        assert open(partition_fp).read() == filtered
+
+
+def test_unpartitioned_features_fall_back(job_config, tmpdir):
+    assert fetch_feature_partition(job_config, "course-a", "001", "extract", str(tmpdir.join("features.csv"))) is None
+    assert not os.path.exists(str(tmpdir.join("features.csv")))
+
+
+def test_failed_partition_upload_leaves_features_unindexed(job_config, fake_s3, tmpdir, monkeypatch):
+    def upload_file(Filename, Bucket, Key, Config=None, Callback=None, ExtraArgs=None):
+        if "course-b" in Key:
+            raise IOError("connection reset")
+        with open(Filename, "rb") as f:
+            fake_s3.put(Bucket, Key, f.read())
+
+    monkeypatch.setattr(fake_s3, "upload_file", upload_file)
+    monkeypatch.setattr("morf.utils.get_s3_client", lambda: fake_s3)
+    # index of an earlier run of the job
+    fake_s3.put("proc-bucket", "user/job/extract/user-job-extract-features-index.json", b"{}")
+    collected_fp = tmpdir.join("user-job-extract.csv")
+    collected_fp.write(COLLECTED_CSV)
+    assert partition_collected_features(job_config, str(collected_fp)) is None
+    assert not [k for k in fake_s3.buckets["proc-bucket"] if k.endswith("features-index.json")]
+    # staging falls back to filtering the collected file
+    assert fetch_feature_partition(job_config, "course-a", "001", "extract", str(tmpdir.join("features.csv"))) is None
+
+
+def test_partitions_are_fetched_without_cache(job_config, fake_s3, tmpdir, monkeypatch):
+    def upload_file_to_s3(file, bucket, key, job_config=None, remove_on_success=False, raise_errors=False):
+        with open(file, "rb") as f:
+            fake_s3.put(bucket, key, f.read())
+
+    monkeypatch.setattr(api_utils, "upload_file_to_s3", upload_file_to_s3)
+    job_config.cache_dir = None
+    collected_fp = tmpdir.join("user-job-extract.csv")
+    collected_fp.write(COLLECTED_CSV)
+    partition_collected_features(job_config, str(collected_fp))
+    partition_fp = str(tmpdir.join("partitioned", "course-a", "001", make_feature_csv_name("course-a", "001")))
+    assert fetch_feature_partition(job_config, "course-a", "001", "extract", partition_fp) == partition_fp
+    assert open(partition_fp).read() == "userID,feature_1,feature_2\nu1,1,\nu2,2,0.5\n"
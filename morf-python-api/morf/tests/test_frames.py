@@ -0,0 +1,80 @@
+import numpy as np
+import pandas as pd
+import pytest
+from morf.utils.frames import apply_typed_schema, as_string_frame, make_intermediate_filename, read_intermediate, \
+    write_intermediate, UserIdDictionary, get_user_id_dictionary, make_lean_frame, align_categories, restore_user_ids
+
+COLLECTED_CSV = """userID,feature_1,feature_2,feature_3,course,session
+007,1,0.5,1e3,course-a,001
+8,2,,x,course-a,002
+9,,1.0,3,course-b,001
+"""
+
+
+def test_typed_schema_keeps_values(tmpdir):
+    fp = tmpdir.join("collected.csv")
+    fp.write(COLLECTED_CSV)
+    df = pd.read_csv(str(fp), dtype=object)
+    typed_df = apply_typed_schema(df)
+    assert str(typed_df["feature_1"].dtype) == "Int64"
+    assert typed_df["feature_2"].dtype == np.float64
+    # columns whose values would be written differently as numbers stay strings
+    for column in ("userID", "feature_3", "session"):
+        assert typed_df[column].dtype == object
+    assert as_string_frame(typed_df).values.tolist() == df.values.tolist()
+
+
+def test_csv_intermediate_matches_read_csv(tmpdir):
+    df = pd.DataFrame({"userID": ["007", "8"], "prob": ["0.25", "0.75"]}, dtype=object)
+    fp = write_intermediate(df, str(tmpdir.join("predictions.csv")))
+    assert read_intermediate(fp, dtype=object).values.tolist() == df.values.tolist()
+    assert read_intermediate(fp)["prob"].tolist() == [0.25, 0.75]
+
+
+def test_parquet_intermediate_round_trip(tmpdir):
+    pytest.importorskip("pyarrow")
+    fp = tmpdir.join("collected.csv")
+    fp.write(COLLECTED_CSV)
+    df = pd.read_csv(str(fp), dtype=object)
+    parquet_fp = write_intermediate(df, str(tmpdir.join("collected.parquet")))
+    assert read_intermediate(parquet_fp, dtype=object).values.tolist() == df.values.tolist()
+    pd.testing.assert_frame_equal(read_intermediate(parquet_fp), pd.read_csv(str(fp)), check_dtype=False)
+
+
+def test_intermediate_filename(job_config):
+    assert make_intermediate_filename(job_config, "course_1_train_features.csv") == "course_1_train_features.csv"
+    job_config.intermediate_format = "parquet"
+    assert make_intermediate_filename(job_config, "course_1_train_features.csv") == "course_1_train_features.parquet"
+
+
+def test_user_id_codes_are_shared_by_job(job_config):
+    user_ids = get_user_id_dictionary(job_config)
+    assert get_user_id_dictionary(job_config) is user_ids
+    codes = user_ids.encode(["u1", "u2", np.nan, "u1"])
+    assert codes.dtype == np.int32 and codes[0] == codes[3] and codes[2] < 0
+    # ids read as numbers get the same codes as the same ids read as strings
+    assert (UserIdDictionary().encode([7, "8"]) == UserIdDictionary().encode(["7", 8])).all()
+    assert user_ids.decode(codes).tolist()[:2] == ["u1", "u2"]
+
+
+def test_lean_join_matches_object_join():
+    features = pd.DataFrame({"userID": ["u1", "u2", "u3"], "n_posts": ["3", "0", ""], "course": ["a", "a", "b"],
+                             "session": ["001", "001", "002"]}, dtype=object).replace("", np.nan)
+    labels = pd.DataFrame({"userID": ["u3", "u1", "u4"], "label_value": ["1", "0", "1"], "course": ["b", "a", "c"]},
+                          dtype=object)
+    expected = pd.merge(labels, features, how="left", on=["userID", "course"])
+    user_ids = UserIdDictionary()
+    lean_features, lean_labels = make_lean_frame(features, user_ids), make_lean_frame(labels, user_ids)
+    assert lean_features["userID"].dtype == np.int32 and lean_labels["label_value"].dtype == np.int8
+    assert isinstance(lean_features["session"].dtype, pd.CategoricalDtype)
+    align_categories([lean_labels, lean_features])
+    joined = restore_user_ids(pd.merge(lean_labels, lean_features, how="left", on=["userID", "course"]), user_ids)
+    assert as_string_frame(joined).values.tolist() == as_string_frame(expected).values.tolist()
+
+
+def test_lean_frame_keeps_columns():
+    labels = pd.DataFrame({"userID": ["u1", "u2"], "label_value": ["0", "1"], "course": ["a", "a"]}, dtype=object)
+    lean_labels = make_lean_frame(labels, UserIdDictionary(), keep_columns=["label_value", "course"])
+    assert lean_labels["userID"].dtype == np.int32
+    assert lean_labels["label_value"].tolist() == ["0", "1"]
+    assert lean_labels["course"].dtype == object
@@ -0,0 +1,74 @@
+import os
+import pytest
+from morf.utils import clear_s3_subdirectory, move_results_to_destination
+from morf.utils.job_state import DONE, FAILED, get_job_state, job_task, make_job_state_fp, make_task_id, record_task_output, task_is_complete
+
+
+def test_completed_task_is_skipped_until_inputs_or_outputs_change(job_config, fake_s3):
+    task_id = make_task_id("extract", "session", "course", "001")
+    with job_task(job_config, task_id, "fp1"):
+        fake_s3.put("proc-bucket", "user/job/extract/course/001/result.tgz", b"result")
+        record_task_output("proc-bucket", "user/job/extract/course/001/result.tgz")
+    assert get_job_state(job_config).get(task_id)["status"] == DONE
+    assert task_is_complete(job_config, task_id, "fp1")
+    assert not task_is_complete(job_config, task_id, "fp2") # inputs changed
+    fake_s3.put("proc-bucket", "user/job/extract/course/001/result.tgz", b"overwritten")
+    assert not task_is_complete(job_config, task_id, "fp1") # output changed
+    fake_s3.buckets["proc-bucket"].clear()
+    assert not task_is_complete(job_config, task_id, "fp1") # output deleted
+
+
+def test_failed_tasks_are_recorded(job_config):
+    with pytest.raises(ValueError):
+        with job_task(job_config, "extract/session/course/001", "fp"):
+            raise ValueError("container crashed")
+    with job_task(job_config, "extract/session/course/002", "fp") as task:
+        task.fail("docker run exited with status 1")
+    assert get_job_state(job_config).summary() == {FAILED: 2}
+    assert not task_is_complete(job_config, "extract/session/course/002", "fp")
+
+
+def test_resume_keeps_previous_results(job_config, fake_s3):
+    fake_s3.put("proc-bucket", "user/job/extract/course/001/result.tgz", b"result")
+    with job_task(job_config, "extract/session/course/001", "fp"):
+        record_task_output("proc-bucket", "user/job/extract/course/001/result.tgz")
+    job_config.resume = True
+    clear_s3_subdirectory(job_config)
+    assert "user/job/extract/course/001/result.tgz" in fake_s3.buckets["proc-bucket"]
+    job_config.resume = False
+    clear_s3_subdirectory(job_config)
+    assert fake_s3.buckets["proc-bucket"] == {}
+    assert get_job_state(job_config).get("extract/session/course/001") is None
+
+
+def test_failed_upload_fails_task(job_config, fake_s3, tmpdir, monkeypatch):
+    def upload_file(Filename, Bucket, Key, Config=None, Callback=None):
+        raise IOError("connection reset")
+
+    monkeypatch.setattr(fake_s3, "upload_file", upload_file)
+    monkeypatch.setattr("morf.utils.get_s3_client", lambda: fake_s3)
+    archive_fp = tmpdir.join("result.tgz")
+    archive_fp.write("result")
+    task_id = make_task_id("extract", "session", "course", "001")
+    with job_task(job_config, task_id, "fp", require_outputs=True):
+        move_results_to_destination(str(archive_fp), job_config, course="course", session="001")
+    record = get_job_state(job_config).get(task_id)
+    assert record["status"] == FAILED and "connection reset" in record["error"]
+    assert not task_is_complete(job_config, task_id, "fp", require_outputs=True)
+
+
+def test_task_without_outputs_is_not_complete(job_config):
+    with job_task(job_config, "extract/session/course/001", "fp"):
+        pass
+    assert task_is_complete(job_config, "extract/session/course/001", "fp")
+    assert not task_is_complete(job_config, "extract/session/course/001", "fp", require_outputs=True)
+    with job_task(job_config, "extract/session/course/002", "fp", require_outputs=True):
+        pass
+    assert get_job_state(job_config).get("extract/session/course/002")["status"] == FAILED
+
+
+def test_clearing_without_resume_creates_no_job_state(job_config, fake_s3):
+    fake_s3.put("proc-bucket", "user/job/extract/course/001/result.tgz", b"result")
+    clear_s3_subdirectory(job_config)
+    assert fake_s3.buckets["proc-bucket"] == {}
+    assert not os.path.exists(make_job_state_fp(job_config))
@@ -0,0 +1,88 @@
+import io
+import multiprocessing
+import pickle
+import sys
+import pandas as pd
+import pytest
+from morf.utils import initialize_session_labels
+from morf.utils.labels import get_label_index, get_shared_label_table, label_sharing_pool, SharedLabelTable
+
+LABELS_CSV = b"""userID,course,session,label_type,label_value
+u1,course-a,001,dropout,1
+u2,course-a,001,dropout,0
+u1,course-a,001,grade,0.5
+u3,course-a,002,dropout,1
+u4,course-b,001,dropout,0
+"""
+
+
+@pytest.fixture(params=["cache", "no-cache"])
+def labels_job_config(request, job_config, fake_s3):
+    fake_s3.put("raw-bucket", "morf-data/labels-train.csv", LABELS_CSV)
+    job_config.mode = "train"
+    if request.param == "no-cache":
+        job_config.cache_dir = None
+    return job_config
+
+
+def test_session_labels_read_from_index(labels_job_config, fake_s3, tmpdir):
+    expected = pd.read_csv(io.BytesIO(LABELS_CSV), dtype=object)
+    for course, session in (("course-a", "001"), ("course-a", "002"), ("course-b", "001"), ("course-b", "002")):
+        labels_fp = initialize_session_labels(labels_job_config, "raw-bucket", course, session, "dropout",
+                                              str(tmpdir.join(course, session)), "morf-data/")
+        df = pd.read_csv(labels_fp, dtype=object)
+        match = expected[(expected["course"] == course) & (expected["session"] == session) & (expected["label_type"] == "dropout")]
+        assert list(df.columns) == ["userID", "label_value"]
+        assert df.values.tolist() == match[["userID", "label_value"]].values.tolist()
+    # the labels file is downloaded and indexed once for all sessions
+    assert fake_s3.requests.count("GetObject") == 1
+
+
+def test_new_labels_version_is_indexed(labels_job_config, fake_s3):
+    index = get_label_index(labels_job_config, "raw-bucket", "morf-data/labels-train.csv")
+    assert index.lookup("course-a", "001", "grade")["label_value"].tolist() == ["0.5"]
+    fake_s3.put("raw-bucket", "morf-data/labels-train.csv", LABELS_CSV.replace(b"0.5", b"0.7"))
+    index = get_label_index(labels_job_config, "raw-bucket", "morf-data/labels-train.csv")
+    assert index.lookup("course-a", "001", "grade")["label_value"].tolist() == ["0.7"]
+
+
+def lookup_shared_labels(course, session, label_type):
+    table = get_shared_label_table("raw-bucket", "morf-data/labels-train.csv")
+    return table.lookup(course, session, label_type).values.tolist() if table else None
+
+
+def test_shared_label_table_matches_index(labels_job_config):
+    index = get_label_index(labels_job_config, "raw-bucket", "morf-data/labels-train.csv")
+    table = SharedLabelTable.create(pd.read_csv(io.BytesIO(LABELS_CSV + b"u5,course-b,002,dropout,\n"), dtype=object))
+    try:
+        attached = pickle.loads(pickle.dumps(table))
+        for partition in (("course-a", "001", "dropout"), ("course-a", "001", "grade"), ("course-b", "001", "dropout"), ("course-c", "001", "dropout")):
+            shared_df, index_df = attached.lookup(*partition), index.lookup(*partition)
+            assert list(shared_df.columns) == list(index_df.columns)
+            assert shared_df.values.tolist() == index_df.values.tolist()
+        assert attached.lookup("course-b", "002", "dropout")["label_value"].isnull().all()
+        attached.close()
+    finally:
+        table.unlink()
+
+
+def test_pool_workers_read_shared_labels(labels_job_config):
+    labels_job_config.shared_labels = True
+    key = "morf-data/labels-train.csv"
+    with label_sharing_pool(labels_job_config, "raw-bucket", [key, "morf-data/labels-test.csv"], 2) as pool:
+        results = pool.starmap(lookup_shared_labels, [("course-a", "001", "dropout"), ("course-b", "001", "dropout")])
+        pool.close()
+        pool.join()
+    assert results == [[["u1", "1"], ["u2", "0"]], [["u4", "0"]]]
+    labels_job_config.shared_labels = False
+    with label_sharing_pool(labels_job_config, "raw-bucket", [key], 1) as pool:
+        assert pool.apply(lookup_shared_labels, ("course-a", "001", "dropout")) is None
+
+
+def test_pool_without_shared_memory_reads_index(labels_job_config, monkeypatch):
+    # multiprocessing.shared_memory does not exist before python 3.8
+    monkeypatch.setitem(sys.modules, "multiprocessing.shared_memory", None)
+    monkeypatch.delattr(multiprocessing, "shared_memory", raising=False)
+    labels_job_config.shared_labels = True
+    with label_sharing_pool(labels_job_config, "raw-bucket", ["morf-data/labels-train.csv"], 1) as pool:
+        assert pool.apply(lookup_shared_labels, ("course-a", "001", "dropout")) is None
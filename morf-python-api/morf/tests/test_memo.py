@@ -0,0 +1,30 @@
+from morf.utils.memo import make_memo_key, make_result_fingerprint, restore_memoized_result, store_memoized_result
+
+
+def make_fingerprint(job_config, tmpdir):
+    return make_result_fingerprint(job_config, str(tmpdir.join("docker_image")), "raw-bucket", "session", "course", "001",
+                                   controller_fp=str(tmpdir.join("controller.py")))
+
+
+def test_fingerprint_depends_on_inputs_not_job_id(job_config, fake_s3, tmpdir):
+    tmpdir.join("docker_image").write("image")
+    tmpdir.join("controller.py").write("extract_session()")
+    fake_s3.put("raw-bucket", "morf-data/coursera_course_dates.csv", b"dates")
+    fake_s3.put("raw-bucket", "morf-data/course/001/clickstream.gz", b"clicks")
+    fake_s3.put("raw-bucket", "morf-data/course/002/clickstream.gz", b"other")
+    job_config.client_args = {"window": "3"}
+    fingerprint = make_fingerprint(job_config, tmpdir)
+    job_config.job_id = "another-job"
+    assert make_fingerprint(job_config, tmpdir) == fingerprint
+    job_config.client_args = {"window": "4"}
+    assert make_fingerprint(job_config, tmpdir) != fingerprint
+
+
+def test_memoized_result_is_copied_to_new_job(job_config, fake_s3):
+    fake_s3.put("proc-bucket", "user/job/extract/course/001/user-job-extract-course-001.tgz", b"results")
+    assert not restore_memoized_result(job_config, "abc", "course", "001")
+    assert store_memoized_result(job_config, "abc", "course", "001")
+    assert fake_s3.buckets["proc-bucket"][make_memo_key("abc")] == b"results"
+    job_config.job_id = "job2"
+    assert restore_memoized_result(job_config, "abc", "course", "001")
+    assert fake_s3.buckets["proc-bucket"]["user/job2/extract/course/001/user-job2-extract-course-001.tgz"] == b"results"
@@ -0,0 +1,90 @@
+import json
+import multiprocessing
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import boto3
+import pytest
+from morf.utils import metrics
+from morf.utils.metrics import register_s3_metrics, s3_metrics_context, report_s3_metrics, reset_s3_metrics, \
+    record_s3_request
+
+
+class FakeS3Handler(BaseHTTPRequestHandler):
+    """
+    Answers GET with a 3-byte body, PUT with an empty 200, and HEAD with a 404.
+    """
+    def reply(self, status, body=b""):
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.reply(200, b"abc")
+
+    def do_PUT(self):
+        self.rfile.read(int(self.headers["Content-Length"]))
+        self.reply(200)
+
+    def do_HEAD(self):
+        self.send_response(404)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def s3_endpoint():
+    server = HTTPServer(("127.0.0.1", 0), FakeS3Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield "http://127.0.0.1:{}".format(server.server_port)
+    server.shutdown()
+
+
+def test_s3_metrics_by_stage_and_session(job_config, s3_endpoint):
+    reset_s3_metrics()
+    s3 = register_s3_metrics(boto3.client("s3", region_name="us-east-1", endpoint_url=s3_endpoint,
+                                          aws_access_key_id="key", aws_secret_access_key="secret"))
+    with s3_metrics_context(job_config, stage="extract", course="course", session="001"):
+        s3.get_object(Bucket="raw-bucket", Key="a")["Body"].read()
+        s3.put_object(Bucket="proc-bucket", Key="b", Body=b"hello")
+        with pytest.raises(Exception):
+            s3.head_object(Bucket="raw-bucket", Key="c")
+    with open(report_s3_metrics(job_config)) as f:
+        summary = json.load(f)
+    assert summary["totals"]["GetObject"]["bytes_in"] == 3
+    assert summary["totals"]["PutObject"]["bytes_out"] == 5
+    assert summary["totals"]["HeadObject"]["errors"] == 1
+    assert summary["stages"]["extract"]["GetObject"]["requests"] == 1
+    assert summary["sessions"]["course/001"]["requests"] == 3
+    assert sum(summary["totals"]["GetObject"]["latency_histogram"]) == 1
+
+
+def test_s3_metrics_are_not_inherited(monkeypatch):
+    reset_s3_metrics()
+    record_s3_request("GetObject", 0.01)
+    # as in a child process forked on python < 3.7, without os.register_at_fork
+    monkeypatch.setattr(metrics, "_metrics_pid", -1)
+    record_s3_request("GetObject", 0.01)
+    assert [r["requests"] for r in metrics._records.values()] == [1]
+
+
+def test_s3_metrics_of_pool_workers_are_reported(job_config, monkeypatch):
+    from morf.workflow import cross_validation
+
+    def fetch_sessions(*args, **kwargs):
+        record_s3_request("ListObjectsV2", 0.01)
+        raise IOError("listing failed")
+
+    reset_s3_metrics()
+    monkeypatch.setattr(cross_validation, "fetch_sessions", fetch_sessions)
+    # pool workers exit without running atexit handlers; their counts must be written when each task finishes
+    with multiprocessing.get_context("fork").Pool(1) as pool:
+        res = pool.apply_async(cross_validation.make_folds, [job_config, "raw-bucket", "course", 5, "dropout"])
+        with pytest.raises(IOError):
+            res.get()
+    with open(report_s3_metrics(job_config)) as f:
+        summary = json.load(f)
+    assert summary["stages"]["cv"]["ListObjectsV2"]["requests"] == 1
+    assert summary["sessions"]["course/None"]["requests"] == 1
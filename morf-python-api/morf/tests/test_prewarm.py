@@ -0,0 +1,80 @@
+import gzip
+from morf.utils import download_raw_course_data
+from morf.utils.content_cache import get_content_cache, make_digest
+from morf.utils.prewarm import CacheWarmer, plan_job_prefetch
+
+
+def put_raw_data(fake_s3):
+    fake_s3.put("raw-bucket", "morf-data/coursera_course_dates.csv", b"course,start,end\n")
+    fake_s3.put("raw-bucket", "morf-data/course/001/clickstream.gz", b"c" * 100)
+    fake_s3.put("raw-bucket", "morf-data/course/001/dump.sql.gz", gzip.compress(b"select 1;"))
+    fake_s3.put("raw-bucket", "morf-data/course/002/clickstream.gz", b"d" * 100)
+    fake_s3.put("proc-bucket", "user/job/extract/user-job-extract.csv", b"features")
+
+
+def put_controller(job_config, tmpdir, controller="extract_session()\nextract_holdout_session()\n"):
+    controller_fp = tmpdir.join("controller.py")
+    controller_fp.write(controller)
+    job_config.controller_url = "file://" + str(controller_fp)
+
+
+def test_plan_orders_shared_files_first(job_config, fake_s3):
+    put_raw_data(fake_s3)
+    keys = [key for bucket, key, etag, size, variant in plan_job_prefetch(job_config, {"extract", "extract-holdout"})]
+    assert keys == ["morf-data/coursera_course_dates.csv", "user/job/extract/user-job-extract.csv",
+                    "morf-data/course/001/clickstream.gz", "morf-data/course/001/dump.sql.gz",
+                    "morf-data/course/002/clickstream.gz"]
+
+
+def test_plan_only_sessions_extracted_by_job(job_config, fake_s3, tmpdir):
+    put_raw_data(fake_s3)
+    put_controller(job_config, tmpdir, "from morf.workflow.extract import extract_session\nextract_session()\ntrain_session()\n")
+    keys = [key for bucket, key, etag, size, variant in plan_job_prefetch(job_config)]
+    # session 002 is the holdout session of the course, which the job does not extract
+    assert "morf-data/course/002/clickstream.gz" not in keys
+    assert "morf-data/course/001/clickstream.gz" in keys
+    put_controller(job_config, tmpdir, "fork_features('job-1')\n")
+    assert not [key for bucket, key, etag, size, variant in plan_job_prefetch(job_config) if "/course/" in key]
+
+
+def test_warmed_job_stages_without_downloads(job_config, fake_s3, tmpdir):
+    put_raw_data(fake_s3)
+    put_controller(job_config, tmpdir)
+    CacheWarmer(str(tmpdir.join("queue"))).warm(job_config)
+    fake_s3.requests.clear()
+    input_dir = str(tmpdir.mkdir("input"))
+    download_raw_course_data(job_config, "raw-bucket", "course", "001", input_dir, "morf-data/")
+    assert fake_s3.requests == []
+    assert open(tmpdir.join("input", "course", "001", "dump.sql").strpath, "rb").read() == b"select 1;"
+
+
+def test_warming_stops_at_budget(job_config, fake_s3, tmpdir):
+    put_raw_data(fake_s3)
+    put_controller(job_config, tmpdir)
+    warmer = CacheWarmer(str(tmpdir.join("queue")), budget_gb=150 / 1024 ** 3)
+    warmer.warm(job_config)
+    cache = get_content_cache(job_config)
+    etag = fake_s3._describe("raw-bucket", "morf-data/course/002/clickstream.gz")["ETag"]
+    assert cache.lookup(make_digest("raw-bucket", "morf-data/course/002/clickstream.gz", etag)) is None
+    assert cache.size() <= 150
+
+
+def test_poll_warms_each_queued_config_once(job_config, fake_s3, tmpdir):
+    put_raw_data(fake_s3)
+    queue_dir = tmpdir.mkdir("queue")
+    queue_dir.join("job-1.properties").write("[client]\n")
+    warmer = CacheWarmer(str(queue_dir), make_job_config=lambda config_fp: job_config)
+    assert warmer.poll() == 1
+    assert warmer.poll() == 0
+
+
+def test_warming_never_evicts(job_config, fake_s3, tmpdir):
+    put_raw_data(fake_s3)
+    put_controller(job_config, tmpdir)
+    fake_s3.put("raw-bucket", "running-job-input", b"r" * 100)
+    cache = get_content_cache(job_config)
+    cache.max_bytes = 150
+    running_job_input = cache.get(job_config, "raw-bucket", "running-job-input")
+    CacheWarmer(str(tmpdir.join("queue"))).warm(job_config)
+    assert open(running_job_input, "rb").read() == b"r" * 100
+    assert cache.size() <= 150
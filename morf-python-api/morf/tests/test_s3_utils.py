@@ -1,5 +1,7 @@
 import pytest
-from morf.utils import get_bucket_from_url, get_key_from_url
+from morf.utils import get_bucket_from_url, get_key_from_url, download_from_s3, s3interface
+from morf.utils.s3interface import get_s3_client, reset_s3_pool, delete_s3_prefix, wait_for_pending_clears, \
+    copy_s3_objects
 
 def test_get_bucket_from_url():
     assert get_bucket_from_url("s3://my-bucket/some/file.txt") == "my-bucket"
@@ -10,3 +12,56 @@ def test_get_key_from_url():
     with pytest.raises(AttributeError):
         get_key_from_url("s3://my-bucket/") # tests case of path without a key
 
+def test_s3_client_pool():
+    client = get_s3_client("key", "secret")
+    assert get_s3_client("key", "secret") is client
+    assert get_s3_client("otherkey", "secret") is not client
+    reset_s3_pool()
+    assert get_s3_client("key", "secret") is not client
+
+def test_s3_client_pool_is_not_inherited(monkeypatch):
+    client = get_s3_client("key", "secret")
+    # as in a child process forked on python < 3.7, without os.register_at_fork
+    monkeypatch.setattr(s3interface, "_s3_pool_pid", -1)
+    assert get_s3_client("key", "secret") is not client
+
+def test_delete_s3_prefix_batches(job_config, fake_s3):
+    for i in range(2500):
+        fake_s3.put("proc-bucket", "user/job/extract/{}.csv".format(i), b"x")
+    fake_s3.put("proc-bucket", "user/job/train/model.tgz", b"m")
+    assert delete_s3_prefix(job_config, "proc-bucket", "user/job/extract/") == 2500
+    assert fake_s3.requests.count("DeleteObjects") == 3
+    assert list(fake_s3.buckets["proc-bucket"]) == ["user/job/train/model.tgz"]
+
+def test_delete_s3_prefix_async(job_config, fake_s3):
+    fake_s3.put("proc-bucket", "user/job/extract/old.csv", b"x")
+    thread = delete_s3_prefix(job_config, "proc-bucket", "user/job/extract/", asynchronous=True)
+    fake_s3.put("proc-bucket", "user/job/extract/new.csv", b"y") # written after the listing; must survive
+    wait_for_pending_clears(job_config, poll_interval=0.01)
+    assert not thread.is_alive()
+    assert list(fake_s3.buckets["proc-bucket"]) == ["user/job/extract/new.csv"]
+
+def test_copy_s3_objects_reports_failures(job_config, fake_s3):
+    fake_s3.put("proc-bucket", "user/old/extract/a.tgz", b"a")
+    fake_s3.put("proc-bucket", "user/old/extract/b.tgz", b"b")
+    key_pairs = [("user/old/extract/a.tgz", "user/job/extract/a.tgz"), ("user/old/extract/b.tgz", "user/job/extract/b.tgz"),
+                 ("user/old/extract/missing.csv", "user/job/extract/missing.csv")]
+    assert copy_s3_objects(job_config, "proc-bucket", key_pairs) == [key_pairs[2]]
+    assert fake_s3.buckets["proc-bucket"]["user/job/extract/b.tgz"] == b"b"
+
+
+def test_download_from_s3_requests(job_config, fake_s3, tmpdir):
+    job_config.ranged_download_threshold_mb = 1
+    job_config.range_size_mb = 1
+    data = b"x" * (2 * 1024 * 1024 + 1)
+    fake_s3.put("proc-bucket", "small.csv", b"a,b\n")
+    fake_s3.put("proc-bucket", "large.csv", data)
+    # objects of unknown size are fetched with a single GET, without asking for their size first
+    download_from_s3("proc-bucket", "small.csv", fake_s3, str(tmpdir), job_config=job_config)
+    download_from_s3("proc-bucket", "large.csv", fake_s3, str(tmpdir), job_config=job_config)
+    assert fake_s3.requests == ["GetObject", "GetObject"]
+    fake_s3.requests.clear()
+    etag = fake_s3._describe("proc-bucket", "large.csv")["ETag"]
+    fp = download_from_s3("proc-bucket", "large.csv", fake_s3, str(tmpdir), "ranged.csv", job_config, size=len(data), etag=etag)
+    assert fake_s3.requests == ["GetObject"] * 3
+    assert open(fp, "rb").read() == data
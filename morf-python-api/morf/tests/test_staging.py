@@ -0,0 +1,142 @@
+import gzip
+import io
+import os
+import threading
+import time
+import pytest
+from morf.utils.content_cache import fetch_cached_object
+from morf.utils.staging import StagingEngine, gunzip_to_file, download_ranges
+
+
+class NonSeekableStream:
+    """Mimics an s3 response body, which can only be read forward."""
+    def __init__(self, data):
+        self.buf = io.BytesIO(data)
+
+    def read(self, n=-1):
+        return self.buf.read(n)
+
+
+def test_gunzip_to_file_streams(tmpdir):
+    data = b"INSERT INTO forum VALUES (1, 'a');\n" * 10000
+    dest_fp = str(tmpdir.join("forum.sql"))
+    gunzip_to_file(NonSeekableStream(gzip.compress(data)), dest_fp, chunk_size=1024)
+    with open(dest_fp, "rb") as f:
+        assert f.read() == data
+    assert os.listdir(str(tmpdir)) == ["forum.sql"]
+
+
+def test_gunzip_to_file_multiple_members(tmpdir):
+    dest_fp = str(tmpdir.join("out.sql"))
+    gunzip_to_file(io.BytesIO(gzip.compress(b"first\n") + gzip.compress(b"second\n")), dest_fp)
+    with open(dest_fp, "rb") as f:
+        assert f.read() == b"first\nsecond\n"
+
+
+def test_gunzip_to_file_removes_partial_output(tmpdir):
+    dest_fp = str(tmpdir.join("forum.sql"))
+    with pytest.raises(EOFError):
+        gunzip_to_file(io.BytesIO(gzip.compress(b"x" * 10000)[:-20]), dest_fp)
+    assert os.listdir(str(tmpdir)) == []
+
+
+def test_download_ranges_resumes(tmpdir):
+    data = os.urandom(10 * 1024 + 7)
+    dest_fp = str(tmpdir.join("docker_image"))
+    requested = []
+    fail_at = {4096}
+
+    def open_range(start, end):
+        requested.append(start)
+        if start in fail_at:
+            raise IOError("connection reset")
+        return io.BytesIO(data[start:end + 1])
+
+    with pytest.raises(IOError):
+        download_ranges(len(data), dest_fp, open_range, validator="etag", range_size=2048, max_workers=2)
+    assert not os.path.exists(dest_fp)
+    requested.clear()
+    fail_at.clear()
+    download_ranges(len(data), dest_fp, open_range, validator="etag", range_size=2048, max_workers=3)
+    assert requested == [4096]
+    with open(dest_fp, "rb") as f:
+        assert f.read() == data
+    assert os.listdir(str(tmpdir)) == ["docker_image"]
+
+
+def test_download_ranges_without_validator_starts_over(tmpdir):
+    data = os.urandom(4096)
+    dest_fp = str(tmpdir.join("file"))
+    requested = []
+    fail_at = {2048}
+
+    def open_range(start, end):
+        requested.append(start)
+        if start in fail_at:
+            raise IOError("connection reset")
+        return io.BytesIO(data[start:end + 1])
+
+    with pytest.raises(IOError):
+        download_ranges(len(data), dest_fp, open_range, range_size=2048, max_workers=1)
+    requested.clear()
+    fail_at.clear()
+    download_ranges(len(data), dest_fp, open_range, range_size=2048, max_workers=1)
+    assert requested == [0, 2048]
+    with open(dest_fp, "rb") as f:
+        assert f.read() == data
+
+
+def test_staging_engine_bounds_concurrency(job_config):
+    job_config.staging_max_workers = 2
+    engine = StagingEngine(job_config)
+    lock = threading.Lock()
+    running = [0]
+    peak = [0]
+
+    def stage():
+        with lock:
+            running[0] += 1
+            peak[0] = max(peak[0], running[0])
+        time.sleep(0.05)
+        with lock:
+            running[0] -= 1
+
+    for i in range(6):
+        engine.add_call(stage)
+    engine.run()
+    assert peak[0] == 2
+    assert engine.tasks == []
+
+
+def test_staging_engine_raises_required_failures_only(job_config):
+    def fail(message):
+        raise IOError(message)
+
+    staged = []
+    engine = StagingEngine(job_config)
+    engine.add_call(fail, "optional", required=False)
+    engine.add_call(staged.append, "a")
+    assert engine.run()["failed"] == 1
+    engine.add_call(fail, "required")
+    engine.add_call(fail, "optional", required=False)
+    engine.add_call(staged.append, "b")
+    with pytest.raises(IOError, match="required"):
+        engine.run()
+    assert staged == ["a", "b"] # other tasks still run
+
+
+def test_staging_engine_counts_downloads_and_calls(job_config, fake_s3, tmpdir):
+    fake_s3.put("raw-bucket", "course/001/forum.sql.gz", gzip.compress(b"x" * 100))
+    fake_s3.put("raw-bucket", "course/001/users.csv", b"y" * 30)
+    fake_s3.put("raw-bucket", "course/001/grades.csv", b"z" * 50)
+    engine = StagingEngine(job_config)
+    engine.add_download("raw-bucket", "course/001/forum.sql.gz", str(tmpdir.join("forum.sql")), decompress=True)
+    engine.add_download("raw-bucket", "course/001/users.csv", str(tmpdir.join("users.csv")))
+    # staged from the content cache
+    engine.add_call(fetch_cached_object, job_config, "raw-bucket", "course/001/grades.csv", str(tmpdir.join("grades.csv")))
+    engine.add_call(lambda: None) # reports nothing
+    stats = engine.run()
+    compressed_size = len(fake_s3.buckets["raw-bucket"]["course/001/forum.sql.gz"])
+    assert stats["objects"] == 3
+    assert stats["bytes"] == compressed_size + 30 + 50
+    assert stats["failed"] == 0
@@ -0,0 +1,23 @@
+import os
+from morf.utils.s3interface import sync_s3_prefix
+
+
+def test_sync_s3_prefix_transfers_only_changes(job_config, fake_s3):
+    fake_s3.put("proc-bucket", "user/job/extract/a.csv", b"a")
+    fake_s3.put("proc-bucket", "user/job/extract/course/001/b.tgz", b"b")
+    fake_s3.put("proc-bucket", "user/job/train/c.tgz", b"c")
+    dest_dir = os.path.join(job_config.cache_dir, "extract")
+    objects = sync_s3_prefix(job_config, "proc-bucket", "user/job/extract/", dest_dir)
+    assert sorted(objects) == ["user/job/extract/a.csv", "user/job/extract/course/001/b.tgz"]
+    assert open(os.path.join(dest_dir, "course", "001", "b.tgz"), "rb").read() == b"b"
+    assert fake_s3.requests.count("GetObject") == 2
+    # second call in the same workflow stage reuses the first result without listing
+    fake_s3.requests.clear()
+    sync_s3_prefix(job_config, "proc-bucket", "user/job/extract/", dest_dir)
+    assert fake_s3.requests == []
+    # a new run lists again but only downloads the changed object
+    job_config.run_id = "run-2"
+    fake_s3.put("proc-bucket", "user/job/extract/a.csv", b"a2")
+    sync_s3_prefix(job_config, "proc-bucket", "user/job/extract/", dest_dir)
+    assert fake_s3.requests == ["ListObjectsV2", "GetObject"]
+    assert open(os.path.join(dest_dir, "a.csv"), "rb").read() == b"a2"
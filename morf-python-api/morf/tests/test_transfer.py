@@ -0,0 +1,50 @@
+import os
+import time
+from morf.utils.transfer import TransferScheduler, CRITICAL, BULK, MB, get_transfer_scheduler
+
+
+def timed_acquire(scheduler, n_bytes, lane):
+    start = time.time()
+    scheduler.acquire(n_bytes, lane)
+    return time.time() - start
+
+
+def test_bandwidth_shared_between_schedulers(tmpdir):
+    state_fp = os.path.join(str(tmpdir), "transfer", "job.state")
+    first = TransferScheduler(state_fp, rate=10 * MB)
+    second = TransferScheduler(state_fp, rate=10 * MB) # i.e., in another pool worker
+    assert timed_acquire(first, 10 * MB, BULK) < 0.1 # bucket starts full
+    assert timed_acquire(second, 3 * MB, BULK) >= 0.25
+
+
+def test_critical_lane_goes_ahead_of_bulk(tmpdir):
+    state_fp = os.path.join(str(tmpdir), "transfer", "job.state")
+    bulk = TransferScheduler(state_fp, rate=10 * MB)
+    critical = TransferScheduler(state_fp, rate=10 * MB)
+    assert timed_acquire(critical, 6 * MB, CRITICAL) < 0.1
+    # 4 MB remain, which is below the reserve bulk transfers must leave while critical transfers are active
+    assert timed_acquire(critical, 1 * MB, CRITICAL) < 0.1
+    assert timed_acquire(bulk, 1 * MB, BULK) >= 0.2
+
+
+def test_unlimited_scheduler_does_not_wrap():
+    scheduler = TransferScheduler()
+    fileobj = object()
+    assert scheduler.wrap(fileobj) is fileobj
+    assert timed_acquire(scheduler, 100 * MB, BULK) < 0.01
+
+
+def test_scheduler_reopens_state_file_after_fork(tmpdir):
+    scheduler = TransferScheduler(str(tmpdir.join("transfer.state")), rate=10 * MB)
+    scheduler.acquire(MB)
+    # as in a child process forked on python < 3.7, without os.register_at_fork
+    scheduler.pid = -1
+    scheduler.acquire(MB)
+    assert scheduler.pid == os.getpid()
+
+
+def test_jobs_on_host_share_one_bucket(job_config):
+    job_config.transfer_max_mb_per_s = 10
+    state_fp = get_transfer_scheduler(job_config).state_fp
+    job_config.morf_id = "other-job"
+    assert get_transfer_scheduler(job_config).state_fp == state_fp
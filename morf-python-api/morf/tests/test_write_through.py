@@ -0,0 +1,46 @@
+import os
+import tarfile
+import morf.utils
+from morf.utils import download_from_s3, fetch_result_file, move_results_to_destination
+from morf.utils.content_cache import get_content_cache
+from morf.utils.s3interface import delete_s3_prefix
+
+
+def make_archive(tmpdir, name="user-job-extract-course-001.tgz"):
+    csv_fp = tmpdir.join("features.csv")
+    csv_fp.write("userID,feature\n1,2\n")
+    with tarfile.open(str(tmpdir.join(name)), "w:gz") as tar:
+        tar.add(str(csv_fp), arcname="features.csv")
+    return name # results are archived in, and uploaded from, the working directory
+
+
+def test_uploaded_results_are_read_locally(job_config, fake_s3, tmpdir, monkeypatch):
+    job_config.write_through = True
+    monkeypatch.setattr(morf.utils, "get_s3_client", lambda *args, **kwargs: fake_s3)
+    monkeypatch.chdir(tmpdir)
+    archive_file = make_archive(tmpdir)
+    move_results_to_destination(archive_file, job_config, course="course", session="001")
+    assert not os.path.exists(archive_file)
+    fake_s3.requests.clear()
+    result_dir = tmpdir.mkdir("results")
+    fetch_result_file(job_config, str(result_dir), course="course", session="001")
+    assert result_dir.join("features.csv").read() == "userID,feature\n1,2\n"
+    key = "user/job/extract/course/001/user-job-extract-course-001.tgz"
+    download_from_s3("proc-bucket", key, fake_s3, str(tmpdir.mkdir("copy")), job_config=job_config)
+    assert fake_s3.requests == []
+
+
+def test_deleted_uploads_are_not_served(job_config, fake_s3, tmpdir, monkeypatch):
+    job_config.write_through = True
+    monkeypatch.setattr(morf.utils, "get_s3_client", lambda *args, **kwargs: fake_s3)
+    monkeypatch.chdir(tmpdir)
+    move_results_to_destination(make_archive(tmpdir), job_config, course="course", session="001")
+    delete_s3_prefix(job_config, "proc-bucket", "user/job/extract/")
+    assert get_content_cache(job_config).lookup_upload("proc-bucket", "user/job/extract/course/001/user-job-extract-course-001.tgz") is None
+
+
+def test_uploads_not_retained_by_default(job_config, fake_s3, tmpdir, monkeypatch):
+    monkeypatch.setattr(morf.utils, "get_s3_client", lambda *args, **kwargs: fake_s3)
+    monkeypatch.chdir(tmpdir)
+    move_results_to_destination(make_archive(tmpdir), job_config, course="course", session="001")
+    assert get_content_cache(job_config).size() == 0
@@ -35,10 +35,20 @@ from urllib.parse import urlparse
 import boto3
 import pandas as pd
 from botocore.exceptions import ClientError
-from morf.utils.caching import fetch_from_cache, make_course_session_cache_dir_fp
+from morf.utils.catalog import get_bucket_catalog, normalize_data_dir
+from morf.utils.caching import fetch_from_cache
+from morf.utils.features import fetch_feature_partition
+from morf.utils.frames import intermediate_extension, make_intermediate_filename, read_intermediate, write_intermediate
+from morf.utils.job_state import get_job_state, make_job_state_fp, record_task_output, record_task_failure
+from morf.utils.labels import get_label_index, get_shared_label_table
+from morf.utils.content_cache import get_content_cache, fetch_cached_object, fetch_retained_object, retain_uploaded_file
 from morf.utils.log import set_logger_handlers, execute_and_log_output
 # create logger
-from morf.utils.s3interface import make_s3_key_path
+from morf.utils.s3interface import make_s3_key_path, get_s3_client, get_s3_resource, delete_s3_prefix, \
+    wait_for_pending_clears
+from morf.utils.staging import StagingEngine, ranged_download_s3, ranged_download_https, MB, \
+    DEFAULT_RANGED_DOWNLOAD_THRESHOLD_MB
+from morf.utils.transfer import get_transfer_scheduler, CRITICAL, BULK, DEFAULT_CRITICAL_MAX_MB
 
 module_logger = logging.getLogger(__name__)
 
@@ -78,6 +88,15 @@ def unarchive_file(src, dest, remove=True):
     return outpath
 
 
+def make_clean_filename(filename):
+    """
+    Remove parentheses, whitespace, and ampersands from a base filename.
+    :param filename: base name of file (string).
+    :return: cleaned base name (string).
+    """
+    return re.sub(r"[\(\)\s&]", "", filename)
+
+
 def clean_filename(src):
     """
     Rename file, removing any non-alphanumeric characters.
@@ -85,7 +104,7 @@ def clean_filename(src):
     :return: None
     """
     src_dir, src_file = os.path.split(src)
-    clean_src_file = re.sub(r"[\(\)\s&]", "", src_file)
+    clean_src_file = make_clean_filename(src_file)
     clean_src_path = os.path.join(src_dir, clean_src_file)
     try:
         os.rename(src, clean_src_path)
@@ -112,7 +131,7 @@ def get_key_from_url(url):
     return re.search(r"^s3://[^/]+/(.+)", url).group(1)
 
 
-def download_from_s3(bucket, key, s3, dir = os.getcwd(), dest_filename = None, job_config = None):
+def download_from_s3(bucket, key, s3, dir = os.getcwd(), dest_filename = None, job_config = None, lane = None, size = None, etag = None):
     """
     Downloads a file from s3 into dir and returns its path as a string for optional use.
     :param bucket: an s3 bucket name (string).
@@ -120,6 +139,11 @@ def download_from_s3(bucket, key, s3, dir = os.getcwd(), dest_filename = None, j
     :param s3: boto3.client object for s3 connection.
     :param dir: directory where file should be downloaded (string); will be created if does not exist
     :param dest_filename: base name for file.
+    :param job_config: MorfJobConfig object; used for logging and transfer settings.
+    :param lane: transfer priority lane; by default, small files are critical and large files are bulk.
+    :param size: size of the object in bytes, if known (i.e., from a bucket catalog). Objects of known size above
+    job_config.ranged_download_threshold_mb are fetched as concurrent byte ranges; all others with a single GET.
+    :param etag: ETag of the object, if known; lets an interrupted ranged download resume.
     :return: Path to downloaded file inside dir (string).
     """
     if job_config:
@@ -130,25 +154,40 @@ def download_from_s3(bucket, key, s3, dir = os.getcwd(), dest_filename = None, j
         dest_filename = os.path.basename(key)
     if not os.path.exists(dir):
         os.makedirs(dir)
-    with open(os.path.join(dir, dest_filename), "wb") as resource:
-        try:
-            s3.download_fileobj(bucket, key, resource)
-        except ClientError as ce:
-            logger.error("boto ClientError downloading from location s3://{}/{}: {}".format(bucket, key, ce))
-            raise
-        except Exception as e:
-            logger.error("error downloading from location s3://{}/{}: {}".format(bucket, key, e))
-            raise
     dest_path = os.path.join(dir, dest_filename)
+    if job_config and fetch_retained_object(job_config, bucket, key, dest_path): # uploaded from this host
+        logger.info("copied s3://{}/{} from local cache".format(bucket, key))
+        return dest_path
+    threshold = getattr(job_config, "ranged_download_threshold_mb", DEFAULT_RANGED_DOWNLOAD_THRESHOLD_MB) * MB
+    scheduler = get_transfer_scheduler(job_config)
+    critical_max = getattr(job_config, "transfer_critical_max_mb", DEFAULT_CRITICAL_MAX_MB) * MB
+    try:
+        if size is not None and size >= threshold: # large object; fetch byte ranges concurrently
+            logger.info("downloading s3://{}/{} ({} bytes) as concurrent byte ranges".format(bucket, key, size))
+            ranged_download_s3(s3, bucket, key, dest_path, size, etag.strip('"') if etag else None, job_config, lane or BULK)
+        else: # a single GET, which also reports the size, instead of asking for it first
+            response = s3.get_object(Bucket=bucket, Key=key)
+            if not lane:
+                lane = CRITICAL if response["ContentLength"] < critical_max else BULK
+            with open(dest_path, "wb") as resource:
+                shutil.copyfileobj(scheduler.wrap(response["Body"], lane), resource, MB)
+    except ClientError as ce:
+        logger.error("boto ClientError downloading from location s3://{}/{}: {}".format(bucket, key, ce))
+        raise
+    except Exception as e:
+        logger.error("error downloading from location s3://{}/{}: {}".format(bucket, key, e))
+        raise
     return dest_path
 
 
-def initialize_tar(fp, s3, dest_dir = None):
+def initialize_tar(fp, s3, dest_dir = None, job_config = None, lane = None):
     """
     Prepare tar file at fp, either downloading from s3 or just fetching tar name if file is local.
     :param fp: path to .tar file.
     :param s3: boto3.client object with appropriate access credentials.
     :param dest_dir: if tar file is located in s3, location to download file to.
+    :param job_config: MorfJobConfig object; used for logging and transfer settings.
+    :param lane: transfer priority lane for download from s3.
     :return:
     """
     file_url = urlparse(fp)
@@ -157,7 +196,7 @@ def initialize_tar(fp, s3, dest_dir = None):
     if file_url.scheme == "s3":
         bucket = get_bucket_from_url(fp)
         bucketkey = get_key_from_url(fp)
-        tar_path = download_from_s3(bucket, bucketkey, s3, dest_dir)
+        tar_path = download_from_s3(bucket, bucketkey, s3, dest_dir, job_config = job_config, lane = lane)
     return tar_path
 
 
@@ -183,11 +222,7 @@ def fetch_courses(job_config, data_bucket, data_dir ="morf-data/"):
     :param data_dir: path to directory in data_bucket that contains course-level directories of raw data.
     :return: courses; list of course names as strings.
     """
-    s3 = job_config.initialize_s3()
-    if not data_dir.endswith("/"):
-        data_dir = "{0}/".format(data_dir)
-    bucket_objects = s3.list_objects(Bucket=data_bucket, Prefix=data_dir, Delimiter="/")
-    courses = [item.get("Prefix").split("/")[1] for item in bucket_objects.get("CommonPrefixes")]
+    courses = get_bucket_catalog(job_config, data_bucket, data_dir).courses()
     return courses
 
 
@@ -203,12 +238,7 @@ def fetch_sessions(job_config, data_bucket, data_dir, course, fetch_holdout_sess
     :return: list of session numbers as strings.
     """
     assert (not (fetch_holdout_session_only & fetch_all_sessions)), "choose one - fetch holdout sessions or fetch all sessions"
-    s3 = job_config.initialize_s3()
-    if not data_dir.endswith("/"):
-        data_dir = data_dir + "/"
-    course_bucket_objects = s3.list_objects(Bucket=data_bucket, Prefix="".join([data_dir, course, "/"]), Delimiter="/")
-    sessions = [item.get("Prefix").split("/")[2] for item in course_bucket_objects.get("CommonPrefixes")]
-    sessions = sorted(sessions, key = lambda x: x[-3:]) # handles session numbers like "2012-001" by keeping leading digits before "-" but only sorts on last 3 digits
+    sessions = get_bucket_catalog(job_config, data_bucket, data_dir).sessions(course)
     if fetch_all_sessions: # return complete list of sessions
         result = sessions
     else:
@@ -230,10 +260,10 @@ def fetch_complete_courses(job_config, data_bucket, data_dir ="morf-data/", n_tr
     :return: list of course names.
     """
     complete_courses = []
-    for course in fetch_courses(job_config, data_bucket, data_dir):
-        training_sessions = fetch_sessions(job_config, data_bucket, data_dir, course, fetch_holdout_session_only=False)
-        testing_session = fetch_sessions(job_config, data_bucket, data_dir, course, fetch_holdout_session_only=True)
-        if (len(testing_session) == 1) and (len(training_sessions) >= n_train):
+    catalog = get_bucket_catalog(job_config, data_bucket, data_dir)
+    for course in catalog.courses():
+        # one holdout session plus at least n_train training sessions
+        if len(catalog.sessions(course)) >= n_train + 1:
             complete_courses.append(course)
     return complete_courses
 
@@ -248,18 +278,15 @@ def fetch_all_complete_courses_and_sessions(job_config, data_dir ="morf-data/",
     """
     complete_courses = []
     for data_bucket in job_config.raw_data_buckets:
-        for course in fetch_courses(job_config, data_bucket, data_dir):
-            training_sessions = fetch_sessions(job_config, data_bucket, data_dir, course,fetch_holdout_session_only=False)
-            testing_session = fetch_sessions(job_config, data_bucket, data_dir, course, fetch_holdout_session_only=True)
-            if (len(testing_session) == 1) and (len(training_sessions) >= n_train):
-                sessions = training_sessions + testing_session
-                complete_courses.append((course, sessions))
+        for course in fetch_complete_courses(job_config, data_bucket, data_dir, n_train):
+            sessions = fetch_sessions(job_config, data_bucket, data_dir, course, fetch_all_sessions=True)
+            complete_courses.append((course, sessions))
     return complete_courses
 
 
-def download_raw_course_data(job_config, bucket, course, session, input_dir, data_dir, course_date_file_name = "coursera_course_dates.csv"):
+def download_raw_course_data(job_config, bucket, course, session, input_dir, data_dir, course_date_file_name = "coursera_course_dates.csv", engine = None):
     """
-    Download all raw course files for course and session into input_dir.
+    Download all raw course files for course and session into input_dir, via the content cache if job_config has a cache_dir.
     :param job_config: MorfJobConfig object.
     :param bucket: bucket containing raw data.
     :param course: id of course to download data for.
@@ -267,28 +294,51 @@ def download_raw_course_data(job_config, bucket, course, session, input_dir, dat
     :param input_dir: input directory.
     :param data_dir: directory in bucket that contains course-level data.
     :param course_date_file_name: name of csv file in bucket which contains course start/end dates.
+    :param engine: StagingEngine to queue downloads on; if not provided, files are downloaded before returning.
     :return: None
     """
-    s3 = job_config.initialize_s3()
-    logger = set_logger_handlers(module_logger, job_config)
-    course_date_file_url =  "s3://{}/{}/{}".format(bucket, data_dir, course_date_file_name)
+    run_engine = engine is None
+    if run_engine:
+        engine = StagingEngine(job_config, task_name="course {} session {}".format(course, session))
+    use_cache = get_content_cache(job_config) is not None
     session_input_dir = os.path.join(input_dir, course, session)
     os.makedirs(session_input_dir)
-    for obj in boto3.resource("s3", aws_access_key_id=job_config.aws_access_key_id, aws_secret_access_key=job_config.aws_secret_access_key)\
-            .Bucket(bucket).objects.filter(Prefix="{}/{}/{}/".format(data_dir, course, session)):
-        filename = obj.key.split("/")[-1]
+    catalog = get_bucket_catalog(job_config, bucket, data_dir)
+    dates_key = normalize_data_dir(data_dir) + course_date_file_name
+    session_objects = [(key, etag, False) for key, size, etag in catalog.session_objects(course, session)]
+    session_objects.append((dates_key, catalog.objects.get(dates_key, (None, None))[1], True))
+    for key, etag, required in session_objects:
+        filename = key.split("/")[-1]
         filename = re.sub(r'[\s\(\)":!&]', "", filename)
+        decompress = filename.endswith(".sql.gz") # decompress sql dumps while staging
+        if decompress:
+            filename = make_clean_filename(filename[:-3])
         filepath = os.path.join(session_input_dir, filename)
-        try:
-            with open(filepath, "wb") as resource:
-                s3.download_fileobj(bucket, obj.key, resource)
-        except:
-            logger.warning("skipping empty object in bucket {} key {}".format(bucket, obj.key))
-            continue
-    dates_bucket = get_bucket_from_url(course_date_file_url)
-    dates_key = get_key_from_url(course_date_file_url)
-    dates_file = dates_key.split("/")[-1]
-    s3.download_file(dates_bucket, dates_key, os.path.join(session_input_dir, dates_file))
+        if use_cache:
+            engine.add_call(fetch_cached_object, job_config, bucket, key, filepath, etag, decompress, allow_bind=True, required=required)
+        else:
+            engine.add_download(bucket, key, filepath, required=required, decompress=decompress)
+    if run_engine:
+        engine.run()
+    return
+
+
+def stage_raw_course_data(job_config, engine, bucket, course, session, input_dir, data_dir ="morf-data/"):
+    """
+    Queue the copies or downloads needed to place raw course data for course and session in input_dir onto engine.
+    :param job_config: MorfJobConfig object
+    :param engine: StagingEngine object.
+    :param bucket: bucket containing raw data.
+    :param course: id of course to download data for.
+    :param session: id of session to download data for.
+    :param input_dir: input directory.
+    :param data_dir: directory in bucket that contains course-level data.
+    :return: None
+    """
+    logger = set_logger_handlers(module_logger, job_config)
+    logger.info("staging data for course {} session {} from s3://{}/{}".format(course, session, bucket, data_dir))
+    download_raw_course_data(job_config, bucket=bucket, course=course, session=session, input_dir=input_dir,
+                             data_dir=data_dir, engine=engine)
     return
 
 
@@ -303,28 +353,9 @@ def fetch_raw_course_data(job_config, bucket, course, session, input_dir, data_d
     :param data_dir: directory in bucket that contains course-level data.
     :return: None
     """
-    logger = set_logger_handlers(module_logger, job_config)
-    course_date_file = "coursera_course_dates.csv"
-    session_input_dir = os.path.join(input_dir, course, session)
-    if hasattr(job_config, "cache_dir"):
-        course_session_cache_dir = make_course_session_cache_dir_fp(job_config, bucket, data_dir, course, session)
-        try:
-            logger.info("copying data from cached location {} to {}".format(course_session_cache_dir, session_input_dir))
-            shutil.copytree(course_session_cache_dir, session_input_dir)
-            course_date_file = os.path.join(job_config.cache_dir, bucket, data_dir, course_date_file)
-            shutil.copy(course_date_file, session_input_dir)
-        except Exception as e:
-            logger.error("exception while attempting to copy from cache: {}".format(e))
-    else:
-        download_raw_course_data(job_config, bucket=raw_data_bucket,
-                                 course=course, session=session, input_dir=input_dir,
-                                 data_dir=data_dir)
-    # unzip all of the sql files and remove any parens from filename
-    for item in os.listdir(session_input_dir):
-        if item.endswith(".sql.gz"):
-            item_path = os.path.join(session_input_dir, item)
-            unarchive_res = unarchive_file(item_path, session_input_dir)
-            clean_filename(unarchive_res)
+    engine = StagingEngine(job_config, task_name="course {} session {}".format(course, session))
+    stage_raw_course_data(job_config, engine, bucket, course, session, input_dir, data_dir)
+    engine.run()
     return
 
 
@@ -338,7 +369,7 @@ def initialize_session_labels(job_config, bucket, course, session, label_type, d
     :param label_type: valid label type to place in 'label' column
     :param dest_dir: directory to load data into. This should be same directory mounted to Docker image in docker run command.
     :param data_dir: directory in bucket containing course-level data directories.
-    :param use_cache: if true, will attempt to use cached labels file.
+    :param use_cache: if true, will read the labels file from the content cache when indexing it.
     :return: Path to labels (string).
     """
     logger = set_logger_handlers(module_logger, job_config)
@@ -354,24 +385,15 @@ def initialize_session_labels(job_config, bucket, course, session, label_type, d
     # create filename
     label_csv = "labels-{}.csv".format(mode) # file with labels for ALL courses
     key = data_dir + label_csv
-    # fetch from cache, or download if not using cache
-    if hasattr(job_config, "cache_dir") and use_cache:
-        logger.info("fetching labels file from cache for course {} session {} mode {}".format(course, session, mode))
-        # fetch file from cache
-        cache_file_path = "/".join([bucket, key])
-        label_csv_fp = fetch_from_cache(job_config, cache_file_path, dest_dir)
-    else:
-        logger.info("fetching labels file from s3 for course {} session {} mode {}".format(course, session, mode))
-        s3 = job_config.initialize_s3()
-        label_csv_fp = download_from_s3(bucket, key, s3, dest_dir, label_csv, job_config)
-    # read dataframe and filter for correct course/session/labels
-    df = pd.read_csv(label_csv_fp, dtype=object)
-    course_label_df = df.loc[(df["course"] == course) & (df["session"] == session) & (df["label_type"] == label_type)]\
-        .copy()
-    course_label_df.drop(["course", "session", "label_type"], axis = 1, inplace=True)
+    # read only this course/session/label type, from a table shared by the parent process (see label_sharing_pool)
+    # or from the partitioned index of the labels file, built once per version
+    labels = get_shared_label_table(bucket, key)
+    if labels is None:
+        logger.info("fetching labels from index of s3://{}/{} for course {} session {} mode {}".format(bucket, key, course, session, mode))
+        labels = get_label_index(job_config, bucket, key, use_cache=use_cache)
+    course_label_df = labels.lookup(course, session, label_type)
     course_label_csv_fp = os.path.join(dest_dir, make_label_csv_name(course, session))
     course_label_df.to_csv(course_label_csv_fp, index=False)
-    os.remove(label_csv_fp)
     return course_label_csv_fp
 
 
@@ -394,7 +416,7 @@ def initialize_labels(job_config, bucket, course, session, label_type, dest_dir,
         for session in fetch_sessions(job_config, bucket, data_dir, course, fetch_all_sessions=True):
             initialize_session_labels(job_config, bucket, course, session, label_type, os.path.join(dest_dir, session), data_dir)
         label_csv_fp = aggregate_session_input_data("labels", dest_dir)
-    elif level == "all": # initialize labels for all courses in bucket into a single file
+    elif level == "all": # initialize labels for all courses in bucket into a single file, in the job's intermediate format
         course_label_df_list = []
         for course in fetch_courses(job_config, bucket, data_dir):
             for session in fetch_sessions(job_config, bucket, data_dir, course, fetch_all_sessions=True):
@@ -405,8 +427,8 @@ def initialize_labels(job_config, bucket, course, session, label_type, dest_dir,
             course_label_df["course"] = course
             course_label_df_list.append(course_label_df)
             os.remove(course_label_csv_fp)
-        label_csv_fp = os.path.join(dest_dir, "labels.csv")
-        pd.concat(course_label_df_list).to_csv(label_csv_fp, index = False)
+        label_csv_fp = os.path.join(dest_dir, "labels.{}".format(intermediate_extension(job_config)))
+        write_intermediate(pd.concat(course_label_df_list), label_csv_fp)
     return label_csv_fp
 
 
@@ -417,7 +439,7 @@ def filter_train_test_data(job_config, course, session, input_dir, feature_csv,
     :param course: course slug.
     :param session: session number.
     :param input_dir: input directorty which should contain feature_csv at input_dir/course/session location.
-    :param feature_csv: base name of feature csv file.
+    :param feature_csv: base name of feature file; csv or the job's intermediate format.
     :param remove: indicator for whether feature_csv should be removed after its results are filtered.
     :return: None
     """
@@ -426,7 +448,7 @@ def filter_train_test_data(job_config, course, session, input_dir, feature_csv,
     local_feature_csv = os.path.join(session_input_dir, feature_csv)
     try:
         logger.info("reading feature file from {} and filtering for features from course {} session {}".format(local_feature_csv, course, session))
-        temp_df = pd.read_csv(local_feature_csv, dtype=object)
+        temp_df = read_intermediate(local_feature_csv, dtype=object)
         outfile = os.path.join(session_input_dir, make_feature_csv_name(course, session))
         temp_df[(temp_df["course"] == course) & (temp_df["session"] == session)].drop(["course", "session"], axis=1) \
             .to_csv(outfile, index=False)
@@ -459,12 +481,14 @@ def download_train_test_data(job_config, raw_data_bucket, raw_data_dir, course,
     logger.info(" fetching {} data for course {} session {}".format(fetch_mode, course, session))
     session_input_dir = os.path.join(input_dir, course, session)
     os.makedirs(session_input_dir)
-    # download features file
-    feature_csv = generate_archive_filename(job_config, mode=fetch_mode, extension="csv")
-    key = "{}/{}/{}/{}".format(job_config.user_id, job_config.job_id, fetch_mode, feature_csv)
-    download_from_s3(proc_data_bucket, key, s3, session_input_dir, job_config=job_config)
-    # read features file and filter to only include specific course/session
-    filter_train_test_data(job_config, course, session, input_dir, feature_csv)
+    # fetch only this session's partition of the collected features, if they were partitioned
+    if not fetch_feature_partition(job_config, course, session, fetch_mode, os.path.join(session_input_dir, make_feature_csv_name(course, session))):
+        # download features file
+        feature_csv = generate_archive_filename(job_config, mode=fetch_mode, extension=intermediate_extension(job_config))
+        key = "{}/{}/{}/{}".format(job_config.user_id, job_config.job_id, fetch_mode, feature_csv)
+        download_from_s3(proc_data_bucket, key, s3, session_input_dir, job_config=job_config)
+        # read features file and filter to only include specific course/session
+        filter_train_test_data(job_config, course, session, input_dir, feature_csv)
     if job_config.mode in ("train", "cv"):  # download labels only if training or cv job; otherwise no labels needed
         initialize_labels(job_config, raw_data_bucket, course, session, label_type, dest_dir=session_input_dir,
                           data_dir=raw_data_dir)
@@ -487,17 +511,17 @@ def fetch_train_test_data(job_config, raw_data_bucket, raw_data_dir, course, ses
     else:
         logger.error("attempting to fetch train/test data while in mode {}".format(job_config.mode))
     # fetch train/test from cache, if exists; otherwise fetch from s3
-    if hasattr(job_config, "cache_dir"):
-        cache_dir = getattr(job_config, "cache_dir")
-        feature_file_src_fname = generate_archive_filename(job_config, extension='csv', mode=fetch_mode)
-        feature_file_dest_fname = make_feature_csv_name(job_config.user_id, job_config.job_id, job_config.mode)
-        feature_file_cache_fp = os.path.join(cache_dir, proc_data_bucket, job_config.user_id, job_config.job_id, fetch_mode, feature_file_src_fname)
+    if get_content_cache(job_config):
+        feature_file_src_fname = generate_archive_filename(job_config, extension=intermediate_extension(job_config), mode=fetch_mode)
+        feature_file_dest_fname = make_intermediate_filename(job_config, make_feature_csv_name(job_config.user_id, job_config.job_id, job_config.mode))
+        feature_file_key = make_s3_key_path(job_config, filename=feature_file_src_fname, mode=fetch_mode)
         feature_file_dest_fp = os.path.join(session_input_dir, feature_file_dest_fname)
         try:
-            logger.info("copying feature data from cached location {} to {}".format(feature_file_cache_fp, feature_file_dest_fp))
-            os.makedirs(session_input_dir, exist_ok=True)
-            shutil.copy(feature_file_cache_fp, feature_file_dest_fp)
-            filter_train_test_data(job_config, course, session, input_dir, feature_file_dest_fname)
+            # fetch only this session's partition of the collected features, if they were partitioned
+            if not fetch_feature_partition(job_config, course, session, fetch_mode, os.path.join(session_input_dir, make_feature_csv_name(course, session))):
+                logger.info("copying feature data from cached s3://{}/{} to {}".format(proc_data_bucket, feature_file_key, feature_file_dest_fp))
+                fetch_cached_object(job_config, proc_data_bucket, feature_file_key, feature_file_dest_fp)
+                filter_train_test_data(job_config, course, session, input_dir, feature_file_dest_fname)
         except Exception as e:
             logger.error("exception while attempting to copy train/test data from cache: {}".format(e))
         # labels
@@ -512,6 +536,7 @@ def initialize_raw_course_data(job_config, raw_data_bucket, level, mode,
                                data_dir ="morf-data", course = None, session = None, input_dir ="./input"):
     """
     Initialize input directory of raw course data for extract or extract-holdout jobs.
+    All sessions for the job are staged concurrently by a single StagingEngine.
     :param s3: boto3.client object for s3 connection.
     :param aws_access_key_id: aws_access_key_id.
     :param aws_secret_access_key: aws_secret_access_key.
@@ -525,35 +550,45 @@ def initialize_raw_course_data(job_config, raw_data_bucket, level, mode,
     :param course_date_file_name: name of csv file located at bucket/data_dir containing course start and end dates.
     :return: None
     """
+    set_logger_handlers(module_logger, job_config)
+    engine = StagingEngine(job_config, task_name="{} level {} course {} session {}".format(mode, level, course, session))
+    for bucket, course, session in fetch_raw_course_sessions(job_config, raw_data_bucket, level, mode, data_dir, course, session):
+        stage_raw_course_data(job_config, engine, bucket, course, session, input_dir, data_dir)
+    engine.run()
+    return
+
+
+def fetch_raw_course_sessions(job_config, raw_data_bucket, level, mode, data_dir ="morf-data", course = None, session = None):
+    """
+    Find the course sessions whose raw data is staged for an extract or extract-holdout job; see initialize_raw_course_data.
+    :return: list of (bucket, course, session) tuples.
+    """
     if level == "all": # there is a unique course date file for each bucket
         # download all data; every session of every course
-        for bucket in raw_data_bucket:
-            for course in fetch_courses(job_config, bucket):
-                if mode == "extract":
-                    sessions = fetch_sessions(job_config, bucket, data_dir, course)
-                    for session in sessions:
-                        fetch_raw_course_data(job_config, bucket=bucket, course=course, session=session, input_dir=input_dir)
-                if mode == "extract-holdout":
-                    holdout_session = fetch_sessions(job_config, bucket, data_dir, course, fetch_holdout_session_only=True)[0]
-                    fetch_raw_course_data(job_config, bucket=bucket, course=course, session=holdout_session, input_dir=input_dir)
+        bucket_courses = [(bucket, course) for bucket in raw_data_bucket for course in fetch_courses(job_config, bucket)]
     elif level == "course":
         # download all data for every session of course
-        if mode == "extract":
-            sessions = fetch_sessions(job_config, raw_data_bucket, data_dir, course)
-            for session in sessions:
-                fetch_raw_course_data(job_config, bucket=raw_data_bucket, course=course, session=session, input_dir=input_dir)
-        if mode == "extract-holdout":
-            holdout_session = fetch_sessions(job_config, raw_data_bucket, data_dir, course, fetch_holdout_session_only=True)[0]
-            fetch_raw_course_data(job_config, bucket=raw_data_bucket, course=course, session=holdout_session, input_dir=input_dir)
+        bucket_courses = [(raw_data_bucket, course)]
+    if level in ("all", "course"):
+        bucket_course_sessions = []
+        for bucket, course in bucket_courses:
+            if mode == "extract":
+                sessions = fetch_sessions(job_config, bucket, data_dir, course)
+            if mode == "extract-holdout":
+                sessions = fetch_sessions(job_config, bucket, data_dir, course, fetch_holdout_session_only=True)
+            bucket_course_sessions.extend([(bucket, course, session) for session in sessions])
     elif level == "session":
         # download only specific session
-        fetch_raw_course_data(job_config, bucket=raw_data_bucket, course=course, session=session, input_dir=input_dir)
-    return
+        bucket_course_sessions = [(raw_data_bucket, course, session)]
+    else:
+        raise ValueError("unknown level {}; should be one of all, course, session".format(level))
+    return bucket_course_sessions
 
 
 def initialize_train_test_data(job_config, raw_data_bucket, level, label_type, course = None, session = None, input_dir ='./input', raw_data_dir = 'morf-data/'):
     """
     Mounts data in /input/course/session directories for MORF API train/test jobs.
+    Sessions are fetched concurrently by a StagingEngine.
     :param job_config: MorfJobConfig object.
     :param raw_data_bucket: S3 bucket containing raw data (used to find all sessions of course).
     :param level: level of job; should be in [all, course, session].
@@ -564,6 +599,8 @@ def initialize_train_test_data(job_config, raw_data_bucket, level, label_type, c
     :return: None
     """
     mode = job_config.mode
+    set_logger_handlers(module_logger, job_config)
+    engine = StagingEngine(job_config, task_name="{} level {} course {} session {}".format(mode, level, course, session))
     if level == "all": # download data for every course and session
         # download all data; every session of every course
         for bucket in raw_data_bucket:
@@ -573,72 +610,88 @@ def initialize_train_test_data(job_config, raw_data_bucket, level, label_type, c
                 elif mode == "test":
                     sessions = fetch_sessions(job_config, bucket, raw_data_dir, course, fetch_holdout_session_only=True)
                 for session in sessions:
-                    fetch_train_test_data(job_config, bucket, raw_data_dir, course, session, input_dir, label_type)
+                    engine.add_call(fetch_train_test_data, job_config, bucket, raw_data_dir, course, session, input_dir, label_type)
     if level == "course": # download data for every session of course
         if mode == "train":
             sessions = fetch_sessions(job_config, raw_data_bucket, raw_data_dir, course)
         elif mode == "test":
             sessions = fetch_sessions(job_config, raw_data_bucket, raw_data_dir, course, fetch_holdout_session_only=True)
         for session in sessions:
-            fetch_train_test_data(job_config, raw_data_bucket, raw_data_dir, course, session, input_dir, label_type)
+            engine.add_call(fetch_train_test_data, job_config, raw_data_bucket, raw_data_dir, course, session, input_dir, label_type)
     if level == "session": # download data for this session only
-        fetch_train_test_data(job_config, raw_data_bucket, raw_data_dir, course, session, input_dir, label_type)
+        engine.add_call(fetch_train_test_data, job_config, raw_data_bucket, raw_data_dir, course, session, input_dir, label_type)
+    engine.run()
     return
 
 
-def upload_file_to_s3(file, bucket, key, job_config=None, remove_on_success = False):
+def upload_file_to_s3(file, bucket, key, job_config=None, remove_on_success = False, raise_errors = False):
     """
     Upload file to bucket + key in S3.
     :param file: name or path to file.
     :param bucket: bucket to upload to.
     :param key: key to upload to in bucket.
     :param job_config: MorfJobConfig object; used for logging.
+    :param raise_errors: if True, a failed upload raises instead of being logged and failing the running task.
     :return: None
     """
     logger = set_logger_handlers(module_logger, job_config)
-    session = boto3.Session()
-    s3_client = session.client("s3")
+    if job_config:
+        wait_for_pending_clears(job_config)
+    s3_client = get_s3_client()
     tc = boto3.s3.transfer.TransferConfig()
     t = boto3.s3.transfer.S3Transfer(client=s3_client, config=tc)
     logger.info("uploading {} to s3://{}/{}".format(file, bucket, key))
     try:
-        t.upload_file(file, bucket, key)
-        if remove_on_success:
+        t.upload_file(file, bucket, key, callback=get_transfer_scheduler(job_config).callback(CRITICAL))
+        record_task_output(bucket, key)
+        if job_config:
+            retain_uploaded_file(job_config, file, bucket, key, move=remove_on_success)
+        if remove_on_success and os.path.exists(file):
             os.remove(file)
     except Exception as e:
-        logger.warn("error caching configurations: {}".format(e))
+        if raise_errors:
+            raise
+        logger.warn("error uploading {} to s3://{}/{}: {}".format(file, bucket, key, e))
+        record_task_failure("upload of s3://{}/{} failed: {}".format(bucket, key, e))
     return
 
 
-def delete_s3_keys(job_config, prefix = None):
+def delete_s3_keys(job_config, prefix = None, asynchronous = False):
     """
     Delete any files in s3 bucket matching prefix.
-    :param s3:
-    :param bucket:
-    :param prefix:
+    :param job_config: MorfJobConfig object.
+    :param prefix: bucket name followed by key prefix to delete, i.e. "bucket/user_id/job_id/mode/".
+    :param asynchronous: if True, delete in a background thread; see delete_s3_prefix.
     :return:
     """
-    logger = set_logger_handlers(module_logger, job_config)
-    # begin
-    cmd = "{} s3 rm --recursive s3://{}".format(job_config.aws_exec, prefix)
-    execute_and_log_output(cmd, logger)
+    bucket, key_prefix = prefix.split("/", 1)
+    delete_s3_prefix(job_config, bucket, key_prefix, asynchronous=asynchronous)
     return
 
 
-def clear_s3_subdirectory(job_config, course = None, session = None, mode = None):
+def clear_s3_subdirectory(job_config, course = None, session = None, mode = None, asynchronous = None):
     """
     Clear all files for user_id, job_id, and mode; used to wipe s3 subdirectory before uploading new files.
     :job_config: MorfJobConfig object.
     :param course:
     :param session:
+    :param asynchronous: if True, old files are deleted in the background while the job continues; uploads wait for
+    the deletion to finish. Defaults to job_config.async_clear.
     :return:
     """
     if not mode: # clear s3 subdirectory for specified mode, not for current mode of job
         mode = job_config.mode
+    if asynchronous is None:
+        asynchronous = getattr(job_config, "async_clear", False)
     logger = set_logger_handlers(module_logger, job_config)
+    if getattr(job_config, "resume", False): # keep results of completed tasks; see morf.utils.job_state
+        logger.info(" resuming job; keeping previous job data for mode {}".format(mode))
+        return
+    if course is None and session is None and os.path.exists(make_job_state_fp(job_config)): # only jobs that resumed or memoized have a job state
+        get_job_state(job_config).forget(mode)
     s3_prefix = "/".join([x for x in [job_config.proc_data_bucket, job_config.user_id, job_config.job_id, mode, course, session] if x is not None]) + "/"
     logger.info(" clearing previous job data at s3://{}".format(s3_prefix))
-    delete_s3_keys(job_config, prefix = s3_prefix)
+    delete_s3_keys(job_config, prefix = s3_prefix, asynchronous = asynchronous)
     return
 
 
@@ -652,7 +705,7 @@ def download_model_from_s3(job_config, bucket, key, dest_dir):
     mod_url = 's3://{}/{}'.format(bucket, key)
     logger.info(" downloading compressed model file from bucket {} key {}".format(bucket, key))
     try:
-        tar_path = initialize_tar(mod_url, s3=s3, dest_dir=dest_dir)
+        tar_path = initialize_tar(mod_url, s3=s3, dest_dir=dest_dir, job_config=job_config, lane=CRITICAL)
         unarchive_file(tar_path, dest_dir)
     except:
         logger.error("error downloading model file from s3; trained model(s) for this course may not exist. Skipping.")
@@ -682,8 +735,7 @@ def download_models(job_config, course, dest_dir, level, session = None):
         download_model_from_s3(job_config, bucket, key, dest_dir)
     elif level in ["course","session"]: # model files might be in either course- or session-level directories
         train_files = [obj.key
-                       for obj in boto3.resource("s3", aws_access_key_id=aws_access_key_id,
-                                                         aws_secret_access_key=aws_secret_access_key)
+                       for obj in get_s3_resource(aws_access_key_id, aws_secret_access_key)
                            .Bucket(bucket).objects.filter(Prefix="/".join([user_id, job_id, "train"]))
                        if ".tgz" in obj.key.split("/")[-1]  # fetch trained model files only
                        and "train" in obj.key.split("/")[-1]
@@ -720,7 +772,8 @@ def fetch_file(s3, dest_dir, remote_file_url, dest_filename = None, job_config=N
             key = url.path[1:]  # ignore initial /
             download_from_s3(bucket, key, s3, dest_dir, dest_filename = dest_filename, job_config=job_config)
         elif url.scheme == "https":
-            urllib.request.urlretrieve(remote_file_url, dest_fp)
+            if not ranged_download_https(remote_file_url, dest_fp, job_config):
+                urllib.request.urlretrieve(remote_file_url, dest_fp)
         else:
             logger.error(
             "A URL which was not s3:// or file:// or https:// was passed in for a file location, this is not supported. {}"
@@ -783,12 +836,18 @@ def move_results_to_destination(archive_file, job_config, course = None, session
     bucket = job_config.proc_data_bucket
     key = make_s3_key_path(job_config, filename=archive_file, course = course, session = session)
     logger.info(" uploading results to bucket {} key {}".format(bucket, key))
-    s3 = boto3.client('s3')
+    wait_for_pending_clears(job_config)
+    s3 = get_s3_client()
     try:
-        s3.upload_file(archive_file, bucket, key)
+        s3.upload_file(archive_file, bucket, key, Callback=get_transfer_scheduler(job_config).callback(CRITICAL))
+        record_task_output(bucket, key)
+        # with write_through, keep the archive for later stages of the job on this host
+        retain_uploaded_file(job_config, archive_file, bucket, key, move=True)
     except Exception as e:
         logger.error("error uploading result file: {}".format(e))
-    os.remove(archive_file)
+        record_task_failure("upload of result file s3://{}/{} failed: {}".format(bucket, key, e))
+    if os.path.exists(archive_file):
+        os.remove(archive_file)
     return
 
 
@@ -808,11 +867,12 @@ def fetch_result_file(job_config, dir, course = None, session = None):
                            filename=archive_file)
     dest = os.path.join(dir, archive_file)
     logger.info("fetching s3://{}/{}".format(bucket, key))
-    with open(dest, 'wb') as resource:
-        try:
-            s3.download_fileobj(bucket, key, resource)
-        except Exception as e:
-            logger.warning("exception while fetching results for mode {} course {} session {}:{}".format(job_config.mode, course, session, e))
+    if not fetch_retained_object(job_config, bucket, key, dest): # not uploaded from this host; download it
+        with open(dest, 'wb') as resource:
+            try:
+                s3.download_fileobj(bucket, key, resource)
+            except Exception as e:
+                logger.warning("exception while fetching results for mode {} course {} session {}:{}".format(job_config.mode, course, session, e))
     unarchive_file(dest, dir)
     return
 
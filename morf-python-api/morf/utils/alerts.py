@@ -139,8 +139,7 @@ def send_success_email(job_config, emailaddr_from ="morf-alerts@umich.edu"):
     status = job_config.status
     job_config.update_mode("test") # need to set mode so that correct key path is used to fetch results
     results_file_name = "morf-results.csv"
-    s3 = boto3.client("s3", aws_access_key_id=aws_access_key_id,
-                      aws_secret_access_key=aws_secret_access_key)
+    s3 = job_config.initialize_s3()
     # fetch model evaluation results
     attachment_basename = generate_archive_filename(job_config, mode="evaluate", extension="csv")
     key = make_s3_key_path(job_config, filename=attachment_basename)
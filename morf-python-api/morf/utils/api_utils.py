@@ -23,10 +23,13 @@
 Utility functions used throughout MORF API.
 """
 
+import json
 import tempfile
 
 import pandas as pd
 from morf.utils import *
+from morf.utils.features import make_feature_index_key
+from morf.utils.frames import intermediate_extension, read_intermediate, write_intermediate
 from morf.utils.s3interface import make_s3_key_path
 from morf.utils.log import set_logger_handlers
 
@@ -47,7 +50,7 @@ def fetch_result_csv_fp(dir):
     return csv
 
 
-def collect_session_results(job_config, holdout = False, raw_data_dir = "morf-data/", raw_data_buckets = None):
+def collect_session_results(job_config, holdout = False, raw_data_dir = "morf-data/", raw_data_buckets = None, extension = None):
     """
     Iterate through course- and session-level directories in bucket, download individual files from [mode], add column for course and session, and concatenate into single 'master' csv.
     :param s3: boto3.client object with appropriate access credentials.
@@ -56,7 +59,8 @@ def collect_session_results(job_config, holdout = False, raw_data_dir = "morf-da
     :param proc_data_bucket: bucket containing session-level archived results from [mode] jobs (i.e., session-level extracted features).
     :param mode: mode to collect results for, {extract, test}.
     :param holdout: flag; fetch holdout run only (boolean; default False).
-    :return: path to csv.
+    :param extension: format of the collected file, {csv, parquet}; defaults to the job's intermediate format.
+    :return: path to collected file.
     """
     logger = set_logger_handlers(module_logger, job_config)
     mode = job_config.mode
@@ -79,12 +83,53 @@ def collect_session_results(job_config, holdout = False, raw_data_dir = "morf-da
                         logger.warning("exception while collecting session results for course {} session {} mode {}: {}".format(course, run, mode, e))
                         continue
     master_feat_df = pd.concat(feat_df_list)
-    csv_fp = generate_archive_filename(job_config, extension='csv')
-    master_feat_df.to_csv(csv_fp, index = False, header = True)
-    return csv_fp
+    result_fp = generate_archive_filename(job_config, extension=extension or intermediate_extension(job_config))
+    write_intermediate(master_feat_df, result_fp)
+    return result_fp
 
 
-def collect_course_results(job_config, raw_data_dir="morf-data/"):
+def partition_collected_features(job_config, csv_fp, mode=None):
+    """
+    Split a feature file collected by collect_session_results into one csv per course and session, upload each next to
+    the session's results, and upload an index of the partitions, so train/test staging fetches only its session.
+    :param job_config: MorfJobConfig object.
+    :param csv_fp: path to collected feature file with course and session columns.
+    :param mode: mode the features were collected for (i.e., extract or extract-holdout); defaults to job_config.mode.
+    :return: key of the partition index in job_config.proc_data_bucket, or None if a partition could not be uploaded.
+    """
+    logger = set_logger_handlers(module_logger, job_config)
+    mode = mode or job_config.mode
+    feat_df = read_intermediate(csv_fp, dtype=object)
+    columns = [c for c in feat_df.columns if c not in ("course", "session")]
+    index = {"columns": columns, "partitions": dict()}
+    engine = StagingEngine(job_config, task_name="partition {} features".format(mode))
+    with tempfile.TemporaryDirectory(dir=job_config.local_working_directory) as working_dir:
+        for (course, session), session_df in feat_df.groupby(["course", "session"], sort=False):
+            partition_csv = make_feature_csv_name(course, session)
+            partition_fp = os.path.join(working_dir, partition_csv)
+            session_df[columns].to_csv(partition_fp, index=False)
+            key = make_s3_key_path(job_config, course, partition_csv, session, mode)
+            index["partitions"].setdefault(course, dict())[session] = {"key": key, "rows": len(session_df)}
+            engine.add_call(upload_file_to_s3, partition_fp, job_config.proc_data_bucket, key, job_config,
+                            remove_on_success=True, raise_errors=True)
+        index_key = make_feature_index_key(job_config, mode)
+        try:
+            engine.run()
+        except Exception as e:
+            # without an index, train/test staging filters the whole collected file; remove any index of an earlier run
+            logger.warning("not indexing {} features after a partition upload failed: {}".format(mode, e))
+            job_config.initialize_s3().delete_objects(Bucket=job_config.proc_data_bucket, Delete={"Objects": [{"Key": index_key}]})
+            return None
+        # the index is uploaded only after every partition, so it only ever lists partitions that exist
+        index_fp = os.path.join(working_dir, "features-index.json")
+        with open(index_fp, "w") as f:
+            json.dump(index, f)
+        upload_file_to_s3(index_fp, job_config.proc_data_bucket, index_key, job_config, remove_on_success=True)
+    logger.info("partitioned {} features into {} sessions".format(mode, sum(len(x) for x in index["partitions"].values())))
+    return index_key
+
+
+def collect_course_results(job_config, raw_data_dir="morf-data/", extension=None):
     """
     Iterate through course-level directories in bucket, download individual files from [mode], add column for course and session, and concatenate into single 'master' csv.
     :param s3: boto3.client object with appropriate access credentials.
@@ -93,7 +138,8 @@ def collect_course_results(job_config, raw_data_dir="morf-data/"):
     :param proc_data_bucket: bucket containing session-level archived results from [mode] jobs (i.e., session-level extracted features).
     :param mode: mode to collect results for, {extract, test}.
     :param holdout: flag; fetch holdout run only (boolean; default False).
-    :return: path to csv.
+    :param extension: format of the collected file, {csv, parquet}; defaults to the job's intermediate format.
+    :return: path to collected file.
     """
     logger = set_logger_handlers(module_logger, job_config)
     raw_data_buckets = job_config.raw_data_buckets
@@ -117,13 +163,13 @@ def collect_course_results(job_config, raw_data_dir="morf-data/"):
                     logger.warning("exception occurred: {} ".format(e))
                     continue
     master_feat_df = pd.concat(feat_df_list)
-    csv_fp = generate_archive_filename(job_config, extension='csv')
-    master_feat_df.to_csv(csv_fp, index=False, header=True)
-    return csv_fp
+    result_fp = generate_archive_filename(job_config, extension=extension or intermediate_extension(job_config))
+    write_intermediate(master_feat_df, result_fp)
+    return result_fp
 
 
 
-def collect_course_cv_results(job_config, k=5, raw_data_dir="morf-data/"):
+def collect_course_cv_results(job_config, k=5, raw_data_dir="morf-data/", extension=None):
     """
     Iterate through course-level directories in bucket, download individual files from [mode], add column for course and session, and concatenate into single 'master' csv.
     :param s3: boto3.client object with appropriate access credentials.
@@ -132,7 +178,8 @@ def collect_course_cv_results(job_config, k=5, raw_data_dir="morf-data/"):
     :param proc_data_bucket: bucket containing session-level archived results from [mode] jobs (i.e., session-level extracted features).
     :param mode: mode to collect results for, {extract, test}.
     :param holdout: flag; fetch holdout run only (boolean; default False).
-    :return: path to csv.
+    :param extension: format of the collected file, {csv, parquet}; defaults to the job's intermediate format.
+    :return: path to collected file.
     """
     logger = set_logger_handlers(module_logger, job_config)
     raw_data_buckets = job_config.raw_data_buckets
@@ -156,14 +203,14 @@ def collect_course_cv_results(job_config, k=5, raw_data_dir="morf-data/"):
                         logger.warning("exception occurred: {} ".format(e))
                         continue
     master_feat_df = pd.concat(pred_df_list)
-    csv_fp = generate_archive_filename(job_config, mode="test", extension='csv')
-    master_feat_df.to_csv(csv_fp, index=False, header=True)
-    return csv_fp
+    result_fp = generate_archive_filename(job_config, mode="test", extension=extension or intermediate_extension(job_config))
+    write_intermediate(master_feat_df, result_fp)
+    return result_fp
 
 
-def collect_all_results(job_config):
+def collect_all_results(job_config, extension=None):
     """
-    Pull results for all-level job and return path to csv.
+    Pull results for all-level job and return path to collected file, converted to the job's intermediate format.
     Similar wrapper to replicated workflow for collect_course_results and collect_session_results, but no iteration over courses/sessions required.
     :param s3:
     :param proc_data_bucket:
@@ -171,14 +218,20 @@ def collect_all_results(job_config):
     :param user_id:
     :param job_id:
     :param raw_data_dir:
+    :param extension: format of the collected file, {csv, parquet}; defaults to the job's intermediate format.
     :return:
     """
     working_dir = os.getcwd()
     fetch_result_file(job_config, dir=working_dir)
     csv = fetch_result_csv_fp(working_dir)
-    csv_fp = generate_archive_filename(job_config, extension="csv")
-    shutil.move(csv, csv_fp)
-    return csv_fp
+    extension = extension or intermediate_extension(job_config)
+    result_fp = generate_archive_filename(job_config, extension=extension)
+    if extension == "csv":
+        shutil.move(csv, result_fp)
+    else:
+        write_intermediate(pd.read_csv(csv, dtype=object), result_fp)
+        os.remove(csv)
+    return result_fp
 
 
 def check_label_type(label_type, valid_labels = ["dropout", "dropout_current_week"]):
@@ -0,0 +1,305 @@
+# Copyright (c) 2018 The Regents of the University of Michigan
+# and the University of Pennsylvania
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""
+Host-level cache of the job artifacts named by URL in client.config (the docker image and controller script).
+
+Each artifact is stored once per version, where the version is the ETag of an s3 object, the ETag or Last-Modified
+header of an https file, or the size and modification time of a local file. Stored artifacts are named by the md5 of
+their contents, which is checked against the s3 ETag when it is a plain md5, and are handed to tasks as hardlinks, so
+tasks of a job on the same host neither download the artifact again nor hash it again (see artifact_md5).
+"""
+
+import errno
+import hashlib
+import logging
+import os
+import re
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import urllib.request
+from contextlib import closing
+from urllib.parse import urlparse
+from morf.utils.locking import file_lock
+from morf.utils.log import set_logger_handlers
+from morf.utils.security import generate_md5
+from morf.utils.staging import download_s3_object, ranged_download_https
+
+module_logger = logging.getLogger(__name__)
+
+ARTIFACT_CACHE_DIR_NAME = "artifacts"
+INDEX_FILENAME = "index.sqlite"
+DEFAULT_ARTIFACT_CACHE_SIZE_GB = 20
+GB = 1024 ** 3
+MD5_ETAG = re.compile("^[0-9a-f]{32}$") # ETag of an s3 object uploaded in a single part is the md5 of its contents
+
+# caches already opened by this process, keyed by cache_dir
+_artifact_caches = {}
+_artifact_caches_lock = threading.Lock()
+
+
+def fetch_url_version(job_config, url):
+    """
+    Identify the current version of the file at url without downloading it.
+    :param job_config: MorfJobConfig object.
+    :param url: file://, s3:// or https:// url.
+    :return: version (string), or None if it can not be determined.
+    """
+    parsed = urlparse(url)
+    if parsed.scheme == "file":
+        st = os.stat(parsed.path)
+        return "{}-{}".format(st.st_size, st.st_mtime_ns)
+    if parsed.scheme == "s3":
+        return job_config.initialize_s3().head_object(Bucket=parsed.netloc, Key=parsed.path[1:])["ETag"].strip('"')
+    if parsed.scheme == "https":
+        with urllib.request.urlopen(urllib.request.Request(url, method="HEAD")) as response:
+            headers = response.headers
+        validator = headers.get("ETag") or headers.get("Last-Modified")
+        return "{}-{}".format(headers.get("Content-Length"), validator) if validator else None
+    return None
+
+
+def download_url(job_config, url, dest_fp):
+    """
+    Download the file at url to dest_fp.
+    :return: dest_fp
+    """
+    parsed = urlparse(url)
+    if parsed.scheme == "file":
+        shutil.copyfile(parsed.path, dest_fp)
+    elif parsed.scheme == "s3":
+        download_s3_object(job_config, parsed.netloc, parsed.path[1:], dest_fp)
+    elif parsed.scheme == "https":
+        if not ranged_download_https(url, dest_fp, job_config):
+            urllib.request.urlretrieve(url, dest_fp)
+    else:
+        raise ValueError("unsupported url scheme for {}".format(url))
+    return dest_fp
+
+
+class ArtifactCache:
+    """
+    Store of artifacts keyed by url and version, limited to max_bytes on disk.
+    """
+
+    def __init__(self, cache_dir, max_bytes=DEFAULT_ARTIFACT_CACHE_SIZE_GB * GB):
+        """
+        :param cache_dir: root directory of cache; artifacts are stored in cache_dir/artifacts.
+        :param max_bytes: size budget for stored artifacts; least recently used artifacts are evicted to stay within it.
+        """
+        self.root = os.path.join(cache_dir, ARTIFACT_CACHE_DIR_NAME)
+        self.tmp_dir = os.path.join(self.root, "tmp")
+        self.index_fp = os.path.join(self.root, INDEX_FILENAME)
+        self.max_bytes = max_bytes
+        os.makedirs(self.tmp_dir, exist_ok=True)
+        with closing(self._connect()) as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS artifacts (url TEXT, version TEXT, md5 TEXT, size INTEGER, "
+                         "device INTEGER, inode INTEGER, last_access REAL, PRIMARY KEY (url, version))")
+
+    def _connect(self):
+        return sqlite3.connect(self.index_fp, timeout=60, isolation_level=None)
+
+    def blob_path(self, md5):
+        return os.path.join(self.root, md5[:2], md5)
+
+    def lock_path(self, url):
+        return os.path.join(self.root, "locks", "{}.lock".format(hashlib.md5(url.encode()).hexdigest()))
+
+    def lookup(self, url, version):
+        """
+        Fetch the path of the stored artifact for url at version and mark it as recently used.
+        :return: path to artifact, or None if it is not stored or was changed or removed outside of the cache.
+        """
+        with closing(self._connect()) as conn:
+            row = conn.execute("SELECT md5, size, device, inode FROM artifacts WHERE url = ? AND version = ?", (url, version)).fetchone()
+            if row is None:
+                return None
+            path = self.blob_path(row[0])
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                st = None
+            if st is None or (st.st_size, st.st_dev, st.st_ino) != tuple(row[1:]):
+                conn.execute("DELETE FROM artifacts WHERE url = ? AND version = ?", (url, version))
+                return None
+            conn.execute("UPDATE artifacts SET last_access = ? WHERE url = ? AND version = ?", (time.time(), url, version))
+        return path
+
+    def lookup_md5(self, fp):
+        """
+        Fetch the md5 of fp without reading it if fp is a stored artifact or a hardlink to one.
+        :return: md5 (hex string), or None if fp is not a stored artifact.
+        """
+        st = os.stat(fp)
+        with closing(self._connect()) as conn:
+            row = conn.execute("SELECT md5 FROM artifacts WHERE device = ? AND inode = ? AND size = ?",
+                               (st.st_dev, st.st_ino, st.st_size)).fetchone()
+        return row[0] if row else None
+
+    def add(self, url, version, src_fp, expected_md5=None):
+        """
+        Move src_fp into the cache as the artifact for url at version, replacing earlier versions of url.
+        :param src_fp: path to file; it is moved, so it should be on the same filesystem as the cache.
+        :param expected_md5: md5 the file must have (i.e., from an s3 ETag); if it differs, IOError is raised.
+        :return: path to stored artifact.
+        """
+        md5 = generate_md5(src_fp)
+        if expected_md5 and md5 != expected_md5:
+            raise IOError("checksum of {} is {}, expected {}".format(url, md5, expected_md5))
+        path = self.blob_path(md5)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.chmod(src_fp, 0o444) # artifacts are hardlinked into task directories, which must not modify them
+        os.replace(src_fp, path)
+        st = os.stat(path)
+        with closing(self._connect()) as conn:
+            stale = [r[0] for r in conn.execute("SELECT md5 FROM artifacts WHERE url = ? AND version != ?", (url, version))]
+            conn.execute("DELETE FROM artifacts WHERE url = ? AND version != ?", (url, version))
+            conn.execute("INSERT OR REPLACE INTO artifacts VALUES (?, ?, ?, ?, ?, ?, ?)",
+                         (url, version, md5, st.st_size, st.st_dev, st.st_ino, time.time()))
+        self._remove_unreferenced(x for x in stale if x != md5)
+        self.evict(keep=md5)
+        return path
+
+    def _remove_unreferenced(self, md5s):
+        with closing(self._connect()) as conn:
+            for md5 in set(md5s):
+                if conn.execute("SELECT 1 FROM artifacts WHERE md5 = ?", (md5,)).fetchone() is None:
+                    try:
+                        os.remove(self.blob_path(md5))
+                    except FileNotFoundError:
+                        pass
+        return
+
+    def evict(self, keep=None):
+        """
+        Remove least recently used artifacts until the cache is within its budget. Tasks holding a hardlink to an
+        evicted artifact keep their copy.
+        :param keep: md5 of an artifact that must not be evicted (i.e., one that was just added).
+        :return: list of evicted md5s.
+        """
+        with closing(self._connect()) as conn:
+            rows = conn.execute("SELECT md5, MAX(size), MAX(last_access) FROM artifacts GROUP BY md5 ORDER BY MAX(last_access)").fetchall()
+            total = sum(r[1] for r in rows)
+            evicted = list()
+            for md5, size, _ in rows:
+                if total <= self.max_bytes:
+                    break
+                if md5 == keep:
+                    continue
+                conn.execute("DELETE FROM artifacts WHERE md5 = ?", (md5,))
+                evicted.append(md5)
+                total -= size
+        self._remove_unreferenced(evicted)
+        return evicted
+
+    def get(self, job_config, url, version):
+        """
+        Fetch the path to the stored artifact for url at version, downloading and verifying it first if needed.
+        Concurrent callers missing the same url wait for a single download.
+        :param job_config: MorfJobConfig object.
+        :param url: file://, s3:// or https:// url.
+        :param version: version of url (see fetch_url_version).
+        :return: path to stored artifact; must be treated as read-only.
+        """
+        path = self.lookup(url, version)
+        if path:
+            return path
+        with file_lock(self.lock_path(url)):
+            path = self.lookup(url, version)
+            if path:
+                return path
+            fd, tmp_fp = tempfile.mkstemp(dir=self.tmp_dir)
+            os.close(fd)
+            try:
+                download_url(job_config, url, tmp_fp)
+                expected_md5 = version if urlparse(url).scheme == "s3" and MD5_ETAG.match(version) else None
+                return self.add(url, version, tmp_fp, expected_md5)
+            finally:
+                if os.path.exists(tmp_fp):
+                    os.remove(tmp_fp)
+
+
+def get_artifact_cache(job_config):
+    """
+    Fetch this process's ArtifactCache for job_config.cache_dir, limited to job_config.artifact_cache_size_gb.
+    :param job_config: MorfJobConfig object.
+    :return: ArtifactCache, or None if job_config has no cache_dir.
+    """
+    cache_dir = getattr(job_config, "cache_dir", None)
+    if not cache_dir:
+        return None
+    with _artifact_caches_lock:
+        cache = _artifact_caches.get(cache_dir)
+        if cache is None:
+            cache = ArtifactCache(cache_dir, int(getattr(job_config, "artifact_cache_size_gb", DEFAULT_ARTIFACT_CACHE_SIZE_GB) * GB))
+            _artifact_caches[cache_dir] = cache
+    return cache
+
+
+def fetch_artifact(job_config, url, dest_dir, dest_filename=None):
+    """
+    Place the file at url in dest_dir as a hardlink to the host's cached copy, downloading it only if the cache does not
+    hold its current version. Falls back to a plain download if there is no cache or the version can not be determined.
+    :param job_config: MorfJobConfig object.
+    :param url: file://, s3:// or https:// url.
+    :param dest_dir: directory to place file in.
+    :param dest_filename: base name of file (otherwise defaults to the base name of url).
+    :return: path to file.
+    """
+    logger = set_logger_handlers(module_logger, job_config)
+    dest_fp = os.path.join(dest_dir, dest_filename or os.path.basename(urlparse(url).path))
+    os.makedirs(dest_dir, exist_ok=True)
+    cache = get_artifact_cache(job_config)
+    version = fetch_url_version(job_config, url) if cache else None
+    if version is None:
+        logger.info("retrieving file {} to {}".format(url, dest_dir))
+        return download_url(job_config, url, dest_fp)
+    for attempt in range(2): # artifact may be evicted by another process between get() and linking it
+        path = cache.get(job_config, url, version)
+        try:
+            os.link(path, dest_fp)
+            logger.info("linked cached copy of {} to {}".format(url, dest_fp))
+            return dest_fp
+        except FileNotFoundError:
+            logger.warning("cached copy of {} was evicted while in use; fetching again".format(url))
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                raise
+            shutil.copyfile(path, dest_fp)
+            logger.info("copied cached copy of {} to {}".format(url, dest_fp))
+            return dest_fp
+    raise IOError("could not fetch {} from artifact cache".format(url))
+
+
+def artifact_md5(job_config, fp):
+    """
+    Fetch the md5 of fp, from the artifact cache if fp was placed by fetch_artifact, otherwise by reading it.
+    :param job_config: MorfJobConfig object.
+    :param fp: path to file.
+    :return: md5 (hex string).
+    """
+    cache = get_artifact_cache(job_config)
+    return (cache and cache.lookup_md5(fp)) or generate_md5(fp)
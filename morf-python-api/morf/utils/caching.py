@@ -28,27 +28,30 @@ import subprocess
 import shutil
 from urllib.parse import urlparse
 import logging
-from morf.utils.docker import load_docker_image
+from morf.utils.docker import registered_docker_image
 from morf.utils.log import set_logger_handlers, execute_and_log_output
+from morf.utils.catalog import get_bucket_catalog
+from morf.utils.content_cache import get_content_cache, fetch_cached_object
 from morf.utils.s3interface import sync_s3_bucket_cache
 
 module_logger = logging.getLogger(__name__)
 
 
-def make_course_session_cache_dir_fp(job_config, bucket, data_dir, course, session):
-    fp = os.path.join(job_config.cache_dir, bucket, data_dir, course, session)
-    return fp
-
-
 def update_raw_data_cache(job_config):
     """
-    Update the raw data cache using the parameters in job_config; if job_config contains multiple raw data buckets, cache all of them.
+    Prepare the raw data cache for job_config. Raw data is no longer mirrored ahead of time: objects enter the
+    content cache when a task first needs them, so this loads the catalog of every raw data bucket (used to validate
+    cached objects by ETag) and evicts objects until the cache is within job_config.cache_size_gb.
     :param job_config: MorfJobConfig object.
     :return:
     """
-    # cache each bucket in a named directory within job_cache_dir
+    logger = set_logger_handlers(module_logger, job_config)
     for raw_data_bucket in job_config.raw_data_buckets:
-        sync_s3_bucket_cache(job_config, raw_data_bucket)
+        get_bucket_catalog(job_config, raw_data_bucket)
+    cache = get_content_cache(job_config)
+    if cache:
+        evicted = cache.evict()
+        logger.info("raw data cache holds {:.1f} GB after evicting {:.1f} GB".format(cache.size() / 2 ** 30, evicted / 2 ** 30))
     return
 
 
@@ -65,21 +68,22 @@ def update_proc_data_cache(job_config):
 
 def fetch_from_cache(job_config, cache_file_path, dest_dir):
     """
-    Fetch a file from the cache for job_config into dest_dir, if it exists.
+    Fetch a file from the content cache for job_config into dest_dir, downloading it into the cache if needed.
     :param job_config:
-    :param cache_file_path: string, relative path to file in cache (this is identical to the directory path in s3; e.g. "/bucket/path/to/somefile.csv"
+    :param cache_file_path: string, path to file in s3 including bucket; e.g. "bucket/path/to/somefile.csv"
     :param dest_dir: absolute path of directory to fetch file into (will be created if not exists)
-    :return: path to fetched file (string); return None if cache is not used.
+    :return: path to fetched file (string); return None if cache is not used or file could not be fetched.
     """
     logger = set_logger_handlers(module_logger, job_config)
     logger.info("fetching file {} from cache".format(cache_file_path))
-    abs_cache_file_path = os.path.join(getattr(job_config, "cache_dir", None), cache_file_path)
-    if hasattr(job_config, "cache_dir") and os.path.exists(abs_cache_file_path):
-        if not os.path.exists(dest_dir):
-            os.makedirs(dest_dir)
-        dest_fp = shutil.copy(abs_cache_file_path, dest_dir)
-    else:
-        logger.warning("file {} does not exist in cache".format(abs_cache_file_path))
+    if not get_content_cache(job_config):
+        logger.warning("job has no cache_dir; not fetching {} from cache".format(cache_file_path))
+        return None
+    bucket, key = cache_file_path.lstrip("/").split("/", 1)
+    try:
+        dest_fp = fetch_cached_object(job_config, bucket, key, os.path.join(dest_dir, os.path.basename(key)))
+    except Exception as e:
+        logger.warning("could not fetch file {} from cache: {}".format(cache_file_path, e))
         dest_fp = None
     return dest_fp
 
@@ -121,7 +125,8 @@ def cache_to_docker_hub(job_config, dir, image_name):
     :return: None
     """
     logger = set_logger_handlers(module_logger, job_config)
-    image_uuid = load_docker_image(dir, job_config, logger, image_name)
-    docker_cloud_login(job_config)
-    docker_cloud_repo_and_tag_path = docker_cloud_push(job_config, image_uuid)
+    # the image is normally still loaded from the job's tasks
+    with registered_docker_image(job_config, os.path.join(dir, image_name), logger) as image_uuid:
+        docker_cloud_login(job_config)
+        docker_cloud_repo_and_tag_path = docker_cloud_push(job_config, image_uuid)
     return docker_cloud_repo_and_tag_path
@@ -0,0 +1,235 @@
+# Copyright (c) 2018 The Regents of the University of Michigan
+# and the University of Pennsylvania
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Snapshots of the contents of raw data buckets, used to answer course/session/object queries without repeated s3 listings.
+"""
+
+import json
+import logging
+import os
+import time
+from morf.utils.log import set_logger_handlers
+
+module_logger = logging.getLogger(__name__)
+
+DEFAULT_CATALOG_TTL = 3600 # seconds a catalog snapshot is considered fresh
+CATALOG_DIR_NAME = "catalog"
+
+# catalogs already loaded by this process, keyed by (bucket, data_dir); inherited by forked pool workers
+_catalogs = {}
+
+
+def normalize_data_dir(data_dir):
+    """
+    Ensure data_dir has exactly one trailing slash, so "morf-data" and "morf-data/" refer to the same prefix.
+    :param data_dir: path to directory in bucket (string).
+    :return: normalized data_dir (string).
+    """
+    return data_dir.rstrip("/") + "/"
+
+
+def list_bucket_objects(s3, bucket, prefix=""):
+    """
+    Generator over every object in bucket under prefix; uses a paginated listing so results are not truncated at 1000 keys.
+    :param s3: boto3.client object for s3 connection.
+    :param bucket: name of s3 bucket.
+    :param prefix: key prefix to list.
+    :return: yields the object dicts returned by list_objects_v2 (with Key, Size, ETag, etc.).
+    """
+    paginator = s3.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get("Contents", []):
+            yield obj
+
+
+class BucketCatalog:
+    """
+    Snapshot of all objects in data_dir of a raw data bucket. Answers course, session, and object queries from memory.
+    """
+
+    def __init__(self, bucket, data_dir, objects, created=None):
+        """
+        :param bucket: name of s3 bucket.
+        :param data_dir: directory in bucket containing course-level directories.
+        :param objects: dict of {key: [size, etag]} for every object under data_dir.
+        :param created: unix timestamp of the listing; defaults to now.
+        """
+        self.bucket = bucket
+        self.data_dir = normalize_data_dir(data_dir)
+        self.objects = objects
+        self.created = created if created is not None else time.time()
+        self._index_courses()
+
+    def _index_courses(self):
+        """
+        Build {course: set(sessions)} from the object keys.
+        :return: None
+        """
+        self.course_sessions = {}
+        for key in self.objects:
+            parts = key[len(self.data_dir):].split("/")
+            if len(parts) >= 2: # key is inside a course-level directory
+                sessions = self.course_sessions.setdefault(parts[0], set())
+                if len(parts) >= 3: # key is inside a session-level directory
+                    sessions.add(parts[1])
+        return
+
+    @classmethod
+    def from_s3(cls, s3, bucket, data_dir):
+        """
+        Build a catalog by listing every object under data_dir in bucket.
+        :param s3: boto3.client object for s3 connection.
+        :param bucket: name of s3 bucket.
+        :param data_dir: directory in bucket containing course-level directories.
+        :return: BucketCatalog
+        """
+        data_dir = normalize_data_dir(data_dir)
+        objects = {obj["Key"]: [obj["Size"], obj["ETag"].strip('"')] for obj in list_bucket_objects(s3, bucket, data_dir)}
+        return cls(bucket, data_dir, objects)
+
+    @classmethod
+    def from_file(cls, fp):
+        """
+        Load a catalog previously written with to_file().
+        :param fp: path to catalog json file.
+        :return: BucketCatalog
+        """
+        with open(fp) as f:
+            data = json.load(f)
+        return cls(data["bucket"], data["data_dir"], data["objects"], data["created"])
+
+    def to_file(self, fp):
+        """
+        Write catalog to fp as json; the file is replaced atomically so concurrent readers never see a partial file.
+        :param fp: path to catalog json file.
+        :return: None
+        """
+        tmp_fp = "{}.{}.tmp".format(fp, os.getpid())
+        with open(tmp_fp, "w") as f:
+            json.dump({"bucket": self.bucket, "data_dir": self.data_dir, "created": self.created,
+                       "objects": self.objects}, f)
+        os.replace(tmp_fp, fp)
+        return
+
+    def is_fresh(self, ttl):
+        return (time.time() - self.created) < ttl
+
+    def courses(self):
+        """
+        :return: list of course names, sorted alphabetically.
+        """
+        return sorted(self.course_sessions)
+
+    def sessions(self, course):
+        """
+        :param course: course name.
+        :return: list of all sessions of course, sorted so that the holdout session is last.
+        """
+        # handles session numbers like "2012-001" by keeping leading digits before "-" but only sorts on last 3 digits
+        return sorted(self.course_sessions.get(course, ()), key=lambda x: x[-3:])
+
+    def holdout_session(self, course):
+        return self.sessions(course)[-1]
+
+    def session_objects(self, course, session):
+        """
+        :return: list of (key, size, etag) tuples for every object in the session-level directory of course.
+        """
+        prefix = "{}{}/{}/".format(self.data_dir, course, session)
+        return [(key, size, etag) for key, (size, etag) in sorted(self.objects.items()) if key.startswith(prefix)]
+
+    def object_size(self, key):
+        return self.objects[key][0]
+
+    def object_etag(self, key):
+        return self.objects[key][1]
+
+
+def lookup_catalog_object(bucket, key):
+    """
+    Find key in any catalog of bucket already loaded by this process, without listing or reading from disk.
+    :param bucket: name of s3 bucket.
+    :param key: object key.
+    :return: (size, etag) tuple, or None if key is not in a loaded catalog.
+    """
+    for (catalog_bucket, data_dir), catalog in _catalogs.items():
+        if catalog_bucket == bucket and key in catalog.objects:
+            return tuple(catalog.objects[key])
+    return None
+
+
+def make_catalog_fp(job_config, bucket, data_dir):
+    """
+    Path to the on-disk catalog for bucket/data_dir, or None if job_config has no local directory to keep it in.
+    """
+    root_dir = getattr(job_config, "cache_dir", getattr(job_config, "local_working_directory", None))
+    if not root_dir:
+        return None
+    catalog_name = "{}-{}.json".format(bucket, normalize_data_dir(data_dir).strip("/").replace("/", "-"))
+    return os.path.join(root_dir, CATALOG_DIR_NAME, catalog_name)
+
+
+def get_bucket_catalog(job_config, bucket, data_dir="morf-data/", refresh=False):
+    """
+    Fetch the catalog for bucket/data_dir, using (in order) this process's copy, the copy on disk, or a fresh s3 listing.
+    Catalogs older than job_config.catalog_ttl seconds are rebuilt.
+    :param job_config: MorfJobConfig object.
+    :param bucket: name of raw data bucket.
+    :param data_dir: directory in bucket containing course-level directories.
+    :param refresh: if True, ignore any cached catalog and list bucket again.
+    :return: BucketCatalog
+    """
+    data_dir = normalize_data_dir(data_dir)
+    ttl = getattr(job_config, "catalog_ttl", DEFAULT_CATALOG_TTL)
+    catalog = _catalogs.get((bucket, data_dir))
+    if catalog and catalog.is_fresh(ttl) and not refresh:
+        return catalog
+    logger = set_logger_handlers(module_logger, job_config)
+    catalog_fp = make_catalog_fp(job_config, bucket, data_dir)
+    catalog = None
+    if catalog_fp and os.path.exists(catalog_fp) and not refresh:
+        try:
+            catalog = BucketCatalog.from_file(catalog_fp)
+        except Exception as e:
+            logger.warning("could not read catalog file {}: {}".format(catalog_fp, e))
+        if catalog and not catalog.is_fresh(ttl):
+            catalog = None
+    if not catalog:
+        logger.info("listing s3://{}/{} to build bucket catalog".format(bucket, data_dir))
+        catalog = BucketCatalog.from_s3(job_config.initialize_s3(), bucket, data_dir)
+        if catalog_fp:
+            os.makedirs(os.path.dirname(catalog_fp), exist_ok=True)
+            catalog.to_file(catalog_fp)
+    _catalogs[(bucket, data_dir)] = catalog
+    return catalog
+
+
+def refresh_bucket_catalogs(job_config, data_dir="morf-data/"):
+    """
+    Rebuild the catalog of every raw data bucket in job_config from a fresh s3 listing.
+    :param job_config: MorfJobConfig object.
+    :param data_dir: directory in buckets containing course-level directories.
+    :return: None
+    """
+    for bucket in job_config.raw_data_buckets:
+        get_bucket_catalog(job_config, bucket, data_dir, refresh=True)
+    return
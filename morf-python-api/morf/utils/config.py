@@ -23,7 +23,6 @@
 Functions for working with (reading writing, modifying) MORF configuration files.
 """
 
-import boto3
 import configparser
 import fileinput
 import json
@@ -31,11 +30,32 @@ import logging
 import multiprocessing
 import os
 import re
+import uuid
 from morf.utils import get_bucket_from_url, get_key_from_url
+from morf.utils.artifacts import DEFAULT_ARTIFACT_CACHE_SIZE_GB
+from morf.utils.catalog import DEFAULT_CATALOG_TTL
+from morf.utils.docker import DEFAULT_DOCKER_IMAGE_CACHE_SIZE
+from morf.utils.frames import DEFAULT_INTERMEDIATE_FORMAT, INTERMEDIATE_FORMATS, PARQUET, PARQUET_AVAILABLE
+from morf.utils.content_cache import DEFAULT_CACHE_SIZE_GB, DEFAULT_PREWARM_BUDGET_GB, STAGING_MODES
+from morf.utils.metrics import set_s3_metrics_context
+from morf.utils.s3interface import get_s3_client, DEFAULT_DELETE_MAX_WORKERS
+from morf.utils.staging import DEFAULT_STAGING_MAX_WORKERS, DEFAULT_MAX_CONCURRENCY, DEFAULT_MULTIPART_THRESHOLD_MB, \
+    DEFAULT_MULTIPART_CHUNKSIZE_MB, DEFAULT_RANGED_DOWNLOAD_THRESHOLD_MB, DEFAULT_RANGE_SIZE_MB, \
+    DEFAULT_RANGED_DOWNLOAD_MAX_WORKERS
 from morf.utils.security import generate_md5
+from morf.utils.transfer import DEFAULT_TRANSFER_MAX_MB_PER_S, DEFAULT_CRITICAL_RESERVE, DEFAULT_CRITICAL_MAX_MB
 
 
 
+def str_to_bool(value):
+    """
+    Convert a boolean value from a config file (i.e., "true", "False", "1") to a Python logical.
+    :param value: string value from config file.
+    :return: boolean
+    """
+    return str(value).strip().lower() in ("true", "t", "yes", "1")
+
+
 def get_config_properties(config_file="config.properties", sections_to_fetch = None):
     """
     Returns the list of properties as a dict of key/value pairs in the file config.properties.
@@ -143,6 +163,9 @@ class MorfJobConfig:
         self.type = "morf"  # todo: delete this
         self.mode = None
         self.status = "START"
+        # identifies this workflow stage (each workflow function creates its own job config); shared by every pool
+        # worker the job_config is passed to
+        self.run_id = uuid.uuid4().hex
         properties = get_config_properties(config_file)
         self.client_args = get_config_properties(config_file, sections_to_fetch="args")
         # add properties to class as attributes
@@ -152,10 +175,37 @@ class MorfJobConfig:
         if self.client_args:
             self.generate_job_id()
         # fetch raw data buckets as list
-        self.raw_data_buckets = fetch_data_buckets_from_config()
+        self.raw_data_buckets = fetch_data_buckets_from_config(config_file)
         self.generate_morf_id(config_file)
         # if maximum number of cores is not specified, set to one less than half of current machine's cores; otherwise cast to int
         self.setcores()
+        # optional numeric properties; these are read as strings from config file
+        self.set_typed_property("catalog_ttl", DEFAULT_CATALOG_TTL, float)
+        self.set_typed_property("staging_max_workers", DEFAULT_STAGING_MAX_WORKERS)
+        self.set_typed_property("staging_max_concurrency", DEFAULT_MAX_CONCURRENCY)
+        self.set_typed_property("staging_multipart_threshold_mb", DEFAULT_MULTIPART_THRESHOLD_MB)
+        self.set_typed_property("staging_multipart_chunksize_mb", DEFAULT_MULTIPART_CHUNKSIZE_MB)
+        self.set_typed_property("ranged_download_threshold_mb", DEFAULT_RANGED_DOWNLOAD_THRESHOLD_MB)
+        self.set_typed_property("range_size_mb", DEFAULT_RANGE_SIZE_MB)
+        self.set_typed_property("ranged_download_max_workers", DEFAULT_RANGED_DOWNLOAD_MAX_WORKERS)
+        self.set_typed_property("delete_max_workers", DEFAULT_DELETE_MAX_WORKERS)
+        self.set_typed_property("async_clear", False, str_to_bool)
+        self.set_typed_property("transfer_max_mb_per_s", DEFAULT_TRANSFER_MAX_MB_PER_S, float)
+        self.set_typed_property("transfer_critical_reserve", DEFAULT_CRITICAL_RESERVE, float)
+        self.set_typed_property("transfer_critical_max_mb", DEFAULT_CRITICAL_MAX_MB, float)
+        self.set_typed_property("cache_size_gb", DEFAULT_CACHE_SIZE_GB, float)
+        self.set_typed_property("artifact_cache_size_gb", DEFAULT_ARTIFACT_CACHE_SIZE_GB, float)
+        self.set_typed_property("staging_mode", "copy", str)
+        self.set_typed_property("prewarm_budget_gb", DEFAULT_PREWARM_BUDGET_GB, float)
+        self.set_typed_property("write_through", False, str_to_bool)
+        self.set_typed_property("memoize_results", False, str_to_bool)
+        self.set_typed_property("resume", False, str_to_bool)
+        self.set_typed_property("shared_labels", False, str_to_bool)
+        self.set_typed_property("docker_image_cache_size", DEFAULT_DOCKER_IMAGE_CACHE_SIZE)
+        self.set_typed_property("intermediate_format", DEFAULT_INTERMEDIATE_FORMAT, str)
+        assert self.staging_mode in STAGING_MODES, "staging_mode must be one of {}".format(STAGING_MODES)
+        assert self.intermediate_format in INTERMEDIATE_FORMATS, "intermediate_format must be one of {}".format(INTERMEDIATE_FORMATS)
+        assert self.intermediate_format != PARQUET or PARQUET_AVAILABLE, "intermediate_format = parquet requires pyarrow (pip install morf-api[parquet])"
 
     def generate_job_id(self):
         """
@@ -194,12 +244,11 @@ class MorfJobConfig:
     def update_mode(self, mode):
         # todo: check whether mode is valid by comparing with allowed values
         self.mode = mode
+        set_s3_metrics_context(self, stage=mode)
 
     def initialize_s3(self):
-        # create s3 connection object for communicating with s3
-        s3obj = boto3.client("s3",
-                             aws_access_key_id=self.aws_access_key_id,
-                             aws_secret_access_key=self.aws_secret_access_key)
+        # fetch s3 connection object for communicating with s3; this is shared by all calls within a process
+        s3obj = get_s3_client(self.aws_access_key_id, self.aws_secret_access_key)
         return s3obj
 
 
@@ -211,3 +260,17 @@ class MorfJobConfig:
             n_cores = int(self.max_num_cores)
             self.max_num_cores = n_cores
         return
+
+    def set_typed_property(self, name, default, cast=int):
+        """
+        Cast property name to cast if it was specified in the config file; otherwise set it to default.
+        :param name: name of property (string).
+        :param default: value to use if property is not specified.
+        :param cast: callable used to convert the string value from the config file.
+        :return: None
+        """
+        if not hasattr(self, name):
+            setattr(self, name, default)
+        else:
+            setattr(self, name, cast(getattr(self, name)))
+        return
@@ -0,0 +1,530 @@
+# Copyright (c) 2018 The Regents of the University of Michigan
+# and the University of Pennsylvania
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Content-addressed local cache of s3 objects with a size budget and least-recently-used eviction.
+
+Objects are stored once per bucket, key, and ETag under job_config.cache_dir/objects, so an object is only downloaded
+again when its content changes. ETags are not content hashes for multipart or SSE-KMS uploads, so objects under
+different keys are never assumed identical because their ETags match. Derived forms of an object (i.e.,
+the decompressed contents of a .sql.gz dump) are stored the same way, keyed by the ETag of the source object, so they
+are only computed once. A SQLite index shared by all MORF processes on the host records the size and last access time
+of each stored object. Fills are single-flight: when several processes or threads miss the same object at once, one
+downloads it into a temporary file and renames it into place, while the others wait on a file lock and reuse it.
+
+With write_through = true, files a job uploads to s3 are also kept in the cache and registered under their bucket, key,
+and ETag, so later stages of the job on this host (collecting, training, testing, evaluating) read them locally
+instead of downloading them again.
+
+With staging_mode = link, cached objects are placed in task input directories as reflinks or hardlinks instead of
+copies; stored objects are read-only, and the container's /input is mounted read-only, so a hardlinked input cannot
+modify the cache (containers run as root, which ignores file modes). When the input directory is on
+another filesystem, the object is bind-mounted read-only into the container instead (see make_docker_run_command);
+bind-mounted objects are pinned, so no process evicts them, until pop_bind_mounts is called after the container exits.
+"""
+
+import errno
+import fcntl
+import hashlib
+import logging
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+from contextlib import closing
+from morf.utils.catalog import lookup_catalog_object
+from morf.utils.locking import file_lock
+from morf.utils.log import set_logger_handlers
+from morf.utils.staging import download_s3_object, download_s3_object_gunzip, gunzip_to_file, report_staged_bytes
+
+module_logger = logging.getLogger(__name__)
+
+CONTENT_CACHE_DIR_NAME = "objects"
+INDEX_FILENAME = "index.sqlite"
+LOCK_DIR_NAME = "locks"
+DEFAULT_CACHE_SIZE_GB = 100
+DEFAULT_PREWARM_BUDGET_GB = 20 # inputs of a queued job fetched ahead of time (see morf.utils.prewarm)
+GB = 1024 ** 3
+STAGING_MODES = ("copy", "link")
+GUNZIP = "gunzip" # variant holding the decompressed contents of a gzip object
+FICLONE = 0x40049409 # ioctl request to reflink a whole file (btrfs, xfs)
+
+# caches already opened by this process, keyed by cache_dir
+_content_caches = {}
+_content_caches_lock = threading.Lock()
+# cached objects to bind-mount into the next container run by this process, as {dest_fp: (ContentCache, cached object path)}
+_bind_mounts = {}
+_bind_mounts_lock = threading.Lock()
+
+
+def normalize_etag(etag):
+    """
+    :return: etag without surrounding quotes.
+    """
+    return etag.strip('"')
+
+
+def make_digest(bucket, key, etag, variant=None):
+    """
+    Name under which version etag of s3://bucket/key, or its variant, is stored.
+    :param bucket: name of s3 bucket.
+    :param key: object key.
+    :param etag: ETag of s3 object, with or without surrounding quotes.
+    :param variant: name of derived form of the object (i.e., GUNZIP), or None for the object itself.
+    :return: digest (string).
+    """
+    location = hashlib.sha1("{}/{}".format(bucket, key).encode("utf-8")).hexdigest()[:16]
+    digest = "{}-{}".format(location, normalize_etag(etag))
+    if variant:
+        digest = "{}.{}".format(digest, variant)
+    return digest
+
+
+class ContentCache:
+    """
+    Store of s3 objects keyed by bucket, key, and ETag, limited to max_bytes on disk.
+    """
+
+    def __init__(self, cache_dir, max_bytes=DEFAULT_CACHE_SIZE_GB * GB):
+        """
+        :param cache_dir: root directory of cache; objects are stored in cache_dir/objects.
+        :param max_bytes: size budget for stored objects; least recently used objects are evicted to stay within it.
+        """
+        self.root = os.path.join(cache_dir, CONTENT_CACHE_DIR_NAME)
+        self.tmp_dir = os.path.join(self.root, "tmp")
+        self.lock_dir = os.path.join(self.root, LOCK_DIR_NAME)
+        self.index_fp = os.path.join(self.root, INDEX_FILENAME)
+        self.max_bytes = max_bytes
+        os.makedirs(self.tmp_dir, exist_ok=True)
+        with closing(self._connect()) as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS blobs (digest TEXT PRIMARY KEY, size INTEGER, last_access REAL)")
+            conn.execute("CREATE TABLE IF NOT EXISTS objects (bucket TEXT, key TEXT, etag TEXT, PRIMARY KEY (bucket, key))")
+            # objects uploaded from this host, whose current ETag is known without asking s3
+            conn.execute("CREATE TABLE IF NOT EXISTS uploads (bucket TEXT, key TEXT, etag TEXT, PRIMARY KEY (bucket, key))")
+            # objects in use outside the cache (i.e., bind-mounted into a container), which must not be evicted
+            conn.execute("CREATE TABLE IF NOT EXISTS pins (digest TEXT, pid INTEGER, owner TEXT)")
+
+    def _connect(self):
+        # a new connection for every operation keeps the index safe to use from threads and forked processes
+        return sqlite3.connect(self.index_fp, timeout=60, isolation_level=None)
+
+    def blob_path(self, digest):
+        return os.path.join(self.root, digest[:2], digest)
+
+    def lock_path(self, digest):
+        return os.path.join(self.lock_dir, "{}.lock".format(digest))
+
+    def lookup(self, digest):
+        """
+        Fetch the path of a stored object and mark it as recently used.
+        :param digest: digest of object (see make_digest).
+        :return: path to object, or None if it is not stored.
+        """
+        path = self.blob_path(digest)
+        with closing(self._connect()) as conn:
+            found = conn.execute("UPDATE blobs SET last_access = ? WHERE digest = ?", (time.time(), digest)).rowcount
+            if found and not os.path.exists(path): # file was removed outside of the cache
+                conn.execute("DELETE FROM blobs WHERE digest = ?", (digest,))
+                found = False
+        return path if found else None
+
+    def add(self, digest, src_fp, bucket=None, key=None, etag=None):
+        """
+        Move src_fp into the cache as digest and evict least recently used objects if the budget is exceeded.
+        :param digest: digest of object (see make_digest).
+        :param src_fp: path to file; it is moved, not copied, so it should be on the same filesystem as the cache.
+        :param bucket: bucket the object came from; recorded together with key and etag.
+        :return: path to stored object.
+        """
+        path = self.blob_path(digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        size = os.path.getsize(src_fp)
+        os.chmod(src_fp, 0o444) # objects may be hardlinked into task inputs, which must not modify them
+        os.replace(src_fp, path)
+        with closing(self._connect()) as conn:
+            conn.execute("INSERT OR REPLACE INTO blobs VALUES (?, ?, ?)", (digest, size, time.time()))
+            if bucket is not None:
+                conn.execute("INSERT OR REPLACE INTO objects VALUES (?, ?, ?)", (bucket, key, normalize_etag(etag)))
+        self.evict(keep=digest)
+        return path
+
+    def pin(self, digest, owner):
+        """
+        Protect a stored object from eviction until unpin(digest, owner) is called by this process.
+        :param digest: digest of object (see make_digest).
+        :param owner: what the object is pinned for (i.e., the path it is bind-mounted at).
+        :return: None; raises FileNotFoundError if the object is no longer stored.
+        """
+        with closing(self._connect()) as conn:
+            conn.execute("BEGIN IMMEDIATE") # evict() cannot remove the object between the check and the pin
+            try:
+                stored = bool(conn.execute("SELECT 1 FROM blobs WHERE digest = ?", (digest,)).fetchone()) \
+                    and os.path.exists(self.blob_path(digest))
+                if stored:
+                    conn.execute("INSERT INTO pins VALUES (?, ?, ?)", (digest, os.getpid(), owner))
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        if not stored:
+            raise FileNotFoundError(errno.ENOENT, "cached object was evicted", self.blob_path(digest))
+        return
+
+    def unpin(self, digest, owner):
+        """
+        Release a pin taken by pin().
+        :return: None
+        """
+        with closing(self._connect()) as conn:
+            conn.execute("DELETE FROM pins WHERE digest = ? AND pid = ? AND owner = ?", (digest, os.getpid(), owner))
+        return
+
+    def _pinned_digests(self, conn):
+        """
+        Digests pinned by running processes; pins left by processes that exited are removed.
+        """
+        pinned = set()
+        for digest, pid in conn.execute("SELECT digest, pid FROM pins").fetchall():
+            if process_is_running(pid):
+                pinned.add(digest)
+            else:
+                conn.execute("DELETE FROM pins WHERE pid = ?", (pid,))
+        return pinned
+
+    def evict(self, keep=None):
+        """
+        Remove least recently used objects until the cache is within its budget; pinned objects are kept.
+        :param keep: digest of an object that must not be evicted (i.e., one that was just added).
+        :return: number of bytes evicted.
+        """
+        evicted = 0
+        with closing(self._connect()) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()[0]
+                if total > self.max_bytes:
+                    pinned = self._pinned_digests(conn)
+                    for digest, size in conn.execute("SELECT digest, size FROM blobs WHERE digest IS NOT ? ORDER BY last_access",
+                                                     (keep,)).fetchall():
+                        if digest in pinned:
+                            continue
+                        if total - evicted <= self.max_bytes:
+                            break
+                        for fp in (self.blob_path(digest), self.lock_path(digest)):
+                            try:
+                                os.remove(fp)
+                            except FileNotFoundError:
+                                pass
+                        conn.execute("DELETE FROM blobs WHERE digest = ?", (digest,))
+                        evicted += size
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        return evicted
+
+    def retain(self, src_fp, bucket, key, etag, move=False):
+        """
+        Store a file just uploaded to s3://bucket/key and register it as the current version of that object.
+        :param src_fp: path to uploaded file.
+        :param etag: ETag s3 returned for the upload.
+        :param move: if True, src_fp is moved into the cache (when on the same filesystem) instead of copied.
+        :return: path to stored object.
+        """
+        fd, tmp_fp = tempfile.mkstemp(dir=self.tmp_dir)
+        os.close(fd)
+        try:
+            moved = False
+            if move:
+                try:
+                    os.replace(src_fp, tmp_fp)
+                    moved = True
+                except OSError as e:
+                    if e.errno != errno.EXDEV:
+                        raise
+            if not moved: # copy, or src_fp is on another filesystem
+                shutil.copyfile(src_fp, tmp_fp)
+            path = self.add(make_digest(bucket, key, etag), tmp_fp, bucket, key, etag)
+        finally:
+            if os.path.exists(tmp_fp):
+                os.remove(tmp_fp)
+        with closing(self._connect()) as conn:
+            conn.execute("INSERT OR REPLACE INTO uploads VALUES (?, ?, ?)", (bucket, key, normalize_etag(etag)))
+        return path
+
+    def lookup_upload(self, bucket, key):
+        """
+        :return: ETag of the last upload to s3://bucket/key registered with retain(), or None.
+        """
+        with closing(self._connect()) as conn:
+            row = conn.execute("SELECT etag FROM uploads WHERE bucket = ? AND key = ?", (bucket, key)).fetchone()
+        return row[0] if row else None
+
+    def forget_uploads(self, bucket, prefix=""):
+        """
+        Unregister uploads under s3://bucket/prefix; called when those objects are deleted from s3.
+        :return: None
+        """
+        with closing(self._connect()) as conn:
+            conn.execute("DELETE FROM uploads WHERE bucket = ? AND substr(key, 1, ?) = ?", (bucket, len(prefix), prefix))
+        return
+
+    def size(self):
+        with closing(self._connect()) as conn:
+            return conn.execute("SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()[0]
+
+    def get(self, job_config, bucket, key, etag=None, variant=None):
+        """
+        Fetch the path to the cached copy of s3://bucket/key, downloading it first if needed. Concurrent callers
+        missing the same object (in any process on this host) wait for a single download instead of repeating it.
+        :param job_config: MorfJobConfig object.
+        :param bucket: name of s3 bucket.
+        :param key: object key.
+        :param etag: ETag of the current version of the object; if None, it is looked up in this process's bucket
+        catalogs or with a HEAD request.
+        :param variant: GUNZIP to fetch the decompressed contents of a gzip object instead of the object itself.
+        :return: path to cached object; must be treated as read-only.
+        """
+        if etag is None:
+            etag = resolve_object_etag(job_config, bucket, key)
+        digest = make_digest(bucket, key, etag, variant)
+        path = self.lookup(digest)
+        if path:
+            return path
+        with file_lock(self.lock_path(digest)):
+            path = self.lookup(digest) # another caller may have filled it while we waited for the lock
+            if path:
+                return path
+            fd, tmp_fp = tempfile.mkstemp(dir=self.tmp_dir)
+            os.close(fd)
+            try:
+                if variant == GUNZIP:
+                    source_path = self.lookup(make_digest(bucket, key, etag))
+                    if source_path: # decompress the cached object
+                        with open(source_path, "rb") as f_in:
+                            gunzip_to_file(f_in, tmp_fp)
+                    else: # decompress while downloading; the compressed object is not kept
+                        download_s3_object_gunzip(job_config, bucket, key, tmp_fp)
+                elif variant:
+                    raise ValueError("unknown cache variant {}".format(variant))
+                else:
+                    download_s3_object(job_config, bucket, key, tmp_fp)
+                return self.add(digest, tmp_fp, bucket, key, etag)
+            finally:
+                if os.path.exists(tmp_fp):
+                    os.remove(tmp_fp)
+
+    def materialize(self, path, dest_fp, staging_mode="copy", allow_bind=False):
+        """
+        Place cached object at path at dest_fp.
+        :param staging_mode: "copy" to copy the object; "link" to reflink or hardlink it, falling back to a
+        read-only bind mount if allow_bind, or to a copy, when dest_fp is on another filesystem.
+        :param allow_bind: True if dest_fp is only read inside a container, so it may be bind-mounted instead.
+        :return: method used to place the object; one of {copy, reflink, hardlink, bind}.
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(dest_fp)), exist_ok=True)
+        if staging_mode == "link":
+            try:
+                reflink(path, dest_fp)
+                return "reflink"
+            except OSError:
+                pass
+            try:
+                os.link(path, dest_fp)
+                return "hardlink"
+            except OSError as e:
+                if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                    raise
+            if allow_bind:
+                dest_fp = os.path.abspath(dest_fp)
+                self.pin(os.path.basename(path), dest_fp) # released by pop_bind_mounts once the container exits
+                open(dest_fp, "w").close() # mount point for the bind mount
+                with _bind_mounts_lock:
+                    _bind_mounts[dest_fp] = (self, path)
+                return "bind"
+        shutil.copyfile(path, dest_fp)
+        return "copy"
+
+
+def reflink(src_fp, dest_fp):
+    """
+    Create dest_fp as a copy-on-write clone of src_fp; raises OSError if the filesystem does not support it.
+    """
+    with open(src_fp, "rb") as f_src, open(dest_fp, "wb") as f_dest:
+        try:
+            fcntl.ioctl(f_dest.fileno(), FICLONE, f_src.fileno())
+            return
+        except OSError:
+            pass
+    os.remove(dest_fp)
+    raise OSError(errno.EOPNOTSUPP, "reflink not supported", dest_fp)
+
+
+def process_is_running(pid):
+    """
+    :return: True if a process with pid exists.
+    """
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError: # exists, but belongs to another user
+        return True
+    return True
+
+
+def list_bind_mounts(input_dir):
+    """
+    Fetch the bind mounts registered by this process for files in input_dir.
+    :param input_dir: host directory mounted as /input in the container.
+    :return: list of (cached object path, path relative to input_dir) tuples.
+    """
+    input_dir = os.path.abspath(input_dir)
+    with _bind_mounts_lock:
+        return [(_bind_mounts[x][1], os.path.relpath(x, input_dir))
+                for x in sorted(_bind_mounts) if x.startswith(input_dir + os.sep)]
+
+
+def pop_bind_mounts(input_dir):
+    """
+    Remove the bind mounts registered by this process for files in input_dir and unpin their cached objects; called
+    when the container using them has exited, or when the task fails before running it.
+    :param input_dir: host directory mounted as /input in the container.
+    :return: list of (cached object path, path relative to input_dir) tuples.
+    """
+    input_dir = os.path.abspath(input_dir)
+    with _bind_mounts_lock:
+        dest_fps = [x for x in sorted(_bind_mounts) if x.startswith(input_dir + os.sep)]
+        mounts = [(x, _bind_mounts.pop(x)) for x in dest_fps]
+    for dest_fp, (cache, path) in mounts:
+        cache.unpin(os.path.basename(path), dest_fp)
+    return [(path, os.path.relpath(dest_fp, input_dir)) for dest_fp, (cache, path) in mounts]
+
+
+def resolve_object_etag(job_config, bucket, key):
+    """
+    Fetch the ETag of the current version of s3://bucket/key, from a loaded bucket catalog if possible.
+    :return: ETag (string).
+    """
+    catalog_object = lookup_catalog_object(bucket, key)
+    if catalog_object:
+        return catalog_object[1]
+    cache = get_content_cache(job_config)
+    uploaded_etag = cache.lookup_upload(bucket, key) if cache and getattr(job_config, "write_through", False) else None
+    if uploaded_etag:
+        return uploaded_etag
+    return job_config.initialize_s3().head_object(Bucket=bucket, Key=key)["ETag"].strip('"')
+
+
+def get_content_cache(job_config):
+    """
+    Fetch this process's ContentCache for job_config.cache_dir, limited to job_config.cache_size_gb.
+    :param job_config: MorfJobConfig object.
+    :return: ContentCache, or None if job_config has no cache_dir.
+    """
+    cache_dir = getattr(job_config, "cache_dir", None)
+    if not cache_dir:
+        return None
+    with _content_caches_lock:
+        cache = _content_caches.get(cache_dir)
+        if cache is None:
+            cache = ContentCache(cache_dir, int(getattr(job_config, "cache_size_gb", DEFAULT_CACHE_SIZE_GB) * GB))
+            _content_caches[cache_dir] = cache
+    return cache
+
+
+def fetch_cached_object(job_config, bucket, key, dest_fp, etag=None, decompress=False, allow_bind=False, staging_mode=None):
+    """
+    Place s3://bucket/key at dest_fp via the content cache of job_config, using job_config.staging_mode.
+    :param job_config: MorfJobConfig object.
+    :param etag: ETag of object, if known.
+    :param decompress: if True, object is gzip data; its decompressed contents (cached separately) are placed at dest_fp.
+    :param allow_bind: True if dest_fp is only read inside a container; see ContentCache.materialize.
+    :param staging_mode: overrides job_config.staging_mode; use "copy" if the caller may modify dest_fp.
+    :return: dest_fp
+    """
+    logger = set_logger_handlers(module_logger, job_config)
+    cache = get_content_cache(job_config)
+    staging_mode = staging_mode or getattr(job_config, "staging_mode", "copy")
+    for attempt in range(2): # object may be evicted by another process between get() and reading it
+        path = cache.get(job_config, bucket, key, etag, variant=GUNZIP if decompress else None)
+        try:
+            cache.materialize(path, dest_fp, staging_mode, allow_bind)
+            report_staged_bytes(os.path.getsize(path))
+            return dest_fp
+        except FileNotFoundError:
+            logger.warning("cached copy of s3://{}/{} was evicted while in use; fetching again".format(bucket, key))
+    raise IOError("could not fetch s3://{}/{} from cache".format(bucket, key))
+
+
+def warm_cached_object(job_config, bucket, key, etag=None):
+    """
+    Fetch s3://bucket/key into the content cache of job_config without placing it anywhere.
+    :param etag: ETag of object, if known.
+    :return: path to cached object.
+    """
+    path = get_content_cache(job_config).get(job_config, bucket, key, etag)
+    report_staged_bytes(os.path.getsize(path))
+    return path
+
+
+def retain_uploaded_file(job_config, file, bucket, key, move=False):
+    """
+    Keep a copy of a file just uploaded to s3://bucket/key in the content cache if job_config.write_through is set.
+    Failures are logged and otherwise ignored, since the object is already safely in s3.
+    :param job_config: MorfJobConfig object.
+    :param file: path to uploaded file.
+    :param move: if True, file may be moved into the cache instead of copied; it no longer exists afterward.
+    :return: path to cached object, or None if it was not retained.
+    """
+    cache = get_content_cache(job_config)
+    if not cache or not getattr(job_config, "write_through", False):
+        return None
+    logger = set_logger_handlers(module_logger, job_config)
+    try:
+        etag = job_config.initialize_s3().head_object(Bucket=bucket, Key=key)["ETag"]
+        return cache.retain(file, bucket, key, etag, move=move)
+    except Exception as e:
+        logger.warning("could not keep local copy of s3://{}/{}: {}".format(bucket, key, e))
+        return None
+
+
+def fetch_retained_object(job_config, bucket, key, dest_fp):
+    """
+    Copy s3://bucket/key to dest_fp from the content cache if it was uploaded from this host with write_through set.
+    :param job_config: MorfJobConfig object.
+    :return: dest_fp, or None if the object was not retained.
+    """
+    cache = get_content_cache(job_config)
+    if not cache or not getattr(job_config, "write_through", False):
+        return None
+    etag = cache.lookup_upload(bucket, key)
+    if not etag:
+        return None
+    try:
+        return fetch_cached_object(job_config, bucket, key, dest_fp, etag, staging_mode="copy")
+    except Exception as e:
+        logger = set_logger_handlers(module_logger, job_config)
+        logger.warning("could not copy s3://{}/{} from local cache: {}".format(bucket, key, e))
+        return None
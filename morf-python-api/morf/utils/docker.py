@@ -25,10 +25,21 @@ Note: functions for working with docker cloud are located in morf.utils.caching
 """
 
 
+import json
+import time
+from contextlib import contextmanager
 from morf.utils import *
+from morf.utils.content_cache import list_bind_mounts
+from morf.utils.locking import file_lock
+from morf.utils.log import execute_and_log_output
+from morf.utils.artifacts import artifact_md5
 
 module_logger = logging.getLogger(__name__)
 
+DOCKER_IMAGES_DIR_NAME = "docker-images"
+REGISTRY_FILENAME = "registry.json"
+DEFAULT_DOCKER_IMAGE_CACHE_SIZE = 0 # number of images no running job uses that are kept loaded on a host
+
 
 
 def load_docker_image(dir, job_config, logger, image_name = "docker_image"):
@@ -54,6 +65,148 @@ def load_docker_image(dir, job_config, logger, image_name = "docker_image"):
     return image_uuid
 
 
+def docker_image_exists(job_config, image_uuid):
+    """
+    Check whether image_uuid is loaded in the local docker daemon.
+    :param job_config: MorfJobConfig object.
+    :param image_uuid: SHA256 or tag name of image.
+    :return: True if the image exists.
+    """
+    cmd = "{} image inspect {}".format(job_config.docker_exec, image_uuid)
+    return subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, shell=True).returncode == 0
+
+
+def make_docker_images_dir(job_config):
+    """
+    Directory holding the registry of docker images loaded on this host; shared by every MORF job on the host.
+    """
+    return os.path.join(job_config.local_working_directory, DOCKER_IMAGES_DIR_NAME)
+
+
+@contextmanager
+def docker_image_registry(job_config):
+    """
+    Hold the lock on the host's docker image registry and yield it as a dict, writing any changes back on exit.
+    The registry maps the md5 of each loaded image file to
+    {"image": image_uuid, "refs": {morf_id: number of running tasks of that job using the image}, "last_used": time}.
+    :param job_config: MorfJobConfig object.
+    :return: dict registry.
+    """
+    registry_fp = os.path.join(make_docker_images_dir(job_config), REGISTRY_FILENAME)
+    with file_lock(registry_fp + ".lock"):
+        registry = dict()
+        if os.path.exists(registry_fp):
+            with open(registry_fp) as f:
+                registry = json.load(f)
+        yield registry
+        with open(registry_fp + ".tmp", "w") as f:
+            json.dump(registry, f)
+        os.replace(registry_fp + ".tmp", registry_fp)
+
+
+def _digest_lock(job_config, digest):
+    # held while an image is loaded or removed, so each image is loaded once per host
+    return file_lock(os.path.join(make_docker_images_dir(job_config), "{}.lock".format(digest)))
+
+
+def acquire_docker_image(job_config, image_fp, logger):
+    """
+    Load the docker image in image_fp unless an identical image is already loaded on this host, and count a
+    reference to it for job_config's job. Every call must be matched by a call to release_docker_image().
+    :param job_config: MorfJobConfig object.
+    :param image_fp: path to docker image file.
+    :param logger: Logger to log output to.
+    :return: (digest, image_uuid) tuple.
+    """
+    digest = artifact_md5(job_config, image_fp)
+    with _digest_lock(job_config, digest):
+        with docker_image_registry(job_config) as registry:
+            entry = registry.get(digest)
+        if entry and docker_image_exists(job_config, entry["image"]):
+            image_uuid = entry["image"]
+            logger.info("using docker image {} already loaded from {}".format(image_uuid, digest))
+        else:
+            image_uuid = load_docker_image(os.path.dirname(image_fp), job_config, logger, os.path.basename(image_fp))
+        with docker_image_registry(job_config) as registry:
+            entry = registry.setdefault(digest, {"image": image_uuid, "refs": {}})
+            entry["image"] = image_uuid
+            entry["refs"][job_config.morf_id] = entry["refs"].get(job_config.morf_id, 0) + 1
+            entry["last_used"] = time.time()
+    return digest, image_uuid
+
+
+def release_docker_image(job_config, digest):
+    """
+    Drop a reference to the image with digest taken by acquire_docker_image(). The image stays loaded until
+    job_config's job ends (see remove_job_docker_images()).
+    :param job_config: MorfJobConfig object.
+    :param digest: digest returned by acquire_docker_image().
+    :return: None
+    """
+    with docker_image_registry(job_config) as registry:
+        entry = registry.get(digest)
+        if entry and entry["refs"].get(job_config.morf_id, 0) > 1:
+            entry["refs"][job_config.morf_id] -= 1
+        elif entry: # keep the job's key so the image is not evicted while the job is still running
+            entry["refs"][job_config.morf_id] = 0
+        if entry:
+            entry["last_used"] = time.time()
+    return
+
+
+@contextmanager
+def registered_docker_image(job_config, image_fp, logger):
+    """
+    Use the docker image in image_fp for the duration of the with block, loading it only if needed.
+    :param job_config: MorfJobConfig object.
+    :param image_fp: path to docker image file.
+    :param logger: Logger to log output to.
+    :return: SHA256 or tag name of loaded docker image.
+    """
+    digest, image_uuid = acquire_docker_image(job_config, image_fp, logger)
+    try:
+        yield image_uuid
+    finally:
+        release_docker_image(job_config, digest)
+
+
+def evict_docker_images(job_config, logger, keep=DEFAULT_DOCKER_IMAGE_CACHE_SIZE):
+    """
+    Remove the least recently used images that no running job holds, leaving at most keep of them loaded.
+    :param job_config: MorfJobConfig object.
+    :param logger: Logger to log output to.
+    :param keep: number of unused images to leave loaded.
+    :return: list of removed image digests.
+    """
+    with docker_image_registry(job_config) as registry:
+        unused = sorted((entry.get("last_used", 0), digest) for digest, entry in registry.items() if not entry["refs"])
+    removed = list()
+    for _, digest in unused[:max(len(unused) - keep, 0)]:
+        with _digest_lock(job_config, digest):
+            with docker_image_registry(job_config) as registry:
+                entry = registry.get(digest)
+                if entry is None or entry["refs"]: # in use again since it was selected
+                    continue
+                del registry[digest]
+            execute_and_log_output("{} rmi --force {}".format(job_config.docker_exec, entry["image"]), logger)
+            removed.append(digest)
+    return removed
+
+
+def remove_job_docker_images(job_config, logger):
+    """
+    Drop every reference job_config's job holds on docker images, then remove images no other job is using,
+    keeping the most recently used job_config.docker_image_cache_size of them loaded for later jobs.
+    :param job_config: MorfJobConfig object.
+    :param logger: Logger to log output to.
+    :return: list of removed image digests.
+    """
+    with docker_image_registry(job_config) as registry:
+        for entry in registry.values():
+            entry["refs"].pop(job_config.morf_id, None)
+    return evict_docker_images(job_config, logger, keep=getattr(job_config, "docker_image_cache_size", DEFAULT_DOCKER_IMAGE_CACHE_SIZE))
+
+
 def make_docker_image_name(job_config, course, session, mode, prefix="MORF"):
     """
     Create a uniqe name for the current job_config
@@ -71,8 +224,14 @@ def make_docker_run_command(job_config, docker_exec, input_dir, output_dir, imag
     :return:
     """
     image_name = make_docker_image_name(job_config, course, session, mode)
-    cmd = "{} run --name {} --network=\"none\" --rm=true --volume={}:/input --volume={}:/output {} --course {} --session {} --mode {}".format(
-        docker_exec, image_name, input_dir, output_dir, image_uuid, course, session, mode)
+    # cached files that could not be linked into input_dir are mounted read-only over their placeholders; they stay
+    # pinned in the cache until the caller calls pop_bind_mounts after the container exits
+    cache_mounts = "".join(" --volume={}:/input/{}:ro".format(src, rel_path) for src, rel_path in list_bind_mounts(input_dir))
+    # with link staging, input files may be hardlinks of cached objects; containers run as root, which ignores the
+    # objects' read-only file mode, so /input itself is mounted read-only
+    input_options = ":ro" if getattr(job_config, "staging_mode", "copy") == "link" else ""
+    cmd = "{} run --name {} --network=\"none\" --rm=true --volume={}:/input{}{} --volume={}:/output {} --course {} --session {} --mode {}".format(
+        docker_exec, image_name, input_dir, input_options, cache_mounts, output_dir, image_uuid, course, session, mode)
     if client_args:# add any additional client args to cmd
         for argname, argval in client_args.items():
             cmd += " --{} {}".format(argname, argval)
@@ -0,0 +1,103 @@
+# Copyright (c) 2018 The Regents of the University of Michigan
+# and the University of Pennsylvania
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""
+Partitioned store of collected feature files.
+
+When session-level extraction results are collected into one feature file for all courses and sessions, the file is
+also split into one csv per course and session, stored next to the session's extraction results, together with an index
+listing every partition (see morf.utils.api_utils.partition_collected_features). Train and test staging then fetch
+only the partition of their session, from s3 or the content cache, instead of the whole feature file. Jobs collected
+before partitioning existed have no index and fall back to filtering the whole file; forking a job (see
+morf.workflow.extract.fork_features) partitions its features again for the new job.
+"""
+
+import json
+import logging
+import os
+from botocore.exceptions import ClientError
+from morf.utils.content_cache import get_content_cache, fetch_cached_object
+from morf.utils.log import set_logger_handlers
+from morf.utils.s3interface import make_s3_key_path
+from morf.utils.staging import download_s3_object
+
+module_logger = logging.getLogger(__name__)
+
+FEATURE_INDEX_SUFFIX = "features-index.json"
+
+
+def make_feature_index_key(job_config, mode=None):
+    """
+    Key of the feature partition index for job_config's job and mode.
+    :param mode: mode of the collected features (i.e., extract or extract-holdout); defaults to job_config.mode.
+    :return: key (string).
+    """
+    mode = mode or job_config.mode
+    filename = "-".join([job_config.user_id, job_config.job_id, mode, FEATURE_INDEX_SUFFIX])
+    return make_s3_key_path(job_config, filename=filename, mode=mode)
+
+
+def fetch_feature_index(job_config, mode=None):
+    """
+    Fetch the feature partition index for job_config's job and mode.
+    :return: dict with "columns" and "partitions" ({course: {session: {"key": key, "rows": n}}}), or None if the
+    collected features of mode were not partitioned.
+    """
+    bucket = job_config.proc_data_bucket
+    key = make_feature_index_key(job_config, mode)
+    try:
+        cache = get_content_cache(job_config)
+        if cache:
+            with open(cache.get(job_config, bucket, key)) as f:
+                return json.load(f)
+        return json.loads(job_config.initialize_s3().get_object(Bucket=bucket, Key=key)["Body"].read().decode("utf-8"))
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ("404", "NoSuchKey"):
+            return None
+        raise
+
+
+def fetch_feature_partition(job_config, course, session, mode, dest_fp):
+    """
+    Place the features of one course and session, as collected for mode, at dest_fp.
+    :param job_config: MorfJobConfig object.
+    :param mode: mode of the collected features (i.e., extract or extract-holdout).
+    :param dest_fp: path to write partition csv to.
+    :return: dest_fp, or None if the collected features were not partitioned (the caller should filter the whole file).
+    """
+    logger = set_logger_handlers(module_logger, job_config)
+    index = fetch_feature_index(job_config, mode)
+    if index is None:
+        return None
+    os.makedirs(os.path.dirname(os.path.abspath(dest_fp)), exist_ok=True)
+    partition = index["partitions"].get(course, {}).get(session)
+    if partition is None: # no features were collected for this session
+        logger.warning("no {} features for course {} session {}".format(mode, course, session))
+        with open(dest_fp, "w") as f:
+            f.write(",".join(index["columns"]) + "\n")
+        return dest_fp
+    logger.info("fetching {} features for course {} session {} from s3://{}/{}".format(
+        mode, course, session, job_config.proc_data_bucket, partition["key"]))
+    if get_content_cache(job_config):
+        return fetch_cached_object(job_config, job_config.proc_data_bucket, partition["key"], dest_fp)
+    download_s3_object(job_config, job_config.proc_data_bucket, partition["key"], dest_fp)
+    return dest_fp
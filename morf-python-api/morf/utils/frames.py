@@ -0,0 +1,326 @@
+# Copyright (c) 2018 The Regents of the University of Michigan
+# and the University of Pennsylvania
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""
+Reading and writing of data frames kept on the host between workflow steps (i.e., partitions of label files).
+
+Frames are stored as parquet when pyarrow is installed (pip install morf-api[parquet]), and otherwise as pickled
+pandas frames; both keep column types and are read much faster than csv.
+
+Intermediate files passed between workflow steps through s3 (collected features, cv folds, labels, and predictions)
+are csv by default; setting intermediate_format = parquet in the job config stores them as compressed parquet
+with typed columns instead. Files read or written by docker images are always csv.
+
+Frames joined on the host (i.e., features and labels when creating folds, predictions and labels when evaluating)
+are made lean before joining: numeric columns are downcast, course and session columns become categorical, and
+user IDs are replaced by integer codes from a dictionary shared by the whole job, decoded only when written out.
+"""
+
+import os
+import threading
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow # optional; enables parquet
+    PARQUET_AVAILABLE = True
+except ImportError:
+    PARQUET_AVAILABLE = False
+
+PARQUET = "parquet"
+PICKLE = "pickle"
+FRAME_FORMATS = (PARQUET, PICKLE)
+DEFAULT_FRAME_FORMAT = PARQUET if PARQUET_AVAILABLE else PICKLE
+FRAME_EXTENSIONS = {PARQUET: ".parquet", PICKLE: ".pkl"}
+CSV = "csv"
+INTERMEDIATE_FORMATS = (CSV, PARQUET)
+DEFAULT_INTERMEDIATE_FORMAT = CSV
+CATEGORICAL_COLUMNS = ("course", "session")
+USER_ID_COL = "userID"
+MISSING_CODE = -1
+
+# user ID dictionaries of this process, keyed by morf_id; see get_user_id_dictionary
+_user_id_dictionaries = {}
+_user_id_dictionaries_lock = threading.Lock()
+
+
+def frame_format_from_path(fp):
+    """
+    Infer the format of a frame file from its extension.
+    :param fp: path to file.
+    :return: one of FRAME_FORMATS.
+    """
+    for fmt, extension in FRAME_EXTENSIONS.items():
+        if fp.endswith(extension):
+            return fmt
+    raise ValueError("unknown frame format for {}".format(fp))
+
+
+def write_frame(df, fp, fmt=None):
+    """
+    Write df to fp, replacing any existing file atomically.
+    :param df: pandas.DataFrame.
+    :param fp: path to file.
+    :param fmt: one of FRAME_FORMATS; inferred from the extension of fp if None.
+    :return: fp
+    """
+    fmt = fmt or frame_format_from_path(fp)
+    tmp_fp = "{}.tmp-{}".format(fp, os.getpid())
+    if fmt == PARQUET:
+        df.to_parquet(tmp_fp, index=False, compression="snappy")
+    elif fmt == PICKLE:
+        df.reset_index(drop=True).to_pickle(tmp_fp)
+    else:
+        raise ValueError("unknown frame format {}".format(fmt))
+    os.replace(tmp_fp, fp)
+    return fp
+
+
+def read_frame(fp, fmt=None, columns=None):
+    """
+    Read a frame written by write_frame.
+    :param fp: path to file.
+    :param fmt: one of FRAME_FORMATS; inferred from the extension of fp if None.
+    :param columns: list of columns to read; all columns if None.
+    :return: pandas.DataFrame.
+    """
+    fmt = fmt or frame_format_from_path(fp)
+    if fmt == PARQUET:
+        return pd.read_parquet(fp, columns=columns)
+    df = pd.read_pickle(fp)
+    return df[columns] if columns is not None else df
+
+
+def intermediate_extension(job_config):
+    """
+    Extension (without leading dot) of intermediate files for job_config.
+    :param job_config: MorfJobConfig object.
+    :return: one of INTERMEDIATE_FORMATS.
+    """
+    return getattr(job_config, "intermediate_format", DEFAULT_INTERMEDIATE_FORMAT)
+
+
+def make_intermediate_filename(job_config, csv_filename):
+    """
+    Name of the intermediate file for job_config corresponding to csv_filename (i.e., a fold file name).
+    :param job_config: MorfJobConfig object.
+    :param csv_filename: name of file ending in .csv.
+    :return: csv_filename with its extension replaced by intermediate_extension(job_config).
+    """
+    return "{}.{}".format(os.path.splitext(csv_filename)[0], intermediate_extension(job_config))
+
+
+def _lossless_numeric(col):
+    """
+    Convert a column of strings to numbers, only if every value is written back exactly as it was read.
+    :return: numeric pandas.Series, or None if any value would change (i.e., "007", "1e3", or non-numeric).
+    """
+    values = col.dropna()
+    if len(values) == 0:
+        return None
+    try:
+        numeric = pd.to_numeric(values)
+    except (ValueError, TypeError):
+        return None
+    if not pd.api.types.is_numeric_dtype(numeric) or pd.api.types.is_bool_dtype(numeric) \
+            or not (numeric.astype(str) == values.astype(str)).all():
+        return None
+    if pd.api.types.is_integer_dtype(numeric) and len(values) < len(col):
+        return numeric.reindex(col.index).astype("Int64")
+    return numeric.reindex(col.index)
+
+
+def apply_typed_schema(df, skip_columns=()):
+    """
+    Give every column of strings (i.e., as read from csv with dtype=object) that holds only numbers a numeric type,
+    so it is stored compactly; values are unchanged when read back with as_string_frame.
+    :param df: pandas.DataFrame.
+    :param skip_columns: columns to leave as they are.
+    :return: pandas.DataFrame with numeric columns converted.
+    """
+    df = df.reset_index(drop=True)
+    for column in df.columns:
+        if column in skip_columns or isinstance(df[column].dtype, pd.CategoricalDtype):
+            continue
+        if pd.api.types.is_object_dtype(df[column]) or pd.api.types.is_string_dtype(df[column]):
+            numeric = _lossless_numeric(df[column])
+            if numeric is not None:
+                df[column] = numeric
+    return df
+
+
+def as_string_frame(df):
+    """
+    Convert every column of df to strings, with missing values as NaN, matching pd.read_csv(dtype=object).
+    :param df: pandas.DataFrame.
+    :return: pandas.DataFrame with object columns.
+    """
+    return pd.DataFrame({column: pd.Series([str(x) if not pd.isna(x) else np.nan for x in df[column]],
+                                           index=df.index, dtype=object)
+                         for column in df.columns}, index=df.index, columns=df.columns)
+
+
+def write_intermediate(df, fp):
+    """
+    Write an intermediate file in the format given by the extension of fp.
+    :param df: pandas.DataFrame.
+    :param fp: path to file ending in .csv or .parquet.
+    :return: fp
+    """
+    if fp.endswith(".csv"):
+        df.to_csv(fp, index=False, header=True)
+        return fp
+    return write_frame(apply_typed_schema(df), fp)
+
+
+def read_intermediate(fp, dtype=None):
+    """
+    Read an intermediate file written by write_intermediate (or any csv file).
+    :param fp: path to file ending in .csv or .parquet.
+    :param dtype: object to read every column as strings, as pd.read_csv(fp, dtype=object) does; None to infer types.
+    :return: pandas.DataFrame.
+    """
+    if fp.endswith(".csv"):
+        return pd.read_csv(fp, dtype=dtype)
+    df = read_frame(fp)
+    if dtype is object:
+        return as_string_frame(df)
+    for column in df.columns: # columns stored as strings to keep their exact values; infer types as read_csv would
+        if pd.api.types.is_object_dtype(df[column]) or pd.api.types.is_string_dtype(df[column]):
+            try:
+                df[column] = pd.to_numeric(df[column])
+            except (ValueError, TypeError):
+                continue
+    return df
+
+
+class UserIdDictionary:
+    """
+    Mapping of user IDs to int32 codes, assigned in order of first appearance; codes from one dictionary can be
+    joined on wherever the IDs could be. Missing IDs are encoded as MISSING_CODE.
+    """
+
+    def __init__(self):
+        self.ids = pd.Index([], dtype=object)
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def encode(self, values):
+        """
+        Encode user IDs, adding any not seen before to the dictionary.
+        :param values: sequence of user IDs; compared as strings, so IDs read as numbers match the same IDs read as strings.
+        :return: numpy.ndarray of int32 codes.
+        """
+        values = pd.Series(values, dtype=object)
+        missing = values.isna().values
+        keys = pd.Index(values[~missing].astype(str), dtype=object)
+        with self.lock:
+            codes = self.ids.get_indexer(keys)
+            if (codes == MISSING_CODE).any():
+                self.ids = self.ids.append(keys[codes == MISSING_CODE].unique())
+                codes = self.ids.get_indexer(keys)
+        encoded = np.full(len(values), MISSING_CODE, dtype=np.int32)
+        encoded[~missing] = codes
+        return encoded
+
+    def decode(self, codes):
+        """
+        Decode codes returned by encode.
+        :param codes: sequence of int codes.
+        :return: numpy.ndarray of user ID strings, with NaN for missing IDs.
+        """
+        codes = np.asarray(codes)
+        decoded = np.full(len(codes), np.nan, dtype=object)
+        present = codes != MISSING_CODE
+        decoded[present] = self.ids.values[codes[present]]
+        return decoded
+
+
+def get_user_id_dictionary(job_config):
+    """
+    Fetch the user ID dictionary of job_config in this process, shared by every frame the job joins in it.
+    :param job_config: MorfJobConfig object.
+    :return: UserIdDictionary
+    """
+    with _user_id_dictionaries_lock:
+        return _user_id_dictionaries.setdefault(job_config.morf_id, UserIdDictionary())
+
+
+def make_lean_frame(df, user_ids=None, user_id_col=USER_ID_COL, categorical_columns=CATEGORICAL_COLUMNS, keep_columns=()):
+    """
+    Reduce the memory used by df (i.e., as read with dtype=object) before it is joined: encode user IDs, make
+    categorical_columns categorical, and give every other column holding only numbers the smallest type that keeps
+    its values (integers are downcast; floats stay float64 so they are written back exactly).
+    :param df: pandas.DataFrame.
+    :param user_ids: UserIdDictionary to encode user_id_col with; user IDs are left as they are if None.
+    :param user_id_col: column containing user IDs.
+    :param categorical_columns: columns with few distinct values (i.e., course and session).
+    :param keep_columns: columns to leave as they are.
+    :return: pandas.DataFrame with the same columns and values as df.
+    """
+    categorical_columns = [c for c in categorical_columns if c in df.columns and c not in keep_columns]
+    skip_columns = set(categorical_columns) | set(keep_columns)
+    if user_ids is not None and user_id_col in df.columns:
+        skip_columns.add(user_id_col)
+    df = apply_typed_schema(df, skip_columns=skip_columns)
+    for column in df.columns:
+        if column == user_id_col and user_ids is not None:
+            df[column] = user_ids.encode(df[column])
+        elif column in categorical_columns:
+            df[column] = df[column].astype("category")
+        elif column not in keep_columns and pd.api.types.is_integer_dtype(df[column]):
+            df[column] = pd.to_numeric(df[column], downcast="integer")
+    return df
+
+
+def align_categories(frames, columns=CATEGORICAL_COLUMNS):
+    """
+    Give the categorical columns of frames the same categories, so frames can be joined on them without copying
+    them to objects.
+    :param frames: list of pandas.DataFrame made by make_lean_frame; modified in place.
+    :param columns: categorical columns to align; columns missing from any frame are skipped.
+    :return: None
+    """
+    for column in columns:
+        if not all(column in df.columns for df in frames):
+            continue
+        categories = pd.Index([], dtype=object)
+        for df in frames:
+            categories = categories.union(pd.Index(df[column].astype("category").cat.categories, dtype=object), sort=False)
+        for df in frames:
+            df[column] = df[column].astype(pd.CategoricalDtype(categories))
+    return
+
+
+def restore_user_ids(df, user_ids, user_id_col=USER_ID_COL):
+    """
+    Decode the user IDs of a frame made by make_lean_frame, before it is written out.
+    :param df: pandas.DataFrame.
+    :param user_ids: UserIdDictionary the frame was encoded with.
+    :param user_id_col: column containing user ID codes.
+    :return: copy of df with user IDs decoded.
+    """
+    df = df.copy()
+    df[user_id_col] = user_ids.decode(df[user_id_col].values)
+    return df
@@ -27,11 +27,19 @@ import os
 import tempfile
 
 from morf.utils import *
+from morf.utils.artifacts import fetch_artifact
 from morf.utils.alerts import send_success_email, send_email_alert
 from morf.utils.caching import update_raw_data_cache, cache_to_docker_hub
+from morf.utils.catalog import refresh_bucket_catalogs
+from morf.utils.content_cache import pop_bind_mounts
 from morf.utils.s3interface import sync_s3_job_cache
 from morf.utils.log import set_logger_handlers, execute_and_log_output
-from morf.utils.docker import load_docker_image, make_docker_run_command
+from morf.utils.job_state import get_job_state, make_job_state_fp, make_task_id, task_is_complete, job_task, untracked_task
+from morf.utils.memo import make_result_fingerprint, make_task_fingerprint, restore_memoized_result, \
+    store_memoized_result, UPSTREAM_MODES, LABEL_FILES
+from morf.utils.metrics import s3_metrics_context, clear_s3_metrics, report_s3_metrics
+from morf.utils.prewarm import CacheWarmer
+from morf.utils.docker import load_docker_image, make_docker_run_command, registered_docker_image, remove_job_docker_images
 from morf.utils.doi import upload_files_to_zenodo
 module_logger = logging.getLogger(__name__)
 
@@ -52,36 +60,69 @@ def run_image(job_config, raw_data_bucket, course=None, session=None, level=None
     """
     logger = set_logger_handlers(module_logger, job_config)
     s3 = job_config.initialize_s3()
-    # create local directory for processing on this instance
-    with tempfile.TemporaryDirectory(dir=job_config.local_working_directory) as working_dir:
-        try:
-            fetch_file(s3, working_dir, job_config.docker_url, dest_filename="docker_image")
-        except Exception as e:
-            logger.error("[ERROR] Error downloading file {} to {}".format(job_config.docker_url, working_dir))
-        input_dir, output_dir = initialize_input_output_dirs(working_dir)
-        # fetch any data or models needed
-        if "extract" in job_config.mode:  # download raw data
-            initialize_raw_course_data(job_config,
-                                       raw_data_bucket=raw_data_bucket, mode=job_config.mode, course=course,
-                                       session=session, level=level, input_dir=input_dir)
-            job_config.mode = "extract" # sets mode to "extract" in case of "extract-holdout"
-        # fetch training/testing data
-        if job_config.mode in ["train", "test"]:
-            sync_s3_job_cache(job_config)
-            initialize_train_test_data(job_config, raw_data_bucket=raw_data_bucket, level=level,
-                                       label_type=label_type, course=course, session=session,
-                                       input_dir=input_dir)
-        if job_config.mode == "test":  # fetch models and untar
-            download_models(job_config, course=course, session=session, dest_dir=input_dir, level=level)
-        image_uuid = load_docker_image(dir=working_dir, job_config=job_config, logger=logger)
-        # build docker run command and execute the image
-        cmd = make_docker_run_command(job_config, job_config.docker_exec, input_dir, output_dir, image_uuid, course, session, job_config.mode, client_args=job_config.client_args)
-        execute_and_log_output(cmd, logger)
-        # cleanup
-        execute_and_log_output("{} rmi --force {}".format(job_config.docker_exec, image_uuid), logger)
-        # archive and write output
-        archive_file = make_output_archive_file(output_dir, job_config, course = course, session = session)
-        move_results_to_destination(archive_file, job_config, course = course, session = session)
+    # count s3 requests made for this task against its stage, course, and session
+    with s3_metrics_context(job_config, stage=job_config.mode, course=course, session=session):
+        # create local directory for processing on this instance
+        with tempfile.TemporaryDirectory(dir=job_config.local_working_directory) as working_dir:
+            try:
+                fetch_artifact(job_config, job_config.docker_url, working_dir, dest_filename="docker_image")
+            except Exception as e:
+                logger.error("[ERROR] Error downloading file {} to {}".format(job_config.docker_url, working_dir))
+            input_dir, output_dir = initialize_input_output_dirs(working_dir)
+            image_fp = os.path.join(working_dir, "docker_image")
+            task_id = make_task_id(job_config.mode, level, course, session, label_type)
+            resume = getattr(job_config, "resume", False)
+            memoize = "extract" in job_config.mode and getattr(job_config, "memoize_results", False)
+            # fingerprint the task's inputs only when resuming or memoizing, since fingerprints cost s3 requests;
+            # with resume set, tasks completed by an earlier run with the same inputs are skipped
+            if resume or memoize:
+                if "extract" in job_config.mode:
+                    fingerprint = make_result_fingerprint(job_config, image_fp, raw_data_bucket, level, course, session)
+                else:
+                    fingerprint = make_task_fingerprint(job_config, {"task": task_id}, image_fp,
+                                                        upstream_modes=UPSTREAM_MODES.get(job_config.mode, ()),
+                                                        label_files=LABEL_FILES.get(job_config.mode, ()))
+                # every task uploads a result archive; a task recorded without one did not complete
+                if resume and task_is_complete(job_config, task_id, fingerprint, require_outputs=True):
+                    logger.info("task {} was completed by an earlier run of this job; skipping".format(task_id))
+                    return
+                task_context = job_task(job_config, task_id, fingerprint, require_outputs=True)
+            else:
+                task_context = untracked_task(job_config, task_id)
+            try:
+                with task_context as task:
+                    # reuse the result of an identical extraction by any earlier job instead of running the image again
+                    if memoize and restore_memoized_result(job_config, fingerprint, course, session, mode="extract"):
+                        return
+                    # fetch any data or models needed
+                    if "extract" in job_config.mode:  # download raw data
+                        initialize_raw_course_data(job_config,
+                                                   raw_data_bucket=raw_data_bucket, mode=job_config.mode, course=course,
+                                                   session=session, level=level, input_dir=input_dir)
+                        job_config.mode = "extract" # sets mode to "extract" in case of "extract-holdout"
+                    # fetch training/testing data
+                    if job_config.mode in ["train", "test"]:
+                        sync_s3_job_cache(job_config)
+                        initialize_train_test_data(job_config, raw_data_bucket=raw_data_bucket, level=level,
+                                                   label_type=label_type, course=course, session=session,
+                                                   input_dir=input_dir)
+                    if job_config.mode == "test":  # fetch models and untar
+                        download_models(job_config, course=course, session=session, dest_dir=input_dir, level=level)
+                    # the image is loaded once per host and removed when the job ends
+                    with registered_docker_image(job_config, image_fp, logger) as image_uuid:
+                        # build docker run command and execute the image
+                        cmd = make_docker_run_command(job_config, job_config.docker_exec, input_dir, output_dir, image_uuid, course, session, job_config.mode, client_args=job_config.client_args)
+                        returncode = execute_and_log_output(cmd, logger)
+                    if returncode:
+                        task.fail("docker run exited with status {}".format(returncode))
+                    # archive and write output
+                    archive_file = make_output_archive_file(output_dir, job_config, course = course, session = session)
+                    move_results_to_destination(archive_file, job_config, course = course, session = session)
+                    if memoize and not task.error:
+                        store_memoized_result(job_config, fingerprint, course, session)
+            finally:
+                # release cached objects bind-mounted into the container, also if the task failed before running it
+                pop_bind_mounts(input_dir)
     return
 
 
@@ -104,29 +145,49 @@ def run_morf_job(job_config, no_cache = False, no_morf_cache = False):
         # copy config file into new directory
         shutil.copy(combined_config_filename, working_dir)
         os.chdir(working_dir)
-        # from job_config, fetch and download the following: docker image, controller script, cached config file
-        if not no_morf_cache:
-            update_raw_data_cache(job_config)
-        # from client.config, fetch and download the following: docker image, controller script
+        warmer = None
         try:
-            fetch_file(s3, working_dir, job_config.docker_url, dest_filename=docker_image_name, job_config=job_config)
-            fetch_file(s3, working_dir, job_config.controller_url, dest_filename=controller_script_name, job_config=job_config)
-            if not no_cache: # cache job files in s3 unless no_cache parameter set to true
-                cache_job_file_in_s3(job_config, filename = docker_image_name)
-                cache_job_file_in_s3(job_config, filename = controller_script_name)
-        except KeyError as e:
-            cause = e.args[0]
-            logger.error("[Error]: field {} missing from client.config file.".format(cause))
-            sys.exit(-1)
-        # change working directory and run controller script with notifications for initialization and completion
-        job_config.update_status("INITIALIZED")
-        send_email_alert(job_config)
-        subprocess.call("python3 {}".format(controller_script_name), shell = True)
-        job_config.update_status("SUCCESS")
-        # push image to docker cloud, create doi for job files in zenodo, and send success email
-        docker_cloud_path = cache_to_docker_hub(job_config, working_dir, docker_image_name)
-        setattr(job_config, "docker_cloud_path", docker_cloud_path)
-        zenodo_deposition_id = upload_files_to_zenodo(job_config, upload_files=(job_config.controller_url, job_config.client_config_url))
-        setattr(job_config, "zenodo_deposition_id", zenodo_deposition_id)
-        send_success_email(job_config)
-        return
+            # list raw data buckets once for the whole job; later course/session queries are answered from this snapshot
+            clear_s3_metrics(job_config)
+            refresh_bucket_catalogs(job_config)
+            # from job_config, fetch and download the following: docker image, controller script, cached config file
+            if not no_morf_cache:
+                update_raw_data_cache(job_config)
+            # while this job runs, fetch the inputs of jobs queued behind it on this host
+            if getattr(job_config, "prewarm_queue_dir", None) and not no_morf_cache:
+                warmer = CacheWarmer(job_config.prewarm_queue_dir, budget_gb=job_config.prewarm_budget_gb)
+                warmer.start()
+            # from client.config, fetch and download the following: docker image, controller script
+            try:
+                # fills the host's artifact cache, from which every task of the job links the image
+                fetch_artifact(job_config, job_config.docker_url, working_dir, dest_filename=docker_image_name)
+                fetch_artifact(job_config, job_config.controller_url, working_dir, dest_filename=controller_script_name)
+                if not no_cache: # cache job files in s3 unless no_cache parameter set to true
+                    cache_job_file_in_s3(job_config, filename = docker_image_name)
+                    cache_job_file_in_s3(job_config, filename = controller_script_name)
+            except KeyError as e:
+                cause = e.args[0]
+                logger.error("[Error]: field {} missing from client.config file.".format(cause))
+                sys.exit(-1)
+            # change working directory and run controller script with notifications for initialization and completion
+            job_config.update_status("INITIALIZED")
+            send_email_alert(job_config)
+            subprocess.call("python3 {}".format(controller_script_name), shell = True)
+            if os.path.exists(make_job_state_fp(job_config)):
+                logger.info("task status for job {}: {}".format(job_config.morf_id, get_job_state(job_config).summary()))
+            job_config.update_status("SUCCESS")
+            # summarize s3 usage of every process in the job and store it next to the job results
+            metrics_fp = report_s3_metrics(job_config)
+            upload_file_to_s3(metrics_fp, job_config.proc_data_bucket, "/".join([job_config.user_id, job_config.job_id, os.path.basename(metrics_fp)]), job_config)
+            # push image to docker cloud, create doi for job files in zenodo, and send success email
+            docker_cloud_path = cache_to_docker_hub(job_config, working_dir, docker_image_name)
+            setattr(job_config, "docker_cloud_path", docker_cloud_path)
+            zenodo_deposition_id = upload_files_to_zenodo(job_config, upload_files=(job_config.controller_url, job_config.client_config_url))
+            setattr(job_config, "zenodo_deposition_id", zenodo_deposition_id)
+            send_success_email(job_config)
+            return
+        finally:
+            if warmer:
+                warmer.stop()
+            # drop the job's references on docker images also if the job failed or exited early, so they can be evicted
+            remove_job_docker_images(job_config, logger)
@@ -0,0 +1,258 @@
+# Copyright (c) 2018 The Regents of the University of Michigan
+# and the University of Pennsylvania
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""
+Local record of the tasks of a MORF job, used to resume a job after a partial failure.
+
+Every task (a run_image call, or the creation or evaluation of a cross-validation fold) records its inputs fingerprint,
+the s3 objects it uploaded with their ETags, and whether it succeeded, in a SQLite file kept on the host per
+user_id/job_id. With resume = true, a re-run of the job keeps its existing results in s3 and skips every task that
+completed with the same inputs fingerprint and whose outputs are still in s3; only missing, failed, or stale tasks run.
+"""
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from contextlib import closing, contextmanager
+from botocore.exceptions import ClientError
+from morf.utils.log import set_logger_handlers
+
+module_logger = logging.getLogger(__name__)
+
+JOB_STATE_DIR_NAME = "job-state"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+# state stores already opened by this process, keyed by path
+_job_states = {}
+_job_states_lock = threading.Lock()
+# s3 objects uploaded by the task running in this process, as [(bucket, key)]; None when no task is running
+_task_outputs = None
+# TaskRun of the task running in this process; None when no task is running
+_task_run = None
+
+
+class JobState:
+    """
+    Status, inputs fingerprint, and outputs of each task of a job, stored in a SQLite file shared by all processes of
+    the job on this host.
+    """
+
+    def __init__(self, db_fp):
+        """
+        :param db_fp: path to SQLite file; created if it does not exist.
+        """
+        self.db_fp = db_fp
+        os.makedirs(os.path.dirname(db_fp), exist_ok=True)
+        with closing(self._connect()) as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS tasks (task_id TEXT PRIMARY KEY, mode TEXT, fingerprint TEXT, "
+                         "status TEXT, outputs TEXT, error TEXT, updated REAL)")
+
+    def _connect(self):
+        return sqlite3.connect(self.db_fp, timeout=60, isolation_level=None)
+
+    def get(self, task_id):
+        """
+        :return: dict with the fingerprint, status, outputs ([bucket, key, etag] lists), and error of task_id, or None.
+        """
+        with closing(self._connect()) as conn:
+            row = conn.execute("SELECT fingerprint, status, outputs, error FROM tasks WHERE task_id = ?", (task_id,)).fetchone()
+        if not row:
+            return None
+        return {"fingerprint": row[0], "status": row[1], "outputs": json.loads(row[2] or "[]"), "error": row[3]}
+
+    def update(self, task_id, mode, fingerprint, status, outputs=(), error=None):
+        with closing(self._connect()) as conn:
+            conn.execute("INSERT OR REPLACE INTO tasks VALUES (?, ?, ?, ?, ?, ?, ?)",
+                         (task_id, mode, fingerprint, status, json.dumps(list(outputs)), error, time.time()))
+        return
+
+    def forget(self, mode):
+        """
+        Remove the records of every task of mode; called when the results of mode are cleared from s3.
+        :return: None
+        """
+        with closing(self._connect()) as conn:
+            conn.execute("DELETE FROM tasks WHERE mode = ?", (mode,))
+        return
+
+    def summary(self):
+        """
+        :return: dict of {status: number of tasks}.
+        """
+        with closing(self._connect()) as conn:
+            return dict(conn.execute("SELECT status, COUNT(*) FROM tasks GROUP BY status").fetchall())
+
+
+def make_job_state_fp(job_config):
+    return os.path.join(job_config.local_working_directory, JOB_STATE_DIR_NAME,
+                        "{}-{}.sqlite".format(job_config.user_id, job_config.job_id))
+
+
+def get_job_state(job_config):
+    """
+    Fetch this process's JobState for the user_id and job_id of job_config.
+    :param job_config: MorfJobConfig object.
+    :return: JobState
+    """
+    db_fp = make_job_state_fp(job_config)
+    with _job_states_lock:
+        job_state = _job_states.get(db_fp)
+        if job_state is None:
+            job_state = JobState(db_fp)
+            _job_states[db_fp] = job_state
+    return job_state
+
+
+def make_task_id(mode, level=None, course=None, session=None, *args):
+    """
+    Identifier of a task within a job, i.e. "extract/session/course/001".
+    :param args: any further parameters distinguishing the task (i.e., a fold number).
+    :return: task id (string).
+    """
+    return "/".join(str(x) for x in (mode, level, course, session) + args if x is not None)
+
+
+def record_task_output(bucket, key):
+    """
+    Add s3://bucket/key to the outputs of the task running in this process, if any.
+    :return: None
+    """
+    if _task_outputs is not None:
+        _task_outputs.append((bucket, key))
+    return
+
+
+def record_task_failure(error):
+    """
+    Record the task running in this process, if any, as failed when it finishes (i.e., because an upload failed).
+    :param error: description of the failure (string).
+    :return: None
+    """
+    if _task_run is not None:
+        _task_run.fail(error)
+    return
+
+
+def task_is_complete(job_config, task_id, fingerprint, require_outputs=False):
+    """
+    Check whether task_id completed in an earlier run with the same inputs and all of its outputs are unchanged in s3.
+    :param job_config: MorfJobConfig object.
+    :param task_id: task id from make_task_id().
+    :param fingerprint: fingerprint of the task's current inputs.
+    :param require_outputs: if True, a task that recorded no outputs is not complete.
+    :return: boolean
+    """
+    record = get_job_state(job_config).get(task_id)
+    if not record or record["status"] != DONE or record["fingerprint"] != fingerprint:
+        return False
+    if require_outputs and not record["outputs"]:
+        return False
+    s3 = job_config.initialize_s3()
+    for bucket, key, etag in record["outputs"]:
+        try:
+            if s3.head_object(Bucket=bucket, Key=key)["ETag"].strip('"') != etag:
+                return False
+        except ClientError:
+            return False
+    return True
+
+
+class TaskRun:
+    """
+    Handle for a running task; see job_task().
+    """
+
+    def __init__(self):
+        self.error = None
+
+    def fail(self, error):
+        """
+        Record the task as failed when it finishes, even though it did not raise an exception.
+        :param error: description of the failure (string).
+        """
+        self.error = error
+
+
+@contextmanager
+def job_task(job_config, task_id, fingerprint, require_outputs=False):
+    """
+    Record the status and outputs of the task run inside the block. Uploads made by this process during the block are
+    recorded as the task's outputs (see record_task_output), and failed uploads fail the task (see record_task_failure).
+    :param job_config: MorfJobConfig object.
+    :param task_id: task id from make_task_id().
+    :param fingerprint: fingerprint of the task's inputs.
+    :param require_outputs: if True, the task fails unless it uploads at least one output (i.e., its result archive).
+    :return: yields a TaskRun.
+    """
+    global _task_outputs, _task_run
+    logger = set_logger_handlers(module_logger, job_config)
+    job_state = get_job_state(job_config)
+    mode = task_id.split("/")[0]
+    job_state.update(task_id, mode, fingerprint, RUNNING)
+    task_run = TaskRun()
+    previous_outputs, _task_outputs = _task_outputs, []
+    previous_run, _task_run = _task_run, task_run
+    try:
+        yield task_run
+    except BaseException as e:
+        job_state.update(task_id, mode, fingerprint, FAILED, error=repr(e))
+        raise
+    else:
+        outputs = list()
+        s3 = job_config.initialize_s3()
+        for bucket, key in _task_outputs:
+            try:
+                outputs.append((bucket, key, s3.head_object(Bucket=bucket, Key=key)["ETag"].strip('"')))
+            except ClientError as ce:
+                task_run.fail("output s3://{}/{} is missing: {}".format(bucket, key, ce))
+        if require_outputs and not outputs and not task_run.error:
+            task_run.fail("task uploaded no outputs")
+        status = FAILED if task_run.error else DONE
+        if task_run.error:
+            logger.warning("task {} failed: {}".format(task_id, task_run.error))
+        job_state.update(task_id, mode, fingerprint, status, outputs, task_run.error)
+    finally:
+        _task_outputs = previous_outputs
+        _task_run = previous_run
+
+
+@contextmanager
+def untracked_task(job_config, task_id):
+    """
+    Run a task without recording it in the job state, for jobs that neither resume nor memoize results; yields a
+    TaskRun like job_task() so callers can fail the task the same way.
+    :param job_config: MorfJobConfig object.
+    :param task_id: task id from make_task_id(), used in log messages.
+    :return: yields a TaskRun.
+    """
+    logger = set_logger_handlers(module_logger, job_config)
+    task_run = TaskRun()
+    yield task_run
+    if task_run.error:
+        logger.warning("task {} failed: {}".format(task_id, task_run.error))
+    return
@@ -0,0 +1,335 @@
+# Copyright (c) 2018 The Regents of the University of Michigan
+# and the University of Pennsylvania
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""
+Partitioned index of the labels files (labels-train.csv, labels-test.csv) shared by all courses in a data bucket.
+
+Each version of a labels file (identified by its ETag) is read once per host and split into one frame per course,
+session, and label type (see morf.utils.frames), so fetching the labels of a session reads only that session's rows.
+Indexes are kept in job_config.cache_dir/labels, or in local_working_directory/labels for jobs without a cache.
+
+With shared_labels = true, workflows that fan tasks out over a multiprocessing Pool instead load each labels file once
+in the parent process into a SharedLabelTable, which the pool's workers read in place (see label_sharing_pool).
+"""
+
+import json
+import logging
+import os
+import shutil
+import tempfile
+from contextlib import contextmanager
+from multiprocessing import Pool
+from urllib.parse import quote
+import numpy as np
+import pandas as pd
+from morf.utils.content_cache import get_content_cache, resolve_object_etag
+from morf.utils.frames import DEFAULT_FRAME_FORMAT, FRAME_EXTENSIONS, read_frame, write_frame
+from morf.utils.locking import file_lock
+from morf.utils.log import set_logger_handlers
+from morf.utils.staging import download_s3_object
+
+module_logger = logging.getLogger(__name__)
+
+LABEL_INDEX_DIR_NAME = "labels"
+MANIFEST_FILENAME = "manifest.json"
+PARTITION_COLUMNS = ("course", "session", "label_type")
+
+# shared label tables registered in this process, keyed by (bucket, key) of their labels file
+_shared_label_tables = {}
+
+
+class LabelIndex:
+    """
+    Labels of one version of a labels file, partitioned by course, session, and label type.
+    """
+
+    def __init__(self, index_dir):
+        """
+        :param index_dir: directory of a built index (see build_label_index).
+        """
+        self.index_dir = index_dir
+        with open(os.path.join(index_dir, MANIFEST_FILENAME)) as f:
+            manifest = json.load(f)
+        self.columns = manifest["columns"]
+        self.format = manifest["format"]
+
+    def partition_path(self, course, session, label_type):
+        return make_partition_path(self.index_dir, course, session, label_type, self.format)
+
+    def lookup(self, course, session, label_type):
+        """
+        Fetch the labels of one course, session, and label type, without the partitioning columns.
+        :return: pandas.DataFrame; empty (with the labels file's columns) if there are no matching labels.
+        """
+        partition_fp = self.partition_path(course, session, label_type)
+        if not os.path.exists(partition_fp):
+            return pd.DataFrame(columns=self.columns, dtype=object)
+        return read_frame(partition_fp, self.format)
+
+
+def make_partition_path(index_dir, course, session, label_type, fmt):
+    # course, session, and label type are quoted so any value is a single path component
+    return os.path.join(index_dir, quote(str(course), safe=""), quote(str(session), safe=""),
+                        quote(str(label_type), safe="") + FRAME_EXTENSIONS[fmt])
+
+
+def build_label_index(labels_csv_fp, index_dir, fmt=DEFAULT_FRAME_FORMAT):
+    """
+    Split a labels file into one frame per course, session, and label type in index_dir. The index is built in a
+    temporary directory and renamed into place, so readers never see a partial index.
+    :param labels_csv_fp: path to labels csv with course, session, and label_type columns.
+    :param index_dir: directory to create; must not exist.
+    :param fmt: frame format for partitions (see morf.utils.frames).
+    :return: LabelIndex
+    """
+    parent_dir = os.path.dirname(index_dir)
+    os.makedirs(parent_dir, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(dir=parent_dir)
+    try:
+        df = pd.read_csv(labels_csv_fp, dtype=object)
+        columns = [c for c in df.columns if c not in PARTITION_COLUMNS]
+        for (course, session, label_type), partition_df in df.groupby(list(PARTITION_COLUMNS), sort=False):
+            partition_fp = make_partition_path(tmp_dir, course, session, label_type, fmt)
+            os.makedirs(os.path.dirname(partition_fp), exist_ok=True)
+            write_frame(partition_df[columns], partition_fp, fmt)
+        with open(os.path.join(tmp_dir, MANIFEST_FILENAME), "w") as f:
+            json.dump({"columns": columns, "format": fmt, "rows": len(df)}, f)
+        os.rename(tmp_dir, index_dir)
+    except Exception:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+    return LabelIndex(index_dir)
+
+
+def make_label_index_root(job_config):
+    return os.path.join(getattr(job_config, "cache_dir", None) or job_config.local_working_directory, LABEL_INDEX_DIR_NAME)
+
+
+def get_label_index(job_config, bucket, key, use_cache=True):
+    """
+    Fetch the index of the current version of labels file s3://bucket/key, building it first if no process on this
+    host has indexed that version yet.
+    :param job_config: MorfJobConfig object.
+    :param bucket: bucket containing labels file.
+    :param key: key of labels file (i.e., morf-data/labels-train.csv).
+    :param use_cache: if True, the labels file is read from the content cache when job_config has one.
+    :return: LabelIndex
+    """
+    logger = set_logger_handlers(module_logger, job_config)
+    etag = resolve_object_etag(job_config, bucket, key)
+    root = make_label_index_root(job_config)
+    index_dir = os.path.join(root, etag.strip('"'))
+    if os.path.exists(os.path.join(index_dir, MANIFEST_FILENAME)):
+        return LabelIndex(index_dir)
+    with file_lock(index_dir + ".lock"):
+        if os.path.exists(os.path.join(index_dir, MANIFEST_FILENAME)): # built while we waited for the lock
+            return LabelIndex(index_dir)
+        logger.info("indexing labels file s3://{}/{}".format(bucket, key))
+        with open_labels_file(job_config, bucket, key, etag, use_cache) as labels_csv_fp:
+            return build_label_index(labels_csv_fp, index_dir)
+
+
+@contextmanager
+def open_labels_file(job_config, bucket, key, etag=None, use_cache=True):
+    """
+    Make a local copy of labels file s3://bucket/key available for the duration of the with block.
+    :param job_config: MorfJobConfig object.
+    :param etag: ETag of the labels file, if known.
+    :param use_cache: if True, the labels file is read from the content cache when job_config has one.
+    :return: path to labels csv; must be treated as read-only.
+    """
+    cache = get_content_cache(job_config) if use_cache else None
+    if cache:
+        yield cache.get(job_config, bucket, key, etag)
+        return
+    root = make_label_index_root(job_config)
+    os.makedirs(root, exist_ok=True)
+    with tempfile.TemporaryDirectory(dir=root) as download_dir:
+        labels_csv_fp = os.path.join(download_dir, os.path.basename(key))
+        download_s3_object(job_config, bucket, key, labels_csv_fp)
+        yield labels_csv_fp
+
+
+class SharedLabelTable:
+    """
+    Read-only labels table in one shared memory segment, so the processes of a pool read a single copy of it.
+
+    Every column is dictionary-encoded: rows hold int32 codes (-1 for missing values), and the distinct values of each
+    column are stored once as utf-8 bytes with their offsets. Rows are sorted by course, session, and label type, so
+    each partition is a contiguous slice. Pickling a table sends only the name and layout of its segment; the
+    receiving process attaches to the segment instead of copying it.
+    """
+
+    def __init__(self, handle):
+        """
+        Attach to the segment described by handle (see SharedLabelTable.create).
+        :param handle: dict with the segment name, array layout, columns, and partition offsets.
+        """
+        self.handle = handle
+        self.columns = handle["columns"]
+        self.partitions = handle["partitions"]
+        self.shm = _attach_shared_memory(handle["name"])
+        self.arrays = {name: np.ndarray(shape, dtype=dtype, buffer=self.shm.buf, offset=offset)
+                       for name, (offset, dtype, shape) in handle["arrays"].items()}
+        self.codes = self.arrays["codes"]
+
+    @classmethod
+    def create(cls, df):
+        """
+        Copy a labels frame into a new shared memory segment. The caller owns the segment and must unlink() it.
+        :param df: pandas.DataFrame with course, session, and label_type columns.
+        :return: SharedLabelTable
+        """
+        df = df.sort_values(list(PARTITION_COLUMNS), kind="stable").reset_index(drop=True)
+        columns = [c for c in df.columns if c not in PARTITION_COLUMNS]
+        partitions = dict()
+        keys = df[list(PARTITION_COLUMNS)].astype(str).itertuples(index=False, name=None)
+        for i, partition_key in enumerate(keys):
+            start, _ = partitions.get(partition_key, (i, i))
+            partitions[partition_key] = (start, i + 1)
+        arrays = {"codes": np.empty((len(df), len(columns)), dtype=np.int32)}
+        for j, column in enumerate(columns):
+            codes, uniques = pd.factorize(df[column])
+            arrays["codes"][:, j] = codes
+            encoded = [str(x).encode("utf-8") for x in uniques]
+            arrays["offsets-{}".format(j)] = np.cumsum([0] + [len(x) for x in encoded], dtype=np.int64)
+            arrays["values-{}".format(j)] = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+        layout = dict()
+        size = 0
+        for name, array in arrays.items():
+            layout[name] = (size, array.dtype.str, array.shape)
+            size += -(-array.nbytes // 8) * 8 # keep every array 8-byte aligned
+        from multiprocessing import shared_memory # python >= 3.8; see shared_memory_available
+        shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        for name, array in arrays.items():
+            offset, dtype, shape = layout[name]
+            np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=offset)[...] = array
+        handle = {"name": shm.name, "arrays": layout, "columns": columns, "partitions": partitions}
+        shm.close()
+        return cls(handle)
+
+    def __getstate__(self):
+        return self.handle
+
+    def __setstate__(self, handle):
+        self.__init__(handle)
+
+    def decode(self, j, codes):
+        """
+        Decode codes of column j into an object array of strings, with NaN for missing values.
+        """
+        offsets, values = self.arrays["offsets-{}".format(j)], self.arrays["values-{}".format(j)]
+        distinct, inverse = np.unique(codes, return_inverse=True)
+        decoded = np.array([np.nan if c < 0 else values[offsets[c]:offsets[c + 1]].tobytes().decode("utf-8")
+                            for c in distinct], dtype=object)
+        return decoded[inverse.reshape(-1)]
+
+    def lookup(self, course, session, label_type):
+        """
+        Fetch the labels of one course, session, and label type, without the partitioning columns.
+        :return: pandas.DataFrame; empty (with the table's columns) if there are no matching labels.
+        """
+        start, stop = self.partitions.get((str(course), str(session), str(label_type)), (0, 0))
+        codes = self.codes[start:stop]
+        if not len(codes):
+            return pd.DataFrame(columns=self.columns, dtype=object)
+        return pd.DataFrame({column: self.decode(j, codes[:, j]) for j, column in enumerate(self.columns)},
+                            columns=self.columns, dtype=object)
+
+    def close(self):
+        self.arrays = self.codes = None
+        self.shm.close()
+
+    def unlink(self):
+        self.close()
+        self.shm.unlink()
+
+
+def shared_memory_available():
+    """
+    Check whether label tables can be shared; multiprocessing.shared_memory exists only on python >= 3.8.
+    :return: boolean
+    """
+    try:
+        from multiprocessing import shared_memory
+    except ImportError:
+        return False
+    return True
+
+
+def _attach_shared_memory(name):
+    from multiprocessing import shared_memory
+    try: # python >= 3.13; segments are owned, and unlinked, by the process that created them
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        return shared_memory.SharedMemory(name=name)
+
+
+def register_shared_label_tables(tables):
+    """
+    Answer label lookups in this process from shared tables; used as the initializer of pool workers.
+    :param tables: dict of {(bucket, key): SharedLabelTable}.
+    :return: None
+    """
+    _shared_label_tables.update(tables)
+    return
+
+
+def get_shared_label_table(bucket, key):
+    """
+    Fetch the shared table registered in this process for labels file s3://bucket/key.
+    :return: SharedLabelTable, or None if there is none.
+    """
+    return _shared_label_tables.get((bucket, key))
+
+
+@contextmanager
+def label_sharing_pool(job_config, bucket, keys, processes=None):
+    """
+    Create a multiprocessing Pool whose workers read labels files s3://bucket/key for each key from tables shared
+    with this process, if job_config.shared_labels is set; otherwise (or if a labels file does not exist) workers
+    read labels from the label index as usual, as they also do on python versions without shared memory. The tables
+    are removed when the pool exits.
+    :param job_config: MorfJobConfig object.
+    :param bucket: bucket containing labels files.
+    :param keys: keys of labels files (i.e., ["morf-data/labels-train.csv"]).
+    :param processes: number of worker processes.
+    :return: multiprocessing.Pool
+    """
+    logger = set_logger_handlers(module_logger, job_config)
+    tables = dict()
+    try:
+        if getattr(job_config, "shared_labels", False) and not shared_memory_available():
+            logger.warning("shared_labels requires python >= 3.8; pool workers will read labels from the label index")
+        elif getattr(job_config, "shared_labels", False):
+            for key in keys:
+                try:
+                    with open_labels_file(job_config, bucket, key) as labels_csv_fp:
+                        tables[(bucket, key)] = SharedLabelTable.create(pd.read_csv(labels_csv_fp, dtype=object))
+                    logger.info("sharing labels file s3://{}/{} with pool workers".format(bucket, key))
+                except Exception as e: # workers fall back to the label index
+                    logger.warning("not sharing labels file s3://{}/{}: {}".format(bucket, key, e))
+        with Pool(processes, initializer=register_shared_label_tables, initargs=(tables,)) as pool:
+            yield pool
+    finally:
+        for table in tables.values():
+            table.unlink()
@@ -135,7 +135,7 @@ def execute_and_log_output(command, logger):
     Execute command and log its output to logger.
     :param command:
     :param logger:
-    :return:
+    :return: exit status of command.
     """
     logger.info("running: " + command)
     command_ary = shlex.split(command)
@@ -145,4 +145,4 @@ def execute_and_log_output(command, logger):
         logger.info(stdout)
     if stderr:
         logger.error(stderr)
-    return
\ No newline at end of file
+    return p.returncode
\ No newline at end of file
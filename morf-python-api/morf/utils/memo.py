@@ -0,0 +1,158 @@
+# Copyright (c) 2018 The Regents of the University of Michigan
+# and the University of Pennsylvania
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""
+Fingerprints of MORF task inputs, and memoization of extraction results across MORF jobs.
+
+An extraction task's output depends only on the docker image, the controller, the task parameters (mode, level, course,
+session, and client args), and the raw data it reads. With memoize_results = true, run_image fingerprints these before
+staging any data. If an earlier job on the platform stored a result archive under the same fingerprint, it is copied
+server-side to the job's result key and the container is not run. Otherwise the task runs normally and its archive is
+copied into the memo store afterward.
+"""
+
+import hashlib
+import json
+import logging
+import os
+from botocore.exceptions import ClientError
+from morf.utils import fetch_raw_course_sessions, generate_archive_filename
+from morf.utils.job_state import record_task_output
+from morf.utils.catalog import get_bucket_catalog, list_bucket_objects, normalize_data_dir
+from morf.utils.log import set_logger_handlers
+from morf.utils.s3interface import copy_s3_objects, make_s3_key_path
+from morf.utils.artifacts import artifact_md5
+
+module_logger = logging.getLogger(__name__)
+
+MEMO_PREFIX = "morf-memo" # prefix in proc_data_bucket holding memoized result archives
+CONTROLLER_FILENAME = "controller.py"
+# results of earlier stages of the job read by tasks of each mode, and label files they read from raw data buckets
+UPSTREAM_MODES = {"train": ("extract",), "test": ("extract-holdout", "train"), "cv": ("extract", "extract-holdout")}
+LABEL_FILES = {"train": ("labels-train.csv",), "cv": ("labels-train.csv", "labels-test.csv")}
+
+
+def make_result_fingerprint(job_config, image_fp, raw_data_bucket, level, course=None, session=None,
+                            data_dir="morf-data/", course_date_file_name="coursera_course_dates.csv",
+                            controller_fp=CONTROLLER_FILENAME):
+    """
+    Fingerprint everything the output of an extract or extract-holdout task depends on.
+    :param job_config: MorfJobConfig object; its mode and client_args are included.
+    :param image_fp: path to docker image .tar file.
+    :param raw_data_bucket: raw data bucket(s), as passed to run_image.
+    :param level: level of task; one of {session, course, all}.
+    :param data_dir: directory in raw data buckets containing course-level directories.
+    :param controller_fp: path to the job's controller script; omitted from the fingerprint if it does not exist.
+    :return: fingerprint (hex string).
+    """
+    inputs = set()
+    for bucket, input_course, input_session in fetch_raw_course_sessions(job_config, raw_data_bucket, level, job_config.mode,
+                                                                          data_dir, course, session):
+        catalog = get_bucket_catalog(job_config, bucket, data_dir)
+        inputs.update((bucket, key, etag) for key, size, etag in catalog.session_objects(input_course, input_session))
+        dates_key = normalize_data_dir(data_dir) + course_date_file_name
+        inputs.add((bucket, dates_key, catalog.objects.get(dates_key, (None, None))[1]))
+    description = {"mode": job_config.mode, "level": level, "course": course, "session": session, "inputs": sorted(inputs)}
+    return hash_task_description(job_config, description, image_fp, controller_fp)
+
+
+def make_task_fingerprint(job_config, params, image_fp=None, upstream_modes=(), label_files=(), data_dir="morf-data/",
+                          controller_fp=CONTROLLER_FILENAME):
+    """
+    Fingerprint a task that reads results of earlier stages of the same job (i.e., train, test, or cross-validation).
+    :param job_config: MorfJobConfig object; its client_args are included.
+    :param params: dict of task parameters (i.e., mode, level, course, session, label_type).
+    :param image_fp: path to docker image .tar file run by the task, if any.
+    :param upstream_modes: modes whose results under the job's prefix in proc_data_bucket the task reads; a change to
+    any of them changes the fingerprint.
+    :param label_files: names of label files in data_dir of the raw data buckets the task reads.
+    :param data_dir: directory in raw data buckets containing course-level directories.
+    :param controller_fp: path to the job's controller script; omitted from the fingerprint if it does not exist.
+    :return: fingerprint (hex string).
+    """
+    s3 = job_config.initialize_s3()
+    upstream = list()
+    for mode in upstream_modes:
+        prefix = make_s3_key_path(job_config, mode=mode) + "/"
+        upstream.extend((obj["Key"], obj["ETag"].strip('"')) for obj in list_bucket_objects(s3, job_config.proc_data_bucket, prefix))
+    labels = list()
+    for bucket in job_config.raw_data_buckets:
+        catalog = get_bucket_catalog(job_config, bucket, data_dir)
+        for filename in label_files:
+            labels.append((bucket, filename, catalog.objects.get(normalize_data_dir(data_dir) + filename, (None, None))[1]))
+    description = {"params": params, "upstream": sorted(upstream), "labels": sorted(labels)}
+    return hash_task_description(job_config, description, image_fp, controller_fp)
+
+
+def hash_task_description(job_config, description, image_fp=None, controller_fp=CONTROLLER_FILENAME):
+    """
+    Combine a description of a task's parameters and inputs with its image, controller, and client args into a fingerprint.
+    :return: fingerprint (hex string).
+    """
+    description = dict(description,
+                       image=artifact_md5(job_config, image_fp) if image_fp else None,
+                       controller=artifact_md5(job_config, controller_fp) if os.path.exists(controller_fp) else None,
+                       client_args=sorted(getattr(job_config, "client_args", {}).items()))
+    return hashlib.sha256(json.dumps(description, sort_keys=True).encode()).hexdigest()
+
+
+def make_memo_key(fingerprint):
+    return "{}/{}.tgz".format(MEMO_PREFIX, fingerprint)
+
+
+def restore_memoized_result(job_config, fingerprint, course=None, session=None, mode=None):
+    """
+    Copy the result archive memoized under fingerprint, if any, to the result key of this task.
+    :param job_config: MorfJobConfig object.
+    :param fingerprint: fingerprint from make_result_fingerprint().
+    :param mode: mode under which the result is stored; defaults to job_config.mode.
+    :return: True if a memoized result was restored.
+    """
+    logger = set_logger_handlers(module_logger, job_config)
+    bucket = job_config.proc_data_bucket
+    memo_key = make_memo_key(fingerprint)
+    try:
+        job_config.initialize_s3().head_object(Bucket=bucket, Key=memo_key)
+    except ClientError as ce:
+        if ce.response["Error"]["Code"] not in ("404", "NoSuchKey"):
+            logger.warning("could not check for memoized result s3://{}/{}: {}".format(bucket, memo_key, ce))
+        return False
+    archive_file = generate_archive_filename(job_config, course=course, session=session, mode=mode)
+    key = make_s3_key_path(job_config, course=course, session=session, filename=archive_file, mode=mode)
+    logger.info("reusing memoized result s3://{}/{} for course {} session {}".format(bucket, memo_key, course, session))
+    if copy_s3_objects(job_config, bucket, [(memo_key, key)]):
+        return False
+    record_task_output(bucket, key)
+    return True
+
+
+def store_memoized_result(job_config, fingerprint, course=None, session=None):
+    """
+    Copy the result archive just uploaded for this task into the memo store under fingerprint.
+    :param job_config: MorfJobConfig object.
+    :param fingerprint: fingerprint from make_result_fingerprint().
+    :return: True if the result was stored.
+    """
+    bucket = job_config.proc_data_bucket
+    archive_file = generate_archive_filename(job_config, course=course, session=session)
+    key = make_s3_key_path(job_config, course=course, session=session, filename=archive_file)
+    return not copy_s3_objects(job_config, bucket, [(key, make_memo_key(fingerprint))])
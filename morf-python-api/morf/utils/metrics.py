@@ -0,0 +1,278 @@
+# Copyright (c) 2018 The Regents of the University of Michigan
+# and the University of Pennsylvania
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Accounting of s3 requests, bytes, and latency for a MORF job, broken down by workflow stage, course, and session.
+
+Every pooled s3 client reports each request it makes to this module. Each process keeps its own counts and writes
+them to a file when a task finishes (and at exit); report_s3_metrics() merges the files of all processes for a job.
+"""
+
+import atexit
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from morf.utils.log import set_logger_handlers
+
+module_logger = logging.getLogger(__name__)
+
+METRICS_DIR_NAME = "s3-metrics"
+METRICS_SUMMARY_FILENAME = "s3-metrics.json"
+LATENCY_BUCKETS_MS = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000) # upper bounds; last bucket is unbounded
+
+_metrics_lock = threading.Lock()
+_records = {} # {(stage, course, session, operation): record dict}
+_context = {"stage": None, "course": None, "session": None, "metrics_dir": None}
+_process_token = uuid.uuid4().hex
+_metrics_pid = os.getpid() # process the counts belong to; see check_s3_metrics_pid
+
+
+def reset_s3_metrics():
+    """
+    Discard this process's counts; called in child processes after a fork so parent requests are not counted twice.
+    :return: None
+    """
+    global _metrics_lock, _records, _process_token, _metrics_pid
+    _metrics_lock = threading.Lock()
+    _records = {}
+    _process_token = uuid.uuid4().hex
+    _metrics_pid = os.getpid()
+    return
+
+
+def check_s3_metrics_pid():
+    """
+    Discard counts inherited from a parent process; os.register_at_fork does this on python >= 3.7 only.
+    :return: None
+    """
+    if os.getpid() != _metrics_pid:
+        reset_s3_metrics()
+    return
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=reset_s3_metrics)
+
+
+def make_metrics_dir(job_config):
+    """
+    Directory holding the per-process metrics files for job; shared by every process running the job on this host.
+    """
+    return os.path.join(job_config.local_working_directory, METRICS_DIR_NAME, job_config.morf_id)
+
+
+def make_empty_record():
+    return {"requests": 0, "errors": 0, "bytes_in": 0, "bytes_out": 0, "latency_ms": 0.0,
+            "latency_histogram": [0] * (len(LATENCY_BUCKETS_MS) + 1)}
+
+
+def add_to_record(record, other):
+    for k in ("requests", "errors", "bytes_in", "bytes_out", "latency_ms"):
+        record[k] += other[k]
+    record["latency_histogram"] = [x + y for x, y in zip(record["latency_histogram"], other["latency_histogram"])]
+    return record
+
+
+def record_s3_request(operation, seconds, bytes_in=0, bytes_out=0, error=False):
+    """
+    Add one s3 request to this process's counts, attributed to the current stage, course, and session.
+    :param operation: s3 API operation name (i.e., "GetObject").
+    :param seconds: request latency.
+    :param bytes_in: bytes received in the response body.
+    :param bytes_out: bytes sent in the request body.
+    :param error: True if the request failed.
+    :return: None
+    """
+    latency_ms = seconds * 1000
+    bucket_ix = next((i for i, bound in enumerate(LATENCY_BUCKETS_MS) if latency_ms <= bound), len(LATENCY_BUCKETS_MS))
+    check_s3_metrics_pid()
+    key = (_context["stage"], _context["course"], _context["session"], operation)
+    with _metrics_lock:
+        record = _records.setdefault(key, make_empty_record())
+        record["requests"] += 1
+        record["errors"] += int(error)
+        record["bytes_in"] += bytes_in
+        record["bytes_out"] += bytes_out
+        record["latency_ms"] += latency_ms
+        record["latency_histogram"][bucket_ix] += 1
+    return
+
+
+def _body_size(body):
+    if body is None:
+        return 0
+    if isinstance(body, (bytes, bytearray, str)):
+        return len(body)
+    try:
+        position = body.tell()
+        size = body.seek(0, os.SEEK_END) - position
+        body.seek(position)
+        return size
+    except Exception:
+        return 0
+
+
+def _before_call(model, params, context, **kwargs):
+    context["morf_metrics"] = (model.name, time.time(), _body_size(params.get("body")))
+    return
+
+
+def _after_call(http_response, parsed, model, context, **kwargs):
+    operation, start, bytes_out = context.pop("morf_metrics", (model.name, time.time(), 0))
+    bytes_in = parsed.get("ContentLength", 0) if model.name == "GetObject" else 0
+    record_s3_request(operation, time.time() - start, bytes_in=bytes_in or 0, bytes_out=bytes_out,
+                      error=http_response.status_code >= 300)
+    return
+
+
+def _after_call_error(exception, context, **kwargs):
+    if "morf_metrics" in context:
+        operation, start, bytes_out = context.pop("morf_metrics")
+        record_s3_request(operation, time.time() - start, error=True)
+    return
+
+
+def register_s3_metrics(client):
+    """
+    Attach request accounting to a boto3 s3 client.
+    :param client: boto3.client object for s3 connection.
+    :return: client
+    """
+    client.meta.events.register("before-call.s3", _before_call)
+    client.meta.events.register("after-call.s3", _after_call)
+    client.meta.events.register("after-call-error.s3", _after_call_error)
+    return client
+
+
+def set_s3_metrics_context(job_config=None, stage=None, course=None, session=None):
+    """
+    Attribute subsequent s3 requests in this process to stage, course, and session.
+    :param job_config: MorfJobConfig object; sets where this process's counts are written.
+    :return: None
+    """
+    _context.update({"stage": stage, "course": course, "session": session})
+    if job_config is not None and hasattr(job_config, "local_working_directory"):
+        _context["metrics_dir"] = make_metrics_dir(job_config)
+    return
+
+
+@contextmanager
+def s3_metrics_context(job_config, stage=None, course=None, session=None):
+    """
+    Attribute s3 requests made inside the block to stage, course, and session, and write this process's counts
+    to disk when the block exits.
+    """
+    previous = dict(_context)
+    set_s3_metrics_context(job_config, stage, course, session)
+    try:
+        yield
+    finally:
+        flush_s3_metrics()
+        _context.update(previous)
+
+
+def flush_s3_metrics(metrics_dir=None):
+    """
+    Write this process's cumulative counts to its metrics file, replacing any earlier version.
+    :param metrics_dir: directory to write to; defaults to the directory of the last job_config set as context.
+    :return: None
+    """
+    check_s3_metrics_pid()
+    metrics_dir = metrics_dir or _context["metrics_dir"]
+    if not metrics_dir or not _records:
+        return
+    with _metrics_lock:
+        records = [dict(v, stage=k[0], course=k[1], session=k[2], operation=k[3]) for k, v in _records.items()]
+    os.makedirs(metrics_dir, exist_ok=True)
+    metrics_fp = os.path.join(metrics_dir, "{}-{}.json".format(os.getpid(), _process_token))
+    with open(metrics_fp + ".tmp", "w") as f:
+        json.dump(records, f)
+    os.replace(metrics_fp + ".tmp", metrics_fp)
+    return
+
+
+atexit.register(flush_s3_metrics)
+
+
+def clear_s3_metrics(job_config):
+    """
+    Remove metrics files from any earlier run of job_config on this host.
+    :return: None
+    """
+    shutil.rmtree(make_metrics_dir(job_config), ignore_errors=True)
+    return
+
+
+def summarize_s3_metrics(records):
+    """
+    Aggregate per-process records into totals by operation, by stage, and by course/session.
+    :param records: list of record dicts as written by flush_s3_metrics().
+    :return: dict summary.
+    """
+    totals = {}
+    stages = {}
+    sessions = {}
+    for r in records:
+        add_to_record(totals.setdefault(r["operation"], make_empty_record()), r)
+        add_to_record(stages.setdefault(str(r["stage"]), {}).setdefault(r["operation"], make_empty_record()), r)
+        if r["course"] is not None:
+            add_to_record(sessions.setdefault("{}/{}".format(r["course"], r["session"]), make_empty_record()), r)
+    return {"latency_buckets_ms": list(LATENCY_BUCKETS_MS), "totals": totals, "stages": stages, "sessions": sessions}
+
+
+def report_s3_metrics(job_config, n_sessions=5):
+    """
+    Merge the metrics files of every process that ran job_config, log a summary, and write it to a json file.
+    :param job_config: MorfJobConfig object.
+    :param n_sessions: number of course/session pairs with the most requests to include in the log.
+    :return: path to json summary file.
+    """
+    logger = set_logger_handlers(module_logger, job_config)
+    metrics_dir = make_metrics_dir(job_config)
+    flush_s3_metrics(metrics_dir)
+    records = list()
+    for metrics_file in sorted(os.listdir(metrics_dir)) if os.path.isdir(metrics_dir) else []:
+        if metrics_file.endswith(".json") and metrics_file != METRICS_SUMMARY_FILENAME:
+            with open(os.path.join(metrics_dir, metrics_file)) as f:
+                records.extend(json.load(f))
+    summary = summarize_s3_metrics(records)
+    summary["morf_id"] = job_config.morf_id
+    for stage, operations in sorted(summary["stages"].items()):
+        logger.info("s3 requests for stage {}: {}".format(stage, ", ".join(
+            "{} {} ({:.1f} MB in, {:.1f} MB out, {:.0f} ms mean)".format(op, r["requests"], r["bytes_in"] / 2 ** 20, r["bytes_out"] / 2 ** 20, r["latency_ms"] / r["requests"])
+            for op, r in sorted(operations.items()))))
+    total = make_empty_record()
+    for r in summary["totals"].values():
+        add_to_record(total, r)
+    logger.info("s3 requests for job {}: {} requests, {} errors, {:.1f} MB in, {:.1f} MB out".format(
+        job_config.morf_id, total["requests"], total["errors"], total["bytes_in"] / 2 ** 20, total["bytes_out"] / 2 ** 20))
+    for course_session, r in sorted(summary["sessions"].items(), key=lambda x: -x[1]["requests"])[:n_sessions]:
+        logger.info("s3 requests for {}: {} requests, {:.1f} MB in".format(course_session, r["requests"], r["bytes_in"] / 2 ** 20))
+    summary_fp = os.path.join(metrics_dir, METRICS_SUMMARY_FILENAME)
+    os.makedirs(metrics_dir, exist_ok=True)
+    with open(summary_fp, "w") as f:
+        json.dump(summary, f, indent=2)
+    return summary_fp
@@ -0,0 +1,221 @@
+# Copyright (c) 2018 The Regents of the University of Michigan
+# and the University of Pennsylvania
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""
+Background pre-warming of the local content cache for queued MORF jobs.
+
+A CacheWarmer watches a directory holding the config.properties files of jobs that are queued to run on this host.
+For each new config it works out the objects the job will read (shared raw data files, the raw data of the sessions
+its controller script extracts features from, and anything already under the job's prefix in the processed data bucket)
+and fetches them into the content cache, up to a disk budget, so the job's tasks find their inputs locally when it
+starts. Warming only fills free space in the cache; it never evicts objects, so the running job keeps its inputs.
+"""
+
+import logging
+import os
+import re
+import tempfile
+import threading
+from morf.utils.artifacts import fetch_artifact
+from morf.utils.catalog import get_bucket_catalog, list_bucket_objects, normalize_data_dir
+from morf.utils.config import MorfJobConfig
+from morf.utils.content_cache import get_content_cache, make_digest, GUNZIP, DEFAULT_PREWARM_BUDGET_GB
+from morf.utils.log import set_logger_handlers
+
+module_logger = logging.getLogger(__name__)
+
+DEFAULT_PREWARM_POLL_INTERVAL = 10 # seconds between scans of the queue directory
+SHARED_RAW_FILES = ("coursera_course_dates.csv", "labels-train.csv", "labels-test.csv")
+GB = 1024 ** 3
+# calls of the feature extraction functions in morf.workflow.extract, i.e. extract_session() or extract_holdout_course()
+EXTRACT_CALL_PATTERN = re.compile(r"\bextract_(holdout_)?(all|course|session)\s*\(")
+
+
+def find_extract_modes(job_config):
+    """
+    Find the extraction stages run by job_config's controller script, whose raw data the job will stage.
+    :param job_config: MorfJobConfig object.
+    :return: set of modes in {extract, extract-holdout}; empty if the controller script can not be read.
+    """
+    logger = set_logger_handlers(module_logger, job_config)
+    try:
+        with tempfile.TemporaryDirectory(dir=job_config.local_working_directory) as working_dir:
+            controller_fp = fetch_artifact(job_config, job_config.controller_url, working_dir, dest_filename="controller.py")
+            with open(controller_fp) as f:
+                controller = f.read()
+    except Exception as e:
+        logger.warning("could not read controller script of job {}; not warming raw data: {}".format(job_config.morf_id, e))
+        return set()
+    return set("extract-holdout" if holdout else "extract" for holdout, level in EXTRACT_CALL_PATTERN.findall(controller))
+
+
+def plan_job_prefetch(job_config, extract_modes=None, data_dir="morf-data/"):
+    """
+    List the s3 objects job_config is expected to read, in the order they should be fetched: files shared by every
+    task first, then results already stored under the job's prefix, then the raw data of the sessions the job extracts
+    features from (the training sessions of every course for extract, the holdout session for extract-holdout; at
+    every level, see fetch_raw_course_sessions).
+    :param job_config: MorfJobConfig object.
+    :param extract_modes: modes in {extract, extract-holdout} run by the job; read from its controller script if None.
+    :param data_dir: directory in raw data buckets containing course-level directories.
+    :return: list of (bucket, key, etag, size, variant) tuples; variant is GUNZIP for sql dumps, which are staged
+    decompressed (see download_raw_course_data).
+    """
+    if extract_modes is None:
+        extract_modes = find_extract_modes(job_config)
+    data_dir = normalize_data_dir(data_dir)
+    shared, session_data, job_results = list(), list(), list()
+    for bucket in job_config.raw_data_buckets:
+        catalog = get_bucket_catalog(job_config, bucket, data_dir)
+        for filename in SHARED_RAW_FILES:
+            if data_dir + filename in catalog.objects:
+                size, etag = catalog.objects[data_dir + filename]
+                shared.append((bucket, data_dir + filename, etag, size, None))
+        for course in catalog.courses():
+            sessions = catalog.sessions(course)
+            # the last session of each course is its holdout session (see fetch_sessions)
+            extracted = (sessions[:-1] if "extract" in extract_modes else []) + \
+                        (sessions[-1:] if "extract-holdout" in extract_modes else [])
+            for session in extracted:
+                for key, size, etag in catalog.session_objects(course, session):
+                    session_data.append((bucket, key, etag, size, GUNZIP if key.endswith(".sql.gz") else None))
+    proc_data_bucket = getattr(job_config, "proc_data_bucket", None)
+    if proc_data_bucket:
+        job_prefix = "{}/{}/".format(job_config.user_id, job_config.job_id)
+        for obj in list_bucket_objects(job_config.initialize_s3(), proc_data_bucket, job_prefix):
+            if not obj["Key"].endswith("/"):
+                job_results.append((proc_data_bucket, obj["Key"], obj["ETag"].strip('"'), obj["Size"], None))
+    return shared + job_results + session_data
+
+
+class CacheWarmer:
+    """
+    Prefetches the inputs of queued jobs into the content cache, in a background thread or one scan at a time.
+    """
+
+    def __init__(self, queue_dir, budget_gb=DEFAULT_PREWARM_BUDGET_GB, poll_interval=DEFAULT_PREWARM_POLL_INTERVAL,
+                 make_job_config=MorfJobConfig):
+        """
+        :param queue_dir: directory containing the config.properties file of each queued job (one file per job).
+        :param budget_gb: maximum size of the inputs warmed for a single job, including inputs already cached. Objects
+        are only fetched while they fit in the free space of the cache, so warming never evicts anything (i.e., the
+        inputs of the job running on the host, or what it just fetched).
+        :param poll_interval: seconds between scans of queue_dir when running in the background.
+        :param make_job_config: callable building a job config from a config file path.
+        """
+        self.queue_dir = queue_dir
+        self.budget_bytes = budget_gb * GB
+        self.poll_interval = poll_interval
+        self.make_job_config = make_job_config
+        self.warmed = {} # {config file path: mtime when warmed}
+        self._stop = threading.Event()
+        self._thread = None
+
+    def warm(self, job_config):
+        """
+        Fetch the objects job_config will read into its content cache, in plan order, until the budget is reached or
+        the cache is full.
+        :param job_config: MorfJobConfig object with a cache_dir.
+        :return: number of bytes fetched from s3.
+        """
+        logger = set_logger_handlers(module_logger, job_config)
+        cache = get_content_cache(job_config)
+        if not cache:
+            logger.warning("job {} has no cache_dir; not warming cache".format(job_config.morf_id))
+            return 0
+        budget = self.budget_bytes
+        used = fetched = 0
+        for bucket, key, etag, size, variant in plan_job_prefetch(job_config):
+            if self._stop.is_set():
+                break
+            path = cache.lookup(make_digest(bucket, key, etag, variant)) # marks objects the job needs as recently used
+            if not path:
+                if used + size > budget:
+                    logger.info("reached cache warming budget of {:.1f} GB at s3://{}/{}".format(budget / GB, bucket, key))
+                    break
+                if cache.size() + size > cache.max_bytes:
+                    logger.info("content cache is full at s3://{}/{}; not evicting to warm it".format(bucket, key))
+                    break
+                try:
+                    path = cache.get(job_config, bucket, key, etag, variant)
+                    fetched += size
+                except Exception as e:
+                    logger.warning("could not warm cache with s3://{}/{}: {}".format(bucket, key, e))
+                    continue
+            used += os.path.getsize(path)
+        logger.info("warmed cache for job {}: {:.1f} GB of inputs cached, {:.1f} GB fetched".format(
+            job_config.morf_id, used / GB, fetched / GB))
+        return fetched
+
+    def queued_config_files(self):
+        """
+        :return: paths of config files in queue_dir that have not been warmed since they were last modified, oldest first.
+        """
+        if not os.path.isdir(self.queue_dir):
+            return []
+        config_files = [os.path.join(self.queue_dir, f) for f in os.listdir(self.queue_dir) if not f.startswith(".")]
+        config_files = [fp for fp in config_files if os.path.isfile(fp) and self.warmed.get(fp) != os.path.getmtime(fp)]
+        return sorted(config_files, key=os.path.getmtime)
+
+    def poll(self):
+        """
+        Warm the cache for every queued job not yet warmed.
+        :return: number of jobs warmed.
+        """
+        n_warmed = 0
+        for config_fp in self.queued_config_files():
+            if self._stop.is_set():
+                break
+            mtime = os.path.getmtime(config_fp)
+            try:
+                self.warm(self.make_job_config(config_fp))
+                n_warmed += 1
+            except Exception as e:
+                module_logger.warning("could not warm cache for job config {}: {}".format(config_fp, e))
+            self.warmed[config_fp] = mtime
+        return n_warmed
+
+    def run(self):
+        while not self._stop.is_set():
+            self.poll()
+            self._stop.wait(self.poll_interval)
+        return
+
+    def start(self):
+        """
+        Start warming queued jobs in a background thread.
+        :return: None
+        """
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.run, name="morf-cache-warmer", daemon=True)
+        self._thread.start()
+        return
+
+    def stop(self, timeout=None):
+        """
+        Stop the background thread after the object currently being fetched.
+        :return: None
+        """
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout)
+        return
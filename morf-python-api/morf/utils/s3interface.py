@@ -23,13 +23,109 @@
 Functions to manage push/pull of MORF files to s3.
 """
 
+import json
 import os
-import subprocess
 import logging
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+import boto3
+from botocore.config import Config
+from morf.utils.catalog import list_bucket_objects
+from morf.utils.content_cache import get_content_cache, make_digest, warm_cached_object
+from morf.utils.locking import file_lock
 from morf.utils.log import set_logger_handlers
+from morf.utils.metrics import register_s3_metrics
+from morf.utils.staging import StagingEngine, DEFAULT_STAGING_MAX_WORKERS
 
 module_logger = logging.getLogger(__name__)
 
+MANIFEST_DIR_NAME = "manifests"
+PENDING_CLEAR_DIR_NAME = "pending-clears"
+DELETE_BATCH_SIZE = 1000 # maximum number of keys in a DeleteObjects request
+DEFAULT_DELETE_MAX_WORKERS = 8
+
+# keep-alive http connections are reused as long as the same client is reused
+S3_CLIENT_CONFIG = Config(max_pool_connections=50, tcp_keepalive=True, retries={"max_attempts": 5, "mode": "standard"})
+
+# per-process pool of s3 clients, keyed by credentials; clients are thread-safe so one is shared by all threads
+_s3_clients = {}
+_s3_clients_lock = threading.Lock()
+# resources are not thread-safe, so each thread keeps its own
+_s3_resources = threading.local()
+# process the pool belongs to; see check_s3_pool_pid
+_s3_pool_pid = os.getpid()
+
+
+def reset_s3_pool():
+    """
+    Discard all pooled clients and resources. Called in child processes after a fork, since connections
+    (and any lock held by another thread at fork time) must not be shared with the parent.
+    :return: None
+    """
+    global _s3_clients, _s3_clients_lock, _s3_resources, _s3_pool_pid
+    _s3_clients = {}
+    _s3_clients_lock = threading.Lock()
+    _s3_resources = threading.local()
+    _s3_pool_pid = os.getpid()
+    return
+
+
+def check_s3_pool_pid():
+    """
+    Reset the pool if it was inherited from a parent process; os.register_at_fork does this on python >= 3.7 only.
+    :return: None
+    """
+    if os.getpid() != _s3_pool_pid:
+        reset_s3_pool()
+    return
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=reset_s3_pool)
+
+
+def get_s3_client(aws_access_key_id=None, aws_secret_access_key=None):
+    """
+    Fetch the pooled s3 client for this process and set of credentials, creating it on first use.
+    :param aws_access_key_id: aws_access_key_id; if None, boto3's default credential chain is used.
+    :param aws_secret_access_key: aws_secret_access_key.
+    :return: boto3.client object for s3 connection.
+    """
+    check_s3_pool_pid()
+    creds = (aws_access_key_id, aws_secret_access_key)
+    client = _s3_clients.get(creds)
+    if client is None:
+        with _s3_clients_lock:
+            client = _s3_clients.get(creds)
+            if client is None:
+                # boto3's default session is not thread-safe; build each client from its own session
+                session = boto3.session.Session(aws_access_key_id=aws_access_key_id, aws_secret_access_key=aws_secret_access_key)
+                client = register_s3_metrics(session.client("s3", config=S3_CLIENT_CONFIG))
+                _s3_clients[creds] = client
+    return client
+
+
+def get_s3_resource(aws_access_key_id=None, aws_secret_access_key=None):
+    """
+    Fetch the pooled s3 resource for this thread and set of credentials, creating it on first use.
+    :param aws_access_key_id: aws_access_key_id; if None, boto3's default credential chain is used.
+    :param aws_secret_access_key: aws_secret_access_key.
+    :return: boto3.resource object for s3.
+    """
+    check_s3_pool_pid()
+    creds = (aws_access_key_id, aws_secret_access_key)
+    if not hasattr(_s3_resources, "pool"):
+        _s3_resources.pool = {}
+    resource = _s3_resources.pool.get(creds)
+    if resource is None:
+        session = boto3.session.Session(aws_access_key_id=aws_access_key_id, aws_secret_access_key=aws_secret_access_key)
+        resource = session.resource("s3", config=S3_CLIENT_CONFIG)
+        register_s3_metrics(resource.meta.client)
+        _s3_resources.pool[creds] = resource
+    return resource
+
 
 def fetch_mode_files(job_config, dest_dir, mode=None):
     """
@@ -46,62 +142,192 @@ def fetch_mode_files(job_config, dest_dir, mode=None):
     return
 
 
+def make_manifest_fp(job_config, bucket, prefix):
+    """
+    Path to the local manifest recording the objects last synced from s3://bucket/prefix.
+    """
+    manifest_name = "{}.json".format(prefix.strip("/").replace("/", "-") or "_root")
+    return os.path.join(job_config.cache_dir, MANIFEST_DIR_NAME, bucket, manifest_name)
+
+
+def sync_s3_prefix(job_config, bucket, prefix, dest_dir=None, force=False):
+    """
+    Sync all objects under s3://bucket/prefix into dest_dir, downloading only objects whose ETag or size changed since
+    the last sync. The prefix is listed at most once per workflow stage (identified by job_config.run_id, which every
+    workflow function such as train_course() generates anew): concurrent callers in the stage's pool workers wait on a
+    lock and then reuse the result of the first sync.
+    :param job_config: MorfJobConfig object.
+    :param bucket: name of s3 bucket.
+    :param prefix: key prefix to sync ("" for entire bucket).
+    :param dest_dir: local directory; object keys are mapped to paths relative to prefix. If None, objects are
+    fetched into the content cache of job_config instead.
+    :param force: if True, list and sync prefix even if it was already synced during this workflow stage.
+    :return: dict of {key: [size, etag]} for all objects under prefix.
+    """
+    logger = set_logger_handlers(module_logger, job_config)
+    manifest_fp = make_manifest_fp(job_config, bucket, prefix)
+    with file_lock("{}.lock".format(manifest_fp)):
+        manifest = {"run_id": None, "objects": {}}
+        if os.path.exists(manifest_fp):
+            with open(manifest_fp) as f:
+                manifest = json.load(f)
+        if manifest["run_id"] == job_config.run_id and not force:
+            logger.info("s3://{}/{} already synced for this job; skipping".format(bucket, prefix))
+            return manifest["objects"]
+        logger.info("syncing s3://{}/{} to {}".format(bucket, prefix, dest_dir or "content cache"))
+        s3 = job_config.initialize_s3()
+        objects = {obj["Key"]: [obj["Size"], obj["ETag"].strip('"')]
+                   for obj in list_bucket_objects(s3, bucket, prefix) if not obj["Key"].endswith("/")}
+        engine = StagingEngine(job_config, task_name="sync s3://{}/{}".format(bucket, prefix))
+        cache = get_content_cache(job_config) if dest_dir is None else None
+        for key, (size, etag) in objects.items():
+            if cache:
+                if not cache.lookup(make_digest(bucket, key, etag)):
+                    engine.add_call(warm_cached_object, job_config, bucket, key, etag, required=False)
+                continue
+            dest_fp = os.path.join(dest_dir, key[len(prefix):].lstrip("/"))
+            if manifest["objects"].get(key) != [size, etag] or not os.path.exists(dest_fp):
+                engine.add_download(bucket, key, dest_fp, required=False)
+        engine.run()
+        manifest = {"run_id": job_config.run_id, "objects": objects}
+        tmp_fp = "{}.tmp".format(manifest_fp)
+        with open(tmp_fp, "w") as f:
+            json.dump(manifest, f)
+        os.replace(tmp_fp, manifest_fp)
+    return objects
+
+
 def sync_s3_bucket_cache(job_config, bucket):
     """
-    Cache all data in an s3 bucket to job_config.cache_dir, creating a complete copy of files and directory structure.
+    Fetch all data in an s3 bucket into the content cache of job_config (subject to its size budget).
     :param job_config: MorfJobConfig object.
     :param bucket: path to s3 bucket.
     :return:
     """
-    logger = set_logger_handlers(module_logger, job_config)
-    s3bucket = "s3://{}".format(bucket)
-    bucket_cache_dir = os.path.join(job_config.cache_dir, bucket)
-    # create job_config.cache_dir directory if not exists
-    if not os.path.exists(job_config.cache_dir):
-        try:
-            os.makedirs(job_config.cache_dir)
-        except exception as e:
-            logger.error("error creating cache: {}".format(e))
-            raise
-    # execute s3 sync command
-    cmd = "{} s3 sync {} {}".format(job_config.aws_exec, s3bucket, bucket_cache_dir)
-    logger.info("running {}".format(cmd))
-    try:
-        subprocess.call(cmd, shell=True)
-    except Exception as e:
-        logger.warning("exception when executing sync: {}".format(e))
+    sync_s3_prefix(job_config, bucket, "")
     return
 
 
 def sync_s3_job_cache(job_config, modes=("extract", "extract-holdout", "train", "test")):
     """
     Sync data in s3 just for this specific job (better for large buckets or when the entire bucket is not actually needed).
+    Each prefix is listed once per workflow stage, not once per task; see sync_s3_prefix.
     :param job_config:
     :param bucket:
     :param modes: modes to update cache for; by default to all modes
     :return:
     """
     bucket = job_config.proc_data_bucket
-    logger = set_logger_handlers(module_logger, job_config)
-    s3bucket = "s3://{}".format(bucket)
-    bucket_cache_dir = os.path.join(job_config.cache_dir, bucket)
-    # create job_config.cache_dir directory if not exists
-    if not os.path.exists(job_config.cache_dir):
-        try:
-            os.makedirs(job_config.cache_dir)
-        except exception as e:
-            logger.error("error creating cache: {}".format(e))
-            raise
     for m in modes:
-        s3_prefix = make_s3_key_path(job_config, mode=m)
-        mode_cache_dir = os.path.join(bucket_cache_dir, job_config.user_id, job_config.job_id, m)
-        # execute s3 sync command
-        cmd = "{} s3 sync {}/{} {}".format(job_config.aws_exec, s3bucket, s3_prefix, mode_cache_dir)
-        logger.info("running {}".format(cmd))
+        s3_prefix = make_s3_key_path(job_config, mode=m) + "/"
+        sync_s3_prefix(job_config, bucket, s3_prefix)
+    return
+
+
+def delete_s3_objects(job_config, bucket, keys):
+    """
+    Delete keys from bucket with concurrent DeleteObjects requests of up to 1000 keys each.
+    :param job_config: MorfJobConfig object.
+    :param bucket: name of s3 bucket.
+    :param keys: list of keys to delete.
+    :return: number of keys deleted.
+    """
+    logger = set_logger_handlers(module_logger, job_config)
+    s3 = job_config.initialize_s3()
+    start = time.time()
+    batches = [keys[i:i + DELETE_BATCH_SIZE] for i in range(0, len(keys), DELETE_BATCH_SIZE)]
+
+    def delete_batch(batch):
+        response = s3.delete_objects(Bucket=bucket, Delete={"Objects": [{"Key": k} for k in batch], "Quiet": True})
+        for error in response.get("Errors", []):
+            logger.warning("error deleting s3://{}/{}: {}".format(bucket, error.get("Key"), error.get("Message")))
+        return len(batch) - len(response.get("Errors", []))
+
+    with ThreadPoolExecutor(max_workers=getattr(job_config, "delete_max_workers", DEFAULT_DELETE_MAX_WORKERS)) as executor:
+        n_deleted = sum(executor.map(delete_batch, batches))
+    logger.info("deleted {} of {} objects from s3://{} in {} batches in {:.1f}s".format(n_deleted, len(keys), bucket, len(batches), time.time() - start))
+    return n_deleted
+
+
+def copy_s3_objects(job_config, bucket, key_pairs):
+    """
+    Copy objects within bucket with concurrent server-side CopyObject requests; no data passes through this host.
+    :param job_config: MorfJobConfig object; staging_max_workers sets the number of concurrent requests.
+    :param bucket: name of s3 bucket.
+    :param key_pairs: list of (source_key, dest_key) tuples.
+    :return: list of (source_key, dest_key) tuples that could not be copied.
+    """
+    logger = set_logger_handlers(module_logger, job_config)
+    wait_for_pending_clears(job_config)
+    s3 = job_config.initialize_s3()
+    start = time.time()
+
+    def copy_object(key_pair):
+        source_key, dest_key = key_pair
         try:
-            subprocess.call(cmd, shell=True)
+            s3.copy_object(CopySource={"Bucket": bucket, "Key": source_key}, Bucket=bucket, Key=dest_key)
         except Exception as e:
-            logger.warning("exception when executing sync: {}".format(e))
+            logger.warning("error copying s3://{}/{} to {}: {}".format(bucket, source_key, dest_key, e))
+            return key_pair
+        return None
+
+    with ThreadPoolExecutor(max_workers=getattr(job_config, "staging_max_workers", DEFAULT_STAGING_MAX_WORKERS)) as executor:
+        failed = [x for x in executor.map(copy_object, key_pairs) if x is not None]
+    logger.info("copied {} of {} objects in s3://{} in {:.1f}s".format(len(key_pairs) - len(failed), len(key_pairs), bucket, time.time() - start))
+    return failed
+
+
+def make_pending_clear_fp(job_config, clear_id):
+    return os.path.join(job_config.local_working_directory, PENDING_CLEAR_DIR_NAME, "{}-{}".format(job_config.run_id, clear_id))
+
+
+def delete_s3_prefix(job_config, bucket, prefix, asynchronous=False):
+    """
+    Delete every object under s3://bucket/prefix. Keys are listed before this function returns, so objects written
+    after the call are never deleted.
+    :param job_config: MorfJobConfig object.
+    :param bucket: name of s3 bucket.
+    :param prefix: key prefix to delete.
+    :param asynchronous: if True, delete in a background thread and return immediately; uploads for this job run
+    wait for the deletion to complete (see wait_for_pending_clears) so new outputs are never removed.
+    :return: number of keys deleted, or the background threading.Thread if asynchronous.
+    """
+    logger = set_logger_handlers(module_logger, job_config)
+    s3 = job_config.initialize_s3()
+    keys = [obj["Key"] for obj in list_bucket_objects(s3, bucket, prefix)]
+    logger.info("found {} objects to delete under s3://{}/{}".format(len(keys), bucket, prefix))
+    cache = get_content_cache(job_config)
+    if cache: # local copies of deleted uploads must not be served as current
+        cache.forget_uploads(bucket, prefix)
+    if not asynchronous:
+        return delete_s3_objects(job_config, bucket, keys)
+    pending_fp = make_pending_clear_fp(job_config, uuid.uuid4().hex)
+    os.makedirs(os.path.dirname(pending_fp), exist_ok=True)
+    open(pending_fp, "w").close()
+
+    def delete_and_mark_done():
+        try:
+            delete_s3_objects(job_config, bucket, keys)
+        finally:
+            os.remove(pending_fp)
+
+    thread = threading.Thread(target=delete_and_mark_done, name="clear-s3://{}/{}".format(bucket, prefix))
+    thread.start()
+    return thread
+
+
+def wait_for_pending_clears(job_config, poll_interval=1):
+    """
+    Block until all asynchronous deletions started by this job run (in any process on this host) have finished.
+    :param job_config: MorfJobConfig object.
+    :param poll_interval: seconds between checks.
+    :return: None
+    """
+    if not hasattr(job_config, "local_working_directory"):
+        return
+    pending_dir = os.path.dirname(make_pending_clear_fp(job_config, ""))
+    while os.path.isdir(pending_dir) and any(x.startswith(job_config.run_id) for x in os.listdir(pending_dir)):
+        time.sleep(poll_interval)
     return
 
 
@@ -35,16 +35,20 @@ def hash_df_column(column, user_id, hash_secret):
     return column_hashed
 
 
-def generate_md5(fname):
+def generate_md5(fname, chunk_size=4 * 1024 ** 2):
     """
     Generates an md5 for a file. Based on https://stackoverflow.com/questions/3431825/generating-an-md5-checksum-of-a-file
     :param fname: file name.
-    :return:
+    :param chunk_size: number of bytes to read at a time.
+    :return: md5 (hex string).
     """
     hash_md5 = hashlib.md5()
-    with open(fname, "rb") as f:
-        for chunk in iter(lambda: f.read(4096), b""):
-            hash_md5.update(chunk)
+    # read large chunks into one reused buffer; docker images are often several GB
+    buffer = bytearray(chunk_size)
+    view = memoryview(buffer)
+    with open(fname, "rb", buffering=0) as f:
+        for n in iter(lambda: f.readinto(buffer), 0):
+            hash_md5.update(view[:n])
     return hash_md5.hexdigest()
 
 
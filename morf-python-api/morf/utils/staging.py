@@ -0,0 +1,338 @@
+# Copyright (c) 2018 The Regents of the University of Michigan
+# and the University of Pennsylvania
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Concurrent staging of input data for MORF tasks.
+"""
+
+import gzip
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from boto3.s3.transfer import TransferConfig
+from morf.utils.log import set_logger_handlers
+from morf.utils.transfer import BULK, get_transfer_scheduler
+
+module_logger = logging.getLogger(__name__)
+
+MB = 1024 ** 2
+DEFAULT_STAGING_MAX_WORKERS = 16
+DEFAULT_MULTIPART_THRESHOLD_MB = 64
+DEFAULT_MULTIPART_CHUNKSIZE_MB = 16
+DEFAULT_MAX_CONCURRENCY = 4
+DEFAULT_RANGED_DOWNLOAD_THRESHOLD_MB = 256
+DEFAULT_RANGE_SIZE_MB = 64
+DEFAULT_RANGED_DOWNLOAD_MAX_WORKERS = 8
+
+
+def make_transfer_config(job_config):
+    """
+    Build the boto3 TransferConfig for job_config; objects larger than the threshold are fetched as concurrent ranged GETs.
+    :param job_config: MorfJobConfig object.
+    :return: boto3.s3.transfer.TransferConfig
+    """
+    tc = TransferConfig(
+        multipart_threshold=getattr(job_config, "staging_multipart_threshold_mb", DEFAULT_MULTIPART_THRESHOLD_MB) * MB,
+        multipart_chunksize=getattr(job_config, "staging_multipart_chunksize_mb", DEFAULT_MULTIPART_CHUNKSIZE_MB) * MB,
+        max_concurrency=getattr(job_config, "staging_max_concurrency", DEFAULT_MAX_CONCURRENCY))
+    return tc
+
+
+def download_s3_object(job_config, bucket, key, dest_fp, lane=BULK):
+    """
+    Download s3://bucket/key to dest_fp using job_config's transfer settings and bandwidth limit.
+    :param job_config: MorfJobConfig object.
+    :param lane: transfer priority lane (see morf.utils.transfer).
+    :return: size of downloaded file in bytes.
+    """
+    os.makedirs(os.path.dirname(dest_fp), exist_ok=True)
+    s3 = job_config.initialize_s3()
+    s3.download_file(bucket, key, dest_fp, Config=make_transfer_config(job_config),
+                     Callback=get_transfer_scheduler(job_config).callback(lane))
+    return os.path.getsize(dest_fp)
+
+
+def download_s3_object_gunzip(job_config, bucket, key, dest_fp, lane=BULK):
+    """
+    Download gzip object s3://bucket/key, decompressing it into dest_fp as it streams.
+    :param job_config: MorfJobConfig object.
+    :param lane: transfer priority lane (see morf.utils.transfer).
+    :return: size of compressed object in bytes.
+    """
+    os.makedirs(os.path.dirname(dest_fp), exist_ok=True)
+    s3 = job_config.initialize_s3()
+    response = s3.get_object(Bucket=bucket, Key=key)
+    gunzip_to_file(get_transfer_scheduler(job_config).wrap(response["Body"], lane), dest_fp)
+    return response["ContentLength"]
+
+
+def gunzip_to_file(fileobj, dest_fp, chunk_size=MB):
+    """
+    Decompress gzip data from fileobj into dest_fp as it is read, so the compressed file is never written to disk.
+    Output is written to a temporary file and renamed, so dest_fp never contains partial data; the temporary file is
+    removed if decompression fails.
+    :param fileobj: readable file-like object containing gzip data (i.e., a local file or an s3 response body).
+    :param dest_fp: path to write decompressed data to.
+    :param chunk_size: number of bytes to decompress at a time.
+    :return: None
+    """
+    tmp_fp = "{}.part".format(dest_fp)
+    try:
+        with gzip.GzipFile(fileobj=fileobj, mode="rb") as f_in, open(tmp_fp, "wb") as f_out:
+            shutil.copyfileobj(f_in, f_out, chunk_size)
+        os.replace(tmp_fp, dest_fp)
+    except Exception:
+        if os.path.exists(tmp_fp):
+            os.remove(tmp_fp)
+        raise
+    return
+
+
+def download_ranges(size, dest_fp, open_range, validator=None, range_size=DEFAULT_RANGE_SIZE_MB * MB,
+                    max_workers=DEFAULT_RANGED_DOWNLOAD_MAX_WORKERS):
+    """
+    Download an object of known size as concurrent byte ranges written into a preallocated file.
+    Progress is recorded in a sidecar file next to dest_fp, so an interrupted download resumes with only the missing
+    ranges, as long as the object (identified by size and validator) has not changed; without a validator, a change
+    can not be detected, so the download always starts over.
+    :param size: size of object in bytes.
+    :param dest_fp: path to write object to.
+    :param open_range: callable taking (start, end) byte offsets (inclusive) and returning a readable file-like object.
+    :param validator: ETag or Last-Modified value of the object (string), used to check that a partial download can be resumed.
+    :param range_size: size of each range in bytes.
+    :param max_workers: number of ranges to fetch at once.
+    :return: dest_fp
+    """
+    part_fp = "{}.part".format(dest_fp)
+    progress_fp = "{}.ranges".format(dest_fp)
+    progress = {"size": size, "validator": validator, "range_size": range_size, "done": []}
+    if validator and os.path.exists(progress_fp) and os.path.exists(part_fp):
+        try:
+            with open(progress_fp) as f:
+                prev_progress = json.load(f)
+            if all(prev_progress.get(x) == progress[x] for x in ("size", "validator", "range_size")) \
+                    and os.path.getsize(part_fp) == size:
+                progress = prev_progress
+        except ValueError: # corrupt progress file; start over
+            pass
+    done = set(progress["done"])
+    if not done:
+        with open(part_fp, "wb") as f:
+            if hasattr(os, "posix_fallocate") and size > 0:
+                os.posix_fallocate(f.fileno(), 0, size)
+            else:
+                f.truncate(size)
+    progress_lock = threading.Lock()
+
+    def fetch_range(fd, start):
+        end = min(start + range_size, size) - 1
+        body = open_range(start, end)
+        offset = start
+        for chunk in iter(lambda: body.read(MB), b""):
+            os.pwrite(fd, chunk, offset)
+            offset += len(chunk)
+        if offset != end + 1:
+            raise IOError("short read for bytes {}-{} of {}: received {} bytes".format(start, end, dest_fp, offset - start))
+        with progress_lock:
+            done.add(start)
+            progress["done"] = sorted(done)
+            tmp_fp = "{}.tmp".format(progress_fp)
+            with open(tmp_fp, "w") as f:
+                json.dump(progress, f)
+            os.replace(tmp_fp, progress_fp)
+        return
+
+    fd = os.open(part_fp, os.O_WRONLY)
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(fetch_range, fd, start) for start in range(0, size, range_size) if start not in done]
+            for future in futures:
+                future.result()
+    finally:
+        os.close(fd)
+    os.replace(part_fp, dest_fp)
+    if os.path.exists(progress_fp):
+        os.remove(progress_fp)
+    return dest_fp
+
+
+def ranged_download_s3(s3, bucket, key, dest_fp, size, etag=None, job_config=None, lane=BULK):
+    """
+    Download s3://bucket/key to dest_fp with concurrent ranged GETs; see download_ranges.
+    :param s3: boto3.client object for s3 connection.
+    :param size: size of object in bytes.
+    :param etag: ETag of object.
+    :param job_config: MorfJobConfig object; used for range size, concurrency and bandwidth settings.
+    :param lane: transfer priority lane (see morf.utils.transfer).
+    :return: dest_fp
+    """
+    scheduler = get_transfer_scheduler(job_config)
+
+    def open_range(start, end):
+        return scheduler.wrap(s3.get_object(Bucket=bucket, Key=key, Range="bytes={}-{}".format(start, end))["Body"], lane)
+
+    return download_ranges(size, dest_fp, open_range, validator=etag,
+                           range_size=getattr(job_config, "range_size_mb", DEFAULT_RANGE_SIZE_MB) * MB,
+                           max_workers=getattr(job_config, "ranged_download_max_workers", DEFAULT_RANGED_DOWNLOAD_MAX_WORKERS))
+
+
+def ranged_download_https(url, dest_fp, job_config=None):
+    """
+    Download url to dest_fp with concurrent ranged GETs if the server supports byte ranges and the file is larger than
+    job_config.ranged_download_threshold_mb; see download_ranges.
+    :param url: https url of file.
+    :param job_config: MorfJobConfig object; used for threshold, range size and concurrency settings.
+    :return: dest_fp if the file was downloaded, otherwise None (caller should fall back to a single-stream download).
+    """
+    with urllib.request.urlopen(urllib.request.Request(url, method="HEAD")) as response:
+        headers = response.headers
+    size = int(headers.get("Content-Length", 0))
+    threshold = getattr(job_config, "ranged_download_threshold_mb", DEFAULT_RANGED_DOWNLOAD_THRESHOLD_MB) * MB
+    if headers.get("Accept-Ranges") != "bytes" or size < threshold:
+        return None
+
+    def open_range(start, end):
+        return urllib.request.urlopen(urllib.request.Request(url, headers={"Range": "bytes={}-{}".format(start, end)}))
+
+    return download_ranges(size, dest_fp, open_range, validator=headers.get("ETag") or headers.get("Last-Modified"),
+                           range_size=getattr(job_config, "range_size_mb", DEFAULT_RANGE_SIZE_MB) * MB,
+                           max_workers=getattr(job_config, "ranged_download_max_workers", DEFAULT_RANGED_DOWNLOAD_MAX_WORKERS))
+
+
+_staged = threading.local() # objects and bytes placed by the staging call running in each thread; see report_staged_bytes
+
+
+def report_staged_bytes(n_bytes):
+    """
+    Count one object of n_bytes as placed by the StagingEngine call running in this thread, if any, so the engine's
+    transfer statistics include objects staged by queued calls (i.e., from the content cache).
+    :param n_bytes: size of the placed object in bytes.
+    :return: None
+    """
+    counts = getattr(_staged, "counts", None)
+    if counts is not None:
+        counts[0] += 1
+        counts[1] += n_bytes
+    return
+
+
+def run_staging_call(func, args, kwargs):
+    """
+    Call func(*args, **kwargs), collecting the objects and bytes it reports with report_staged_bytes.
+    :return: list of [number of objects, number of bytes].
+    """
+    previous = getattr(_staged, "counts", None)
+    _staged.counts = counts = [0, 0]
+    try:
+        func(*args, **kwargs)
+    finally:
+        _staged.counts = previous
+    return counts
+
+
+class StagingEngine:
+    """
+    Queue of downloads and local staging calls for a task, executed together on a bounded thread pool.
+    """
+
+    def __init__(self, job_config, task_name=None, lane=BULK):
+        """
+        :param job_config: MorfJobConfig object; staging_max_workers sets the size of the thread pool.
+        :param task_name: description of task, used when reporting transfer statistics.
+        :param lane: transfer priority lane for downloads (see morf.utils.transfer).
+        """
+        self.job_config = job_config
+        self.task_name = task_name
+        self.lane = lane
+        self.scheduler = get_transfer_scheduler(job_config)
+        self.max_workers = getattr(job_config, "staging_max_workers", DEFAULT_STAGING_MAX_WORKERS)
+        self.tasks = []
+
+    def add_download(self, bucket, key, dest_fp, required=True, decompress=False):
+        """
+        Queue download of s3://bucket/key to dest_fp.
+        :param required: if False, a failed download is logged and skipped instead of raised.
+        :param decompress: if True, object is gzip data and is decompressed into dest_fp while it downloads.
+        :return: None
+        """
+        func = self._download_gunzip if decompress else self._download
+        self.tasks.append((func, (bucket, key, dest_fp), {}, required, "s3://{}/{}".format(bucket, key)))
+        return
+
+    def add_call(self, func, *args, required=True, **kwargs):
+        """
+        Queue a local staging call (i.e., copying from cache) to run alongside downloads. Objects the call reports
+        with report_staged_bytes are included in the transfer statistics.
+        :param required: if False, an exception in func is logged and skipped instead of raised.
+        :return: None
+        """
+        self.tasks.append((func, args, kwargs, required, getattr(func, "__name__", str(func))))
+        return
+
+    def _download(self, bucket, key, dest_fp):
+        report_staged_bytes(download_s3_object(self.job_config, bucket, key, dest_fp, self.lane))
+        return
+
+    def _download_gunzip(self, bucket, key, dest_fp):
+        report_staged_bytes(download_s3_object_gunzip(self.job_config, bucket, key, dest_fp, self.lane))
+        return
+
+    def run(self):
+        """
+        Execute all queued tasks and clear the queue. Raises the first exception from a required task, after all tasks finish.
+        :return: dict of transfer statistics for the task.
+        """
+        logger = set_logger_handlers(module_logger, self.job_config)
+        tasks, self.tasks = self.tasks, []
+        start = time.time()
+        n_objects = 0
+        n_bytes = 0
+        n_failed = 0
+        error = None
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {executor.submit(run_staging_call, func, args, kwargs): (required, name) for func, args, kwargs, required, name in tasks}
+            for future in as_completed(futures):
+                required, name = futures[future]
+                try:
+                    objects, n = future.result()
+                except Exception as e:
+                    n_failed += 1
+                    if required:
+                        logger.error("exception while staging {}: {}".format(name, e))
+                        error = error or e
+                    else:
+                        logger.warning("skipping {} after exception while staging: {}".format(name, e))
+                    continue
+                n_objects += objects
+                n_bytes += n
+        seconds = time.time() - start
+        stats = {"task": self.task_name, "objects": n_objects, "bytes": n_bytes, "failed": n_failed,
+                 "seconds": seconds, "mb_per_second": (n_bytes / MB) / seconds if seconds > 0 else 0.0}
+        logger.info("staged {objects} objects ({mb:.1f} MB) for {task} in {seconds:.1f}s ({mb_per_second:.1f} MB/s); {failed} tasks failed"
+                    .format(mb=n_bytes / MB, **stats))
+        if error:
+            raise error
+        return stats
@@ -0,0 +1,227 @@
+# Copyright (c) 2018 The Regents of the University of Michigan
+# and the University of Pennsylvania
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Bandwidth limiting and prioritization of s3 transfers shared by every process of every MORF job on a host.
+
+All processes on a host draw from one token bucket, stored in a small locked file so pool workers started by any
+method share it. Transfers are assigned to a lane: critical transfers (result uploads, model and metadata downloads)
+may use the whole bucket, while bulk transfers (staging and prefetching input data) leave a reserve untouched
+whenever a critical transfer has been active recently, so critical transfers are never queued behind bulk ones.
+"""
+
+import fcntl
+import os
+import struct
+import threading
+import time
+
+CRITICAL = "critical"
+BULK = "bulk"
+DEFAULT_TRANSFER_MAX_MB_PER_S = 0 # 0 means no bandwidth limit
+DEFAULT_CRITICAL_RESERVE = 0.5 # fraction of the bucket bulk transfers leave for critical transfers
+DEFAULT_CRITICAL_MAX_MB = 16 # single-file downloads smaller than this are critical unless a lane is given
+CRITICAL_WINDOW = 2.0 # seconds after a critical transfer during which the reserve is held back from bulk transfers
+MAX_SLEEP = 0.25
+TRANSFER_DIR_NAME = "transfer"
+TRANSFER_STATE_FILENAME = "host.state"
+_STATE_FORMAT = "ddd" # available bytes, time of last refill, time of last critical transfer
+_STATE_SIZE = struct.calcsize(_STATE_FORMAT)
+MB = 1024 ** 2
+
+# schedulers already opened by this process, keyed by state file
+_schedulers = {}
+_schedulers_lock = threading.Lock()
+_schedulers_pid = os.getpid() # process the schedulers belong to; see check_transfer_schedulers_pid
+
+
+def reset_transfer_schedulers():
+    """
+    Discard schedulers inherited from a parent process; flock locks are shared by forked file descriptors,
+    so each process must open the state file itself.
+    :return: None
+    """
+    global _schedulers, _schedulers_lock, _schedulers_pid
+    _schedulers = {}
+    _schedulers_lock = threading.Lock()
+    _schedulers_pid = os.getpid()
+    return
+
+
+def check_transfer_schedulers_pid():
+    """
+    Discard schedulers inherited from a parent process; os.register_at_fork does this on python >= 3.7 only.
+    :return: None
+    """
+    if os.getpid() != _schedulers_pid:
+        reset_transfer_schedulers()
+    return
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=reset_transfer_schedulers)
+
+
+class TransferScheduler:
+    """
+    Token bucket limiting the combined transfer rate of all processes sharing state_fp, with critical and bulk lanes.
+    """
+
+    def __init__(self, state_fp=None, rate=0, burst=None, critical_reserve=DEFAULT_CRITICAL_RESERVE):
+        """
+        :param state_fp: path to the shared state file; created if it does not exist.
+        :param rate: bytes per second for all processes together; 0 disables limiting.
+        :param burst: size of the bucket in bytes; defaults to one second of transfer.
+        :param critical_reserve: fraction of the bucket that bulk transfers leave for critical transfers.
+        """
+        self.rate = rate
+        self.burst = burst or rate
+        self.reserve = critical_reserve * self.burst
+        self.state_fp = state_fp
+        self.fd = None
+        self.pid = None
+        self.lock = threading.Lock()
+        if rate > 0:
+            os.makedirs(os.path.dirname(state_fp), exist_ok=True)
+            self._open()
+
+    def _open(self):
+        """
+        Open the state file in this process; flock locks are shared by file descriptors inherited through a fork,
+        so a scheduler used in a child process must not use its parent's descriptor.
+        """
+        if self.fd is not None:
+            os.close(self.fd) # the parent's lock is held through its own descriptor, not this copy
+        self.fd = os.open(self.state_fp, os.O_RDWR | os.O_CREAT, 0o644)
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+
+    def _take(self, n_bytes, lane):
+        """
+        Take n_bytes from the bucket if lane may use them now.
+        :return: 0 if the bytes were taken, otherwise an estimate of the seconds to wait before trying again.
+        """
+        if self.pid != os.getpid():
+            self._open()
+        with self.lock:
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+            try:
+                now = time.time()
+                state = os.pread(self.fd, _STATE_SIZE, 0)
+                tokens, last_refill, last_critical = struct.unpack(_STATE_FORMAT, state) if len(state) == _STATE_SIZE \
+                    else (self.burst, now, 0.0)
+                tokens = min(self.burst, tokens + (now - last_refill) * self.rate)
+                floor = self.reserve if lane == BULK and now - last_critical < CRITICAL_WINDOW else 0
+                wait = 0
+                if tokens - n_bytes >= floor:
+                    tokens -= n_bytes
+                else:
+                    wait = (n_bytes + floor - tokens) / self.rate
+                if lane == CRITICAL: # critical transfers hold back bulk transfers while they wait, too
+                    last_critical = now
+                os.pwrite(self.fd, struct.pack(_STATE_FORMAT, tokens, now, last_critical), 0)
+            finally:
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+        return wait
+
+    def acquire(self, n_bytes, lane=BULK):
+        """
+        Block until n_bytes may be transferred in lane.
+        :param n_bytes: number of bytes.
+        :param lane: CRITICAL or BULK.
+        :return: None
+        """
+        if self.rate <= 0:
+            return
+        # take at most what lane can ever get at once, so large requests are not starved
+        max_take = self.burst - self.reserve if lane == BULK else self.burst
+        while n_bytes > 0:
+            chunk = min(n_bytes, max_take)
+            wait = self._take(chunk, lane)
+            if wait:
+                time.sleep(min(wait, MAX_SLEEP))
+            else:
+                n_bytes -= chunk
+        return
+
+    def callback(self, lane=BULK):
+        """
+        Progress callback for boto3 transfers (i.e., Callback for download_file); throttles as bytes arrive.
+        """
+        return lambda n_bytes: self.acquire(n_bytes, lane)
+
+    def wrap(self, fileobj, lane=BULK):
+        """
+        Wrap a readable file-like object (i.e., an s3 response body) so that reads are throttled.
+        """
+        if self.rate <= 0:
+            return fileobj
+        return ThrottledReader(fileobj, self, lane)
+
+
+class ThrottledReader:
+    """
+    File-like object that draws from a TransferScheduler for every read from the wrapped object.
+    """
+
+    def __init__(self, fileobj, scheduler, lane=BULK):
+        self.fileobj = fileobj
+        self.scheduler = scheduler
+        self.lane = lane
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.scheduler.acquire(len(data), self.lane)
+        return data
+
+    def close(self):
+        return self.fileobj.close()
+
+
+def make_transfer_state_fp(job_config):
+    """
+    Path to the token bucket shared by every job on this host: job_config.transfer_state_fp if set, otherwise a fixed
+    file under local_working_directory.
+    """
+    return getattr(job_config, "transfer_state_fp", None) or \
+        os.path.join(job_config.local_working_directory, TRANSFER_DIR_NAME, TRANSFER_STATE_FILENAME)
+
+
+def get_transfer_scheduler(job_config):
+    """
+    Fetch this process's scheduler for job_config's bandwidth limit (job_config.transfer_max_mb_per_s), shared with
+    every other process of every job on this host. Jobs with different limits share the same bucket, each refilling
+    it at its own rate.
+    :param job_config: MorfJobConfig object; if None, an unlimited scheduler is returned.
+    :return: TransferScheduler
+    """
+    rate = getattr(job_config, "transfer_max_mb_per_s", DEFAULT_TRANSFER_MAX_MB_PER_S) * MB
+    if rate <= 0 or not hasattr(job_config, "local_working_directory"):
+        return TransferScheduler()
+    state_fp = make_transfer_state_fp(job_config)
+    check_transfer_schedulers_pid()
+    with _schedulers_lock:
+        scheduler = _schedulers.get((state_fp, rate))
+        if scheduler is None:
+            scheduler = TransferScheduler(state_fp, rate,
+                                          critical_reserve=getattr(job_config, "transfer_critical_reserve", DEFAULT_CRITICAL_RESERVE))
+            _schedulers[(state_fp, rate)] = scheduler
+    return scheduler
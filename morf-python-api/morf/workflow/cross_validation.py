@@ -24,10 +24,16 @@ Utility functions for performing cross-validation for model training/testing.
 """
 
 from morf.utils.log import set_logger_handlers, execute_and_log_output
-from morf.utils.docker import load_docker_image, make_docker_run_command
+from morf.utils.docker import make_docker_run_command, registered_docker_image
 from morf.utils.config import MorfJobConfig
 from morf.utils import fetch_complete_courses, fetch_sessions, download_train_test_data, initialize_input_output_dirs, make_feature_csv_name, make_label_csv_name, clear_s3_subdirectory, upload_file_to_s3, download_from_s3, initialize_labels, aggregate_session_input_data
 from morf.utils.s3interface import make_s3_key_path
+from morf.utils.frames import make_intermediate_filename, read_intermediate, write_intermediate, get_user_id_dictionary, \
+    make_lean_frame, restore_user_ids
+from morf.utils.job_state import make_task_id, task_is_complete, job_task, untracked_task
+from morf.utils.labels import label_sharing_pool
+from morf.utils.memo import make_task_fingerprint, UPSTREAM_MODES, LABEL_FILES
+from morf.utils.metrics import s3_metrics_context
 from morf.utils.api_utils import collect_course_cv_results
 from multiprocessing import Pool
 import logging
@@ -49,47 +55,64 @@ def make_folds(job_config, raw_data_bucket, course, k, label_type, raw_data_dir=
     :return:
     """
     logger = set_logger_handlers(module_logger, job_config)
-    user_id_col = "userID"
-    label_col = "label_value"
-    logger.info("creating cross-validation folds for course {}".format(course))
-    with tempfile.TemporaryDirectory(dir=job_config.local_working_directory) as working_dir:
-        input_dir, output_dir = initialize_input_output_dirs(working_dir)
-        # download data for each session
-        for session in fetch_sessions(job_config, raw_data_bucket, data_dir=raw_data_dir, course=course,
-                                      fetch_all_sessions=True):
-            # get the session feature and label data
-            download_train_test_data(job_config, raw_data_bucket, raw_data_dir, course, session, input_dir,
-                                     label_type=label_type)
-        # merge features to ensure splits are correct
-        feat_csv_path = aggregate_session_input_data("features", os.path.join(input_dir, course))
-        label_csv_path = aggregate_session_input_data("labels", os.path.join(input_dir, course))
-        feat_df = pd.read_csv(feat_csv_path, dtype=object)
-        label_df = pd.read_csv(label_csv_path, dtype=object)
-        feat_label_df = pd.merge(feat_df, label_df, on=user_id_col)
-        if feat_df.shape[0] != label_df.shape[0]:
-            logger.error(
-                "number of observations in extracted features and labels do not match for course {}; features contains {} and labels contains {} observations".format(
-                    course, feat_df.shape[0], label_df.shape[0]))
-        # create the folds
-        logger.info("creating cv splits with k = {} course {} session {}".format(k, course, session))
-        skf = StratifiedKFold(n_splits=k, shuffle=True)
-        folds = skf.split(np.zeros(feat_label_df.shape[0]), feat_label_df.label_value)
-        for fold_num, train_test_indices in enumerate(folds, 1):  # write each fold train/test data to csv and push to s3
-            train_index, test_index = train_test_indices
-            train_df, test_df = feat_label_df.loc[train_index,].drop(label_col, axis=1), feat_label_df.loc[
-                test_index,].drop(label_col, axis=1)
-            train_df_name = os.path.join(working_dir, make_feature_csv_name(course, fold_num, "train"))
-            test_df_name = os.path.join(working_dir, make_feature_csv_name(course, fold_num, "test"))
-            train_df.to_csv(train_df_name, index=False)
-            test_df.to_csv(test_df_name, index=False)
-            # upload to s3
-            try:
-                train_key = make_s3_key_path(job_config, course, os.path.basename(train_df_name))
-                upload_file_to_s3(train_df_name, job_config.proc_data_bucket, train_key, job_config, remove_on_success=True)
-                test_key = make_s3_key_path(job_config, course, os.path.basename(test_df_name))
-                upload_file_to_s3(test_df_name, job_config.proc_data_bucket, test_key, job_config, remove_on_success=True)
-            except Exception as e:
-                logger.warning("exception occurred while uploading cv results: {}".format(e))
+    # count s3 requests made for this task against the course; pool workers exit without running atexit handlers,
+    # so the counts are written when the block exits
+    with s3_metrics_context(job_config, stage=mode, course=course):
+        user_id_col = "userID"
+        label_col = "label_value"
+        logger.info("creating cross-validation folds for course {}".format(course))
+        task_id = make_task_id(mode, "course", course, None, "folds", k, label_type)
+        if getattr(job_config, "resume", False):
+            fingerprint = make_task_fingerprint(job_config, {"task": task_id}, upstream_modes=UPSTREAM_MODES[mode],
+                                                label_files=LABEL_FILES[mode], data_dir=raw_data_dir)
+            if task_is_complete(job_config, task_id, fingerprint, require_outputs=True):
+                logger.info("task {} was completed by an earlier run of this job; skipping".format(task_id))
+                return
+            task_context = job_task(job_config, task_id, fingerprint, require_outputs=True)
+        else:
+            task_context = untracked_task(job_config, task_id)
+        with task_context:
+            with tempfile.TemporaryDirectory(dir=job_config.local_working_directory) as working_dir:
+                input_dir, output_dir = initialize_input_output_dirs(working_dir)
+                # download data for each session
+                for session in fetch_sessions(job_config, raw_data_bucket, data_dir=raw_data_dir, course=course,
+                                              fetch_all_sessions=True):
+                    # get the session feature and label data
+                    download_train_test_data(job_config, raw_data_bucket, raw_data_dir, course, session, input_dir,
+                                             label_type=label_type)
+                # merge features to ensure splits are correct
+                feat_csv_path = aggregate_session_input_data("features", os.path.join(input_dir, course))
+                label_csv_path = aggregate_session_input_data("labels", os.path.join(input_dir, course))
+                # join on integer user ID codes, with numeric columns downcast; user IDs are decoded when folds are written
+                user_ids = get_user_id_dictionary(job_config)
+                feat_df = make_lean_frame(pd.read_csv(feat_csv_path, dtype=object), user_ids, user_id_col)
+                label_df = make_lean_frame(pd.read_csv(label_csv_path, dtype=object), user_ids, user_id_col)
+                feat_label_df = pd.merge(feat_df, label_df, on=user_id_col)
+                if feat_df.shape[0] != label_df.shape[0]:
+                    logger.error(
+                        "number of observations in extracted features and labels do not match for course {}; features contains {} and labels contains {} observations".format(
+                            course, feat_df.shape[0], label_df.shape[0]))
+                del feat_df, label_df
+                # create the folds
+                logger.info("creating cv splits with k = {} course {} session {}".format(k, course, session))
+                skf = StratifiedKFold(n_splits=k, shuffle=True)
+                folds = skf.split(np.zeros(feat_label_df.shape[0]), feat_label_df.label_value)
+                for fold_num, train_test_indices in enumerate(folds, 1):  # write each fold train/test data to csv and push to s3
+                    train_index, test_index = train_test_indices
+                    train_df, test_df = feat_label_df.loc[train_index,].drop(label_col, axis=1), feat_label_df.loc[
+                        test_index,].drop(label_col, axis=1)
+                    train_df_name = os.path.join(working_dir, make_intermediate_filename(job_config, make_feature_csv_name(course, fold_num, "train")))
+                    test_df_name = os.path.join(working_dir, make_intermediate_filename(job_config, make_feature_csv_name(course, fold_num, "test")))
+                    write_intermediate(restore_user_ids(train_df, user_ids, user_id_col), train_df_name)
+                    write_intermediate(restore_user_ids(test_df, user_ids, user_id_col), test_df_name)
+                    # upload to s3
+                    try:
+                        train_key = make_s3_key_path(job_config, course, os.path.basename(train_df_name))
+                        upload_file_to_s3(train_df_name, job_config.proc_data_bucket, train_key, job_config, remove_on_success=True)
+                        test_key = make_s3_key_path(job_config, course, os.path.basename(test_df_name))
+                        upload_file_to_s3(test_df_name, job_config.proc_data_bucket, test_key, job_config, remove_on_success=True)
+                    except Exception as e:
+                        logger.warning("exception occurred while uploading cv results: {}".format(e))
     return
 
 
@@ -114,7 +137,7 @@ def create_course_folds(label_type, k = 5, multithread = True):
     logger.info("creating cross-validation folds")
     for raw_data_bucket in job_config.raw_data_buckets:
         reslist = []
-        with Pool(num_cores) as pool:
+        with label_sharing_pool(job_config, raw_data_bucket, ["morf-data/" + f for f in LABEL_FILES[mode]], num_cores) as pool:
             for course in fetch_complete_courses(job_config, raw_data_bucket):
                 poolres = pool.apply_async(make_folds, [job_config, raw_data_bucket, course, k, label_type])
                 reslist.append(poolres)
@@ -217,6 +240,26 @@ def initialize_cv_labels(job_config, users, raw_data_bucket, course, label_type,
     return out_path
 
 
+def fetch_fold_data(job_config, course, fold_num, type, dest_dir):
+    """
+    Download the train or test data of a fold created by make_folds into dest_dir as csv, for use by the docker image.
+    :param job_config: MorfJobConfig object.
+    :param course: course slug.
+    :param fold_num: fold number.
+    :param type: one of {train, test}.
+    :param dest_dir: directory to download into.
+    :return: pandas.DataFrame of fold data, with all columns read as strings.
+    """
+    fold_csv = make_feature_csv_name(course, fold_num, type)
+    key = make_s3_key_path(job_config, course, make_intermediate_filename(job_config, fold_csv))
+    fold_fp = download_from_s3(job_config.proc_data_bucket, key, job_config.initialize_s3(), dir=dest_dir, job_config=job_config)
+    fold_df = read_intermediate(fold_fp, dtype=object)
+    if not fold_fp.endswith(".csv"): # docker images always read csv
+        fold_df.to_csv(os.path.join(dest_dir, fold_csv), index=False)
+        os.remove(fold_fp)
+    return fold_df
+
+
 def execute_image_for_cv(job_config, raw_data_bucket, course, fold_num, docker_image_dir, label_type, raw_data_dir="morf-data/"):
     """
 
@@ -231,26 +274,40 @@ def execute_image_for_cv(job_config, raw_data_bucket, course, fold_num, docker_i
     """
     user_id_col = "userID"
     logger = set_logger_handlers(module_logger, job_config)
-    with tempfile.TemporaryDirectory(dir=job_config.local_working_directory) as working_dir:
-        input_dir, output_dir = initialize_input_output_dirs(working_dir)
-        # get fold train data
-        course_input_dir = os.path.join(input_dir, course)
-        trainkey = make_s3_key_path(job_config, course, make_feature_csv_name(course, fold_num, "train"))
-        train_data_path = download_from_s3(job_config.proc_data_bucket, trainkey, job_config.initialize_s3(), dir=course_input_dir, job_config=job_config)
-        testkey = make_s3_key_path(job_config, course, make_feature_csv_name(course, fold_num, "test"))
-        test_data_path = download_from_s3(job_config.proc_data_bucket, testkey, job_config.initialize_s3(), dir=course_input_dir, job_config=job_config)
-        # get labels
-        train_users = pd.read_csv(train_data_path)[user_id_col]
-        train_labels_path = initialize_cv_labels(job_config, train_users, raw_data_bucket, course, label_type, input_dir, raw_data_dir, fold_num, "train", level="course")
-        # run docker image with mode == cv
-        image_uuid = load_docker_image(docker_image_dir, job_config, logger)
-        cmd = make_docker_run_command(job_config, job_config.docker_exec, input_dir, output_dir, image_uuid, course, None, mode,
-                                      job_config.client_args) + " --fold_num {}".format(fold_num)
-        execute_and_log_output(cmd, logger)
-        # upload results
-        pred_csv = os.path.join(output_dir, "{}_{}_test.csv".format(course, fold_num))
-        pred_key = make_s3_key_path(job_config, course, os.path.basename(pred_csv), mode="test")
-        upload_file_to_s3(pred_csv, job_config.proc_data_bucket, pred_key, job_config, remove_on_success=True)
+    # count s3 requests made for this task against the course; pool workers exit without running atexit handlers,
+    # so the counts are written when the block exits
+    with s3_metrics_context(job_config, stage=mode, course=course):
+        task_id = make_task_id(mode, "course", course, None, "fold", fold_num, label_type)
+        if getattr(job_config, "resume", False):
+            fingerprint = make_task_fingerprint(job_config, {"task": task_id}, os.path.join(docker_image_dir, "docker_image"),
+                                                upstream_modes=(mode,), label_files=LABEL_FILES["train"], data_dir=raw_data_dir)
+            if task_is_complete(job_config, task_id, fingerprint, require_outputs=True):
+                logger.info("task {} was completed by an earlier run of this job; skipping".format(task_id))
+                return
+            task_context = job_task(job_config, task_id, fingerprint, require_outputs=True)
+        else:
+            task_context = untracked_task(job_config, task_id)
+        with task_context as task:
+            with tempfile.TemporaryDirectory(dir=job_config.local_working_directory) as working_dir:
+                input_dir, output_dir = initialize_input_output_dirs(working_dir)
+                # get fold train data
+                course_input_dir = os.path.join(input_dir, course)
+                train_df = fetch_fold_data(job_config, course, fold_num, "train", course_input_dir)
+                fetch_fold_data(job_config, course, fold_num, "test", course_input_dir)
+                # get labels
+                train_users = train_df[user_id_col]
+                train_labels_path = initialize_cv_labels(job_config, train_users, raw_data_bucket, course, label_type, input_dir, raw_data_dir, fold_num, "train", level="course")
+                # run docker image with mode == cv
+                with registered_docker_image(job_config, os.path.join(docker_image_dir, "docker_image"), logger) as image_uuid:
+                    cmd = make_docker_run_command(job_config, job_config.docker_exec, input_dir, output_dir, image_uuid, course, None, mode,
+                                                  job_config.client_args) + " --fold_num {}".format(fold_num)
+                    returncode = execute_and_log_output(cmd, logger)
+                if returncode:
+                    task.fail("docker run exited with status {}".format(returncode))
+                # upload results
+                pred_csv = os.path.join(output_dir, "{}_{}_test.csv".format(course, fold_num))
+                pred_key = make_s3_key_path(job_config, course, os.path.basename(pred_csv), mode="test")
+                upload_file_to_s3(pred_csv, job_config.proc_data_bucket, pred_key, job_config, remove_on_success=True)
     return
 
 
@@ -273,7 +330,7 @@ def cross_validate_course(label_type, k=5, multithread=True):
     logger.info("conducting cross validation")
     for raw_data_bucket in job_config.raw_data_buckets:
         reslist = []
-        with Pool(num_cores) as pool:
+        with label_sharing_pool(job_config, raw_data_bucket, ["morf-data/" + f for f in LABEL_FILES[mode]], num_cores) as pool:
             for course in fetch_complete_courses(job_config, raw_data_bucket):
                 for fold_num in range(1, k + 1):
                     poolres = pool.apply_async(execute_image_for_cv, [job_config, raw_data_bucket, course, fold_num, docker_image_dir, label_type])
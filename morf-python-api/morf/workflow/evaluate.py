@@ -28,7 +28,9 @@ import numpy as np
 import sklearn.metrics
 from morf.utils.api_utils import *
 from morf.utils.config import MorfJobConfig
-from morf.utils.job_runner_utils import load_docker_image
+from morf.utils.docker import registered_docker_image
+from morf.utils.frames import intermediate_extension, read_intermediate, get_user_id_dictionary, make_lean_frame, \
+    align_categories
 from morf.utils.log import set_logger_handlers
 from morf.utils.security import hash_df_column
 from morf.utils.s3interface import make_s3_key_path
@@ -95,8 +97,9 @@ def fetch_binary_classification_metrics(job_config, df, course, pred_prob_col =
         metrics["f1_score"] = np.nan
     metrics["cohen_kappa_score"] = sklearn.metrics.cohen_kappa_score(y_true, y_pred)
     metrics["N"] = df.shape[0]
-    metrics["N_n"] = df[label_col].value_counts().get(0,0)
-    metrics["N_p"] = df[label_col].value_counts().get(1,0)
+    # count from the label values as floats, so the counts do not depend on the dtype labels were read with
+    metrics["N_n"] = int((y_true == 0).sum())
+    metrics["N_p"] = int((y_true == 1).sum())
     cm = sklearn.metrics.confusion_matrix(y_true, y_pred)
     try:
         spec = cm[0,0] / float(cm[0,0] + cm[1,0])
@@ -144,17 +147,22 @@ def evaluate_course(label_type, label_col = "label_type", raw_data_dir = "morf-d
     clear_s3_subdirectory(job_config)
     course_data = []
     for raw_data_bucket in raw_data_buckets:
-        pred_file = generate_archive_filename(job_config, mode="test", extension="csv")
+        pred_file = generate_archive_filename(job_config, mode="test", extension=intermediate_extension(job_config))
         pred_key = "{}/{}/{}/{}".format(job_config.user_id, job_config.job_id, "test", pred_file)
         label_key = raw_data_dir + labels_file
         # download course prediction and label files, fetch classification metrics at course level
         with tempfile.TemporaryDirectory(dir=os.getcwd()) as working_dir:
             download_from_s3(proc_data_bucket, pred_key, s3, working_dir, job_config=job_config)
             download_from_s3(raw_data_bucket, label_key, s3, working_dir, job_config=job_config)
-            pred_df = pd.read_csv("/".join([working_dir, pred_file]))
+            # join on integer user ID codes and categorical courses, with numeric columns downcast; label values are
+            # left as read, so the metrics computed from them do not change
+            user_ids = get_user_id_dictionary(job_config)
+            pred_df = make_lean_frame(read_intermediate("/".join([working_dir, pred_file])), user_ids, user_col)
             lab_df = pd.read_csv("/".join([working_dir, labels_file]), dtype=object)
-            lab_df = lab_df[lab_df[label_col] == label_type].copy()
+            lab_df = make_lean_frame(lab_df[lab_df[label_col] == label_type], user_ids, user_col, keep_columns=["label_value"])
+            align_categories([lab_df, pred_df], [course_col])
             pred_lab_df = pd.merge(lab_df, pred_df, how = "left", on = [user_col, course_col])
+            del pred_df, lab_df
             check_dataframe_complete(pred_lab_df, job_config, columns = pred_cols)
             for course in fetch_complete_courses(job_config, data_bucket = raw_data_bucket, data_dir = raw_data_dir, n_train=1):
                 course_metrics_df = fetch_binary_classification_metrics(job_config, pred_lab_df, course)
@@ -164,7 +172,7 @@ def evaluate_course(label_type, label_col = "label_type", raw_data_dir = "morf-d
     master_metrics_df[course_col] = hash_df_column(master_metrics_df[course_col], job_config.user_id, job_config.hash_secret)
     master_metrics_df.to_csv(csv_fp, index = False, header = True)
     upload_key = make_s3_key_path(job_config, mode = "test", filename=csv_fp)
-    upload_file_to_s3(csv_fp, bucket=proc_data_bucket, key=upload_key)
+    upload_file_to_s3(csv_fp, bucket=proc_data_bucket, key=upload_key, job_config=job_config)
     os.remove(csv_fp)
     return
 
@@ -195,16 +203,21 @@ def evaluate_cv_course(label_type, k=5, label_col = "label_type", raw_data_dir =
     clear_s3_subdirectory(job_config)
     course_data = []
     for raw_data_bucket in raw_data_buckets:
-        pred_file = generate_archive_filename(job_config, mode="test", extension="csv")
+        pred_file = generate_archive_filename(job_config, mode="test", extension=intermediate_extension(job_config))
         pred_key = make_s3_key_path(job_config, pred_file, mode="test")
         # download course prediction and label files, fetch classification metrics at course level
         with tempfile.TemporaryDirectory(dir=os.getcwd()) as working_dir:
             pred_csv = download_from_s3(proc_data_bucket, pred_key, s3, working_dir, job_config=job_config)
             job_config.update_mode("cv") # set mode to cv to fetch correct labels for sessions even if they are train/test sessions
             label_csv = initialize_labels(job_config, raw_data_bucket, None, None, label_type, working_dir, raw_data_dir, level="all")
-            pred_df = pd.read_csv(pred_csv)
-            lab_df = pd.read_csv(label_csv, dtype=object)
+            # join on integer user ID codes and categorical courses, with numeric columns downcast; label values are
+            # left as read, so the metrics computed from them do not change
+            user_ids = get_user_id_dictionary(job_config)
+            pred_df = make_lean_frame(read_intermediate(pred_csv), user_ids, user_col)
+            lab_df = make_lean_frame(read_intermediate(label_csv, dtype=object), user_ids, user_col, keep_columns=["label_value"])
+            align_categories([lab_df, pred_df], [course_col])
             pred_lab_df = pd.merge(lab_df, pred_df, how = "left", on = [user_col, course_col])
+            del pred_df, lab_df
             check_dataframe_complete(pred_lab_df, job_config, columns = list(pred_cols))
             for course in fetch_complete_courses(job_config, data_bucket = raw_data_bucket, data_dir = raw_data_dir, n_train=1):
                 fold_metrics_list = list()
@@ -226,7 +239,7 @@ def evaluate_cv_course(label_type, k=5, label_col = "label_type", raw_data_dir =
     master_metrics_df[course_col] = hash_df_column(master_metrics_df[course_col], job_config.user_id, job_config.hash_secret)
     master_metrics_df.to_csv(csv_fp, index = False, header = True)
     upload_key = make_s3_key_path(job_config, mode = "test", filename=csv_fp)
-    upload_file_to_s3(csv_fp, bucket=proc_data_bucket, key=upload_key)
+    upload_file_to_s3(csv_fp, bucket=proc_data_bucket, key=upload_key, job_config=job_config)
     os.remove(csv_fp)
     return
 
@@ -262,15 +275,13 @@ def evaluate_prule_session():
                     feat_local_fp = download_from_s3(proc_data_bucket, feat_key, s3, input_dir, job_config=job_config)
                     unarchive_file(feat_local_fp, input_dir)
         docker_image_fp = urlparse(job_config.prule_evaluate_image).path
-        docker_image_dir = os.path.dirname(docker_image_fp)
-        docker_image_name = os.path.basename(docker_image_fp)
-        image_uuid = load_docker_image(docker_image_dir, job_config, logger, image_name=docker_image_name)
         # create a directory for prule file and copy into it; this will be mounted to docker image
         prule_dir = os.path.join(working_dir, "prule")
         os.makedirs(prule_dir)
         shutil.copy(urlparse(prule_file).path, prule_dir)
-        cmd = "{} run --network=\"none\" --rm=true --volume={}:/input --volume={}:/output --volume={}:/prule {} ".format(job_config.docker_exec, input_dir, output_dir, prule_dir, image_uuid)
-        subprocess.call(cmd, shell=True)
+        with registered_docker_image(job_config, docker_image_fp, logger) as image_uuid:
+            cmd = "{} run --network=\"none\" --rm=true --volume={}:/input --volume={}:/output --volume={}:/prule {} ".format(job_config.docker_exec, input_dir, output_dir, prule_dir, image_uuid)
+            subprocess.call(cmd, shell=True)
         # rename result file and upload results to s3
         final_output_file = os.path.join(output_dir, "output.csv")
         final_output_archive_name = generate_archive_filename(job_config, extension="csv")
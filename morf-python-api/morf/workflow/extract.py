@@ -29,8 +29,10 @@ from multiprocessing import Pool
 from morf.utils.alerts import send_email_alert
 from morf.utils.api_utils import *
 from morf.utils.config import MorfJobConfig
+from morf.utils.frames import intermediate_extension
 from morf.utils.job_runner_utils import run_image
 from morf.utils.log import set_logger_handlers
+from morf.utils.s3interface import copy_s3_objects
 
 # define module-level variables for config.properties
 CONFIG_FILENAME = "config.properties"
@@ -52,7 +54,7 @@ def extract_all():
     run_image(job_config, job_config.raw_data_buckets, level=level)
     result_file = collect_all_results(job_config)
     upload_key = make_s3_key_path(job_config, filename=result_file)
-    upload_file_to_s3(result_file, bucket=job_config.proc_data_bucket, key=upload_key)
+    upload_file_to_s3(result_file, bucket=job_config.proc_data_bucket, key=upload_key, job_config=job_config)
     os.remove(result_file)
     send_email_alert(job_config)
     return
@@ -89,7 +91,7 @@ def extract_course(raw_data_dir="morf-data/", multithread = True):
             logger.info(res.get())
     result_file = collect_course_results(job_config)
     upload_key = make_s3_key_path(job_config, filename=result_file)
-    upload_file_to_s3(result_file, bucket=job_config.proc_data_bucket, key=upload_key)
+    upload_file_to_s3(result_file, bucket=job_config.proc_data_bucket, key=upload_key, job_config=job_config)
     os.remove(result_file)
     send_email_alert(job_config)
     return
@@ -132,12 +134,13 @@ def extract_session(labels=False, raw_data_dir="morf-data/", label_type="labels-
     if not labels:  # normal feature extraction job; collects features across all buckets and upload to proc_data_bucket
         result_file = collect_session_results(job_config)
         upload_key = "{}/{}/extract/{}".format(job_config.user_id, job_config.job_id, result_file)
-        upload_file_to_s3(result_file, bucket=job_config.proc_data_bucket, key=upload_key)
+        upload_file_to_s3(result_file, bucket=job_config.proc_data_bucket, key=upload_key, job_config=job_config)
+        partition_collected_features(job_config, result_file)
     else:  # label extraction job; copy file into raw course data dir instead of proc_data_bucket, creating separate label files for each bucket
         for raw_data_bucket in job_config.raw_data_buckets:
-            result_file = collect_session_results(job_config, raw_data_buckets=[raw_data_bucket])
+            result_file = collect_session_results(job_config, raw_data_buckets=[raw_data_bucket], extension="csv")
             upload_key = raw_data_dir + "{}.csv".format(label_type)
-            upload_file_to_s3(result_file, bucket=raw_data_bucket, key=upload_key)
+            upload_file_to_s3(result_file, bucket=raw_data_bucket, key=upload_key, job_config=job_config)
     os.remove(result_file)
     send_email_alert(job_config)
     return
@@ -158,7 +161,7 @@ def extract_holdout_all():
     run_image(job_config, job_config.raw_data_buckets, level=level)
     result_file = collect_all_results(job_config)
     upload_key = make_s3_key_path(job_config, filename=result_file)
-    upload_file_to_s3(result_file, bucket=job_config.proc_data_bucket, key=upload_key)
+    upload_file_to_s3(result_file, bucket=job_config.proc_data_bucket, key=upload_key, job_config=job_config)
     os.remove(result_file)
     send_email_alert(job_config)
     return
@@ -197,7 +200,7 @@ def extract_holdout_course(raw_data_dir="morf-data/", multithread = True):
             logger.info(res.get())
     result_file = collect_course_results(job_config)
     upload_key = make_s3_key_path(job_config, filename=result_file)
-    upload_file_to_s3(result_file, bucket=job_config.proc_data_bucket, key=upload_key)
+    upload_file_to_s3(result_file, bucket=job_config.proc_data_bucket, key=upload_key, job_config=job_config)
     os.remove(result_file)
     send_email_alert(job_config)
     return
@@ -238,12 +241,13 @@ def extract_holdout_session(labels=False, raw_data_dir="morf-data/", label_type=
     if not labels:  # normal feature extraction job; collects features across all buckets and upload to proc_data_bucket
         result_file = collect_session_results(job_config, holdout=True)
         upload_key = "{}/{}/{}/{}".format(job_config.user_id, job_config.job_id, job_config.mode, result_file)
-        upload_file_to_s3(result_file, bucket=job_config.proc_data_bucket, key=upload_key)
+        upload_file_to_s3(result_file, bucket=job_config.proc_data_bucket, key=upload_key, job_config=job_config)
+        partition_collected_features(job_config, result_file)
     else:  # label extraction job; copy file into raw course data dir instead of proc_data_bucket, creating separate label files for each bucket
         for raw_data_bucket in job_config.raw_data_buckets:
-            result_file = collect_session_results(job_config, raw_data_buckets=[raw_data_bucket], holdout = True)
+            result_file = collect_session_results(job_config, raw_data_buckets=[raw_data_bucket], holdout = True, extension="csv")
             upload_key = raw_data_dir + "{}-test.csv".format(label_type)
-            upload_file_to_s3(result_file, bucket=raw_data_bucket, key=upload_key)
+            upload_file_to_s3(result_file, bucket=raw_data_bucket, key=upload_key, job_config=job_config)
     os.remove(result_file)
     send_email_alert(job_config)
     return
@@ -256,32 +260,42 @@ def fork_features(job_id_to_fork, raw_data_dir = "morf-data/"):
     :return: None.
     """
     job_config = MorfJobConfig(CONFIG_FILENAME)
-    #todo: multithread this
-    for mode in ["extract", "extract-holdout"]:
+    logger = set_logger_handlers(module_logger, job_config)
+    modes = ["extract", "extract-holdout"]
+    key_pairs = list()
+    for mode in modes:
         job_config.update_mode(mode)
-        clear_s3_subdirectory(job_config)
+        clear_s3_subdirectory(job_config, asynchronous = False)
         for raw_data_bucket in job_config.raw_data_buckets:
-            print("[INFO] forking features from bucket {} mode {}".format(raw_data_bucket, mode))
+            logger.info("forking features from bucket {} mode {}".format(raw_data_bucket, mode))
             courses = fetch_courses(job_config, raw_data_bucket, raw_data_dir)
             for course in courses:
                 for session in fetch_sessions(job_config, raw_data_bucket, raw_data_dir, course,
                                               fetch_holdout_session_only = mode == "extract-holdout"):
-                    # get current location of file, with old jobid name
+                    # location of archive file in s3 with old job_id name, and new location with current job_id name
                     prev_job_archive_filename = generate_archive_filename(job_config, course = course, session = session, mode = mode, job_id = job_id_to_fork)
-                    # get location of prev archive file in s3
                     prev_job_key = make_s3_key_path(job_config, filename=prev_job_archive_filename, course=course, session=session, mode=mode, job_id=job_id_to_fork)
-                    prev_job_s3_url = "s3://{}/{}".format(job_config.proc_data_bucket, prev_job_key)
-                    # make new location of file, with new jobid name
-                    current_job_archive_filename = generate_archive_filename(job_config, course=course, session=session,
-                                                                          mode=mode)
-                    # copy frmo current location to new location
-                    current_job_key = make_s3_key_path(job_config, filename=current_job_archive_filename, course=course,
-                                                    session=session, mode=mode)
-                    current_job_s3_url = "s3://{}/{}".format(job_config.proc_data_bucket, current_job_key)
-                    copy_s3_file(job_config, sourceloc = prev_job_s3_url, destloc = current_job_s3_url)
-        # after copying individual extraction results, copy collected feature file
-        result_file = collect_session_results(job_config, holdout = mode == "extract-holdout")
-        upload_key = "{}/{}/{}/{}".format(job_config.user_id, job_config.job_id, job_config.mode, result_file)
-        upload_file_to_s3(result_file, bucket=job_config.proc_data_bucket, key=upload_key)
+                    current_job_archive_filename = generate_archive_filename(job_config, course=course, session=session, mode=mode)
+                    current_job_key = make_s3_key_path(job_config, filename=current_job_archive_filename, course=course, session=session, mode=mode)
+                    key_pairs.append((prev_job_key, current_job_key))
+        # copy collected feature file from forked job instead of rebuilding it from the session archives
+        prev_job_result_file = generate_archive_filename(job_config, extension=intermediate_extension(job_config), mode=mode, job_id=job_id_to_fork)
+        current_job_result_file = generate_archive_filename(job_config, extension=intermediate_extension(job_config), mode=mode)
+        key_pairs.append((make_s3_key_path(job_config, filename=prev_job_result_file, mode=mode, job_id=job_id_to_fork),
+                          make_s3_key_path(job_config, filename=current_job_result_file, mode=mode)))
+    failed = copy_s3_objects(job_config, job_config.proc_data_bucket, key_pairs)
+    for mode in modes:
+        job_config.update_mode(mode)
+        result_key = make_s3_key_path(job_config, filename=generate_archive_filename(job_config, extension=intermediate_extension(job_config)))
+        if result_key in [dest_key for source_key, dest_key in failed]:
+            # forked job has no collected feature file; collect it from the copied session archives
+            logger.info("collecting forked features for mode {}".format(mode))
+            result_file = collect_session_results(job_config, holdout = mode == "extract-holdout")
+            upload_file_to_s3(result_file, bucket=job_config.proc_data_bucket, key=result_key, job_config=job_config)
+        else:
+            result_file = download_from_s3(job_config.proc_data_bucket, result_key, job_config.initialize_s3(), os.getcwd(),
+                                           dest_filename=os.path.basename(result_key), job_config=job_config)
+        # the partition index of the forked job lists keys under its own prefix; partition the features for this job
+        partition_collected_features(job_config, result_file)
+        os.remove(result_file)
     return
-
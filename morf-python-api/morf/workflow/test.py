@@ -53,8 +53,8 @@ def test_all(label_type):
     run_image(job_config, job_config.raw_data_buckets, level=level, label_type=label_type)
     # fetch archived result file and push csv result back to s3, mimicking session- and course-level workflow
     result_file = collect_all_results(job_config)
-    upload_key = make_s3_key_path(job_config, filename=generate_archive_filename(job_config, extension="csv"))
-    upload_file_to_s3(result_file, bucket=job_config.proc_data_bucket, key=upload_key)
+    upload_key = make_s3_key_path(job_config, filename=result_file)
+    upload_file_to_s3(result_file, bucket=job_config.proc_data_bucket, key=upload_key, job_config=job_config)
     os.remove(result_file)
     send_email_alert(job_config)
     return
@@ -93,8 +93,8 @@ def test_course(label_type, raw_data_dir="morf-data/", multithread=True):
         for res in reslist:
             logger.info(res.get())
     result_file = collect_course_results(job_config)
-    upload_key = make_s3_key_path(job_config, filename=generate_archive_filename(job_config, extension="csv"))
-    upload_file_to_s3(result_file, bucket=job_config.proc_data_bucket, key=upload_key)
+    upload_key = make_s3_key_path(job_config, filename=result_file)
+    upload_file_to_s3(result_file, bucket=job_config.proc_data_bucket, key=upload_key, job_config=job_config)
     os.remove(result_file)
     send_email_alert(job_config)
     return
@@ -26,6 +26,8 @@ Training functions for the MORF 2.0 API. For more information about the API, see
 from morf.utils import *
 from morf.utils.api_utils import *
 from morf.utils.job_runner_utils import run_image
+from morf.utils.labels import label_sharing_pool
+from morf.utils.memo import LABEL_FILES
 from morf.utils.alerts import send_email_alert
 from morf.utils.config import MorfJobConfig
 from morf.utils.log import set_logger_handlers
@@ -78,7 +80,7 @@ def train_course(label_type, raw_data_dir="morf-data/", multithread=True):
         logger.info("processing bucket {}".format(raw_data_bucket))
         courses = fetch_complete_courses(job_config, raw_data_bucket, raw_data_dir)
         reslist = []
-        with Pool(num_cores) as pool:
+        with label_sharing_pool(job_config, raw_data_bucket, [raw_data_dir + f for f in LABEL_FILES[mode]], num_cores) as pool:
             for course in courses:
                 poolres = pool.apply_async(run_image, [job_config, raw_data_bucket, course, None, level, label_type])
                 reslist.append(poolres)
@@ -114,7 +116,7 @@ def train_session(label_type, raw_data_dir="morf-data/", multithread=True):
         logger.info("processing bucket {}".format(raw_data_bucket))
         courses = fetch_complete_courses(job_config, raw_data_bucket, raw_data_dir)
         reslist = []
-        with Pool(num_cores) as pool:
+        with label_sharing_pool(job_config, raw_data_bucket, [raw_data_dir + f for f in LABEL_FILES[mode]], num_cores) as pool:
             for course in courses:
                 for session in fetch_sessions(job_config, raw_data_bucket, raw_data_dir, course):
                     poolres = pool.apply_async(run_image, [job_config, raw_data_bucket, course, session, level, label_type])
@@ -157,6 +157,11 @@ setup(
     # For an analysis of "install_requires" vs pip's requirements files see:
     # https://packaging.python.org/en/latest/requirements.html
     install_requires=['pandas', 'sklearn', 'boto3', 'boto', 'scipy'],  # Optional
+
+    # Optional dependencies, installed with e.g. pip install morf-api[parquet]
+    extras_require={
+        'parquet': ['pyarrow'],  # frames kept on the host as parquet instead of pickle; required for intermediate_format = parquet
+    },
     python_requires='>=3',
     setup_requires=["pytest-runner"],
     tests_require=["pytest"],